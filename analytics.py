@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+Analytics engine for DataScrape Pro
+Columnar snapshot of usage and revenue, extended incrementally, with vectorized churn, conversion and cohort MRR
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import db
+
+try:
+    import pyarrow  # noqa: F401
+    PART_FORMAT = 'parquet'
+except ImportError:
+    PART_FORMAT = 'pkl'
+
+# Where the snapshot parts live; defaults to an analytics/ directory next to the database
+SNAPSHOT_DIR = os.environ.get('DATASCRAPE_ANALYTICS_DIR') or os.path.join(
+    os.path.dirname(os.path.abspath(db.DATABASE_PATH)), 'analytics')
+# Rows read from SQLite per query while extending the snapshot
+CHUNK_ROWS = 200_000
+# Parts are merged into one once there are more than this many
+MAX_PARTS = 16
+
+USAGE_COLUMNS = ['day', 'user_id', 'calls', 'bytes']
+REVENUE_COLUMNS = ['id', 'user_id', 'amount', 'tier', 'payment_date']
+
+
+def _write(df, path):
+    """Write a part atomically; the dot-prefixed temp file never matches a part glob"""
+    tmp = os.path.join(os.path.dirname(path), '.tmp-' + os.path.basename(path))
+    if PART_FORMAT == 'parquet':
+        df.to_parquet(tmp, index=False)
+    else:
+        df.to_pickle(tmp)
+    os.replace(tmp, path)
+
+
+def _read(path):
+    return pd.read_parquet(path) if path.endswith('.parquet') else pd.read_pickle(path)
+
+
+class Snapshot:
+    """Append-only columnar copy of api_usage (as daily per-user totals) and revenue
+
+    Each refresh reads only rows with an id above the last one processed and
+    writes them as a new part; api_usage rows are aggregated to one row per
+    (day, user) on the way in, so the snapshot stays small even after the raw
+    rows are compacted away by rollups.py. Run refresh at least once per raw
+    retention window (90 days) so no rows are compacted before they are seen.
+    """
+
+    def __init__(self, path=SNAPSHOT_DIR):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.state_path = os.path.join(path, 'state.json')
+        self.state = {'usage_last_id': 0, 'revenue_last_id': 0}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state.update(json.load(f))
+
+    def _save_state(self):
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.state_path)
+
+    def _parts(self, table):
+        """Committed parts of table as (first_id, last_id, path), dropping leftovers of a crash"""
+        parts = []
+        for path in glob.glob(os.path.join(self.path, f'{table}-*-*.*')):
+            name = os.path.basename(path).split('.')[0]
+            _, first, last = name.split('-')
+            parts.append((int(first), int(last), path))
+        committed = self.state[f'{table}_last_id']
+        # Parts past the committed id were written by a refresh that did not finish;
+        # parts inside another part's range were merged by an interrupted compaction
+        keep = [p for p in parts if p[0] <= committed or (p[0] == 0 and p[1] == 0)]
+        keep = [p for p in keep if not any(o is not p and o[0] <= p[0] and p[1] <= o[1]
+                                           and (o[0], o[1]) != (p[0], p[1]) for o in keep)]
+        for part in set(parts) - set(keep):
+            os.remove(part[2])
+        return sorted(keep)
+
+    def _part_path(self, table, first, last):
+        return os.path.join(self.path, f'{table}-{first:012d}-{last:012d}.{PART_FORMAT}')
+
+    def _seed_usage(self, conn):
+        """On the first refresh, take days whose raw rows are already compacted from usage_daily"""
+        first_raw = conn.execute('SELECT MIN(timestamp) FROM api_usage').fetchone()[0]
+        query = 'SELECT day, user_id, SUM(calls), SUM(bytes) FROM usage_daily'
+        params = ()
+        if first_raw is not None:
+            query += ' WHERE day < ?'
+            params = (first_raw[:10],)
+        rows = conn.execute(query + ' GROUP BY day, user_id', params).fetchall()
+        if rows:
+            _write(pd.DataFrame.from_records(rows, columns=USAGE_COLUMNS), self._part_path('usage', 0, 0))
+
+    def _extend_usage(self):
+        added = 0
+        last_id = self.state['usage_last_id']
+        while True:
+            with db.connection() as conn:
+                if last_id == 0 and not self._parts('usage'):
+                    self._seed_usage(conn)
+                rows = conn.execute(
+                    '''SELECT id, user_id, substr(timestamp, 1, 10), COALESCE(response_size, 0)
+                       FROM api_usage WHERE id > ? AND user_id IS NOT NULL ORDER BY id LIMIT ?''',
+                    (last_id, CHUNK_ROWS)).fetchall()
+            if not rows:
+                break
+            raw = pd.DataFrame.from_records(rows, columns=['id', 'user_id', 'day', 'bytes'])
+            daily = (raw.groupby(['day', 'user_id'], sort=False)
+                     .agg(calls=('id', 'size'), bytes=('bytes', 'sum')).reset_index())
+            first, last = int(raw['id'].iat[0]), int(raw['id'].iat[-1])
+            _write(daily[USAGE_COLUMNS], self._part_path('usage', first, last))
+            last_id = last
+            self.state['usage_last_id'] = last_id
+            self._save_state()
+            added += len(rows)
+            if len(rows) < CHUNK_ROWS:
+                break
+        return added
+
+    def _extend_revenue(self):
+        with db.connection() as conn:
+            rows = conn.execute(f'SELECT {", ".join(REVENUE_COLUMNS)} FROM revenue WHERE id > ? ORDER BY id',
+                                (self.state['revenue_last_id'],)).fetchall()
+        if rows:
+            df = pd.DataFrame.from_records(rows, columns=REVENUE_COLUMNS)
+            first, last = int(df['id'].iat[0]), int(df['id'].iat[-1])
+            _write(df, self._part_path('revenue', first, last))
+            self.state['revenue_last_id'] = last
+            self._save_state()
+        return len(rows)
+
+    def _compact(self, table, regroup):
+        parts = self._parts(table)
+        if len(parts) <= MAX_PARTS:
+            return
+        merged = regroup(pd.concat([_read(p[2]) for p in parts], ignore_index=True))
+        first = min(p[0] for p in parts)
+        _write(merged, self._part_path(table, first, max(p[1] for p in parts)))
+        for part in parts:
+            os.remove(part[2])
+
+    def refresh(self):
+        """Append rows added since the last refresh; returns counts and timing"""
+        start = time.perf_counter()
+        usage_added = self._extend_usage()
+        revenue_added = self._extend_revenue()
+        self._compact('usage', lambda df: df.groupby(['day', 'user_id'], as_index=False)[['calls', 'bytes']].sum())
+        self._compact('revenue', lambda df: df)
+        return {
+            'usage_rows_added': usage_added,
+            'revenue_rows_added': revenue_added,
+            'usage_last_id': self.state['usage_last_id'],
+            'revenue_last_id': self.state['revenue_last_id'],
+            'refresh_s': time.perf_counter() - start,
+        }
+
+    def load(self, table):
+        parts = self._parts(table)
+        if not parts:
+            return pd.DataFrame(columns=USAGE_COLUMNS if table == 'usage' else REVENUE_COLUMNS)
+        return pd.concat([_read(p[2]) for p in parts], ignore_index=True)
+
+    def usage(self):
+        df = self.load('usage')
+        if df.empty:
+            return df
+        df = df.groupby(['day', 'user_id'], as_index=False)[['calls', 'bytes']].sum()
+        df['day'] = pd.to_datetime(df['day'])
+        return df
+
+    def revenue(self):
+        df = self.load('revenue')
+        df['payment_date'] = pd.to_datetime(df['payment_date'])
+        df['amount'] = df['amount'].astype(float)
+        return df
+
+
+def load_users():
+    """Users are mutable (tier changes), so they are read fresh; the table is small"""
+    with db.connection() as conn:
+        rows = conn.execute('SELECT id, tier, created_at, requests_used FROM users').fetchall()
+    users = pd.DataFrame.from_records(rows, columns=['user_id', 'tier', 'created_at', 'requests_used'])
+    users['created_at'] = pd.to_datetime(users['created_at'])
+    users['requests_used'] = users['requests_used'].fillna(0).astype(np.int64)
+    return users
+
+
+def _records(df):
+    """DataFrame -> JSON-friendly list of dicts"""
+    return json.loads(df.to_json(orient='records', date_format='iso'))
+
+
+def tier_prices(revenue, prices=None):
+    """Monthly price per tier: as given, else the latest amount charged for it"""
+    if prices is not None:
+        return pd.Series(prices, dtype=float)
+    if revenue.empty:
+        return pd.Series(dtype=float)
+    return revenue.sort_values('payment_date').groupby('tier')['amount'].last()
+
+
+def revenue_by_tier(revenue, now, days=30):
+    recent = revenue[revenue['payment_date'] > now - pd.Timedelta(days=days)]
+    out = (recent.groupby('tier')
+           .agg(subscribers=('user_id', 'size'), total_revenue=('amount', 'sum'),
+                avg_revenue_per_user=('amount', 'mean'))
+           .reset_index())
+    return out
+
+
+def usage_by_tier(usage, users, now, days=7):
+    recent = usage[usage['day'] > now - pd.Timedelta(days=days)]
+    per_tier = recent.merge(users[['user_id', 'tier']], on='user_id', how='left')
+    per_tier['tier'] = per_tier['tier'].fillna('unknown')
+    calls = per_tier.groupby('tier')[['calls', 'bytes']].sum()
+    used = users.groupby('tier')['requests_used'].sum()
+    out = pd.DataFrame({'requests_used': used}).join(calls, how='outer').fillna(0)
+    out['api_calls'] = out['calls'].astype(np.int64)
+    out['avg_response_size'] = out['bytes'] / out['calls'].replace(0, np.nan)
+    return out.reset_index().rename(columns={'index': 'tier'})[
+        ['tier', 'api_calls', 'avg_response_size', 'requests_used']]
+
+
+def cohorts(users, revenue, prices):
+    """Per signup month: signups, paid conversions, revenue collected and current MRR"""
+    if users.empty:
+        columns = ['cohort', 'signups', 'converted', 'revenue_total', 'mrr',
+                   'median_days_to_convert', 'conversion_rate']
+        return pd.DataFrame(columns=columns), users.assign(mrr=0.0, converted=False, days_to_convert=np.nan)
+    users = users.assign(cohort=users['created_at'].dt.to_period('M'))
+    users['mrr'] = users['tier'].map(prices).fillna(0.0)
+    first_paid = revenue.groupby('user_id')['payment_date'].min()
+    collected = revenue.groupby('user_id')['amount'].sum()
+    users['converted'] = users['user_id'].isin(first_paid.index)
+    users['revenue'] = users['user_id'].map(collected).fillna(0.0)
+    paid_at = pd.Series(first_paid.reindex(users['user_id']).to_numpy(), index=users.index)
+    users['days_to_convert'] = (paid_at - users['created_at']).dt.total_seconds() / 86400
+
+    out = users.groupby('cohort').agg(
+        signups=('user_id', 'size'), converted=('converted', 'sum'),
+        revenue_total=('revenue', 'sum'), mrr=('mrr', 'sum'),
+        median_days_to_convert=('days_to_convert', 'median')).reset_index()
+    out['conversion_rate'] = out['converted'] / out['signups']
+    out['cohort'] = out['cohort'].astype(str)
+    return out, users
+
+
+def churn(usage, users, paid_only=True):
+    """Month-over-month churn of active users (any API call in the month)
+
+    churn_rate for month m is the share of users active in m-1 with no calls in m.
+    """
+    columns = ['month', 'active_prev', 'active', 'churned', 'churn_rate']
+    if paid_only:
+        usage = usage[usage['user_id'].isin(users.loc[users['tier'] != 'free', 'user_id'])]
+    if usage.empty:
+        return pd.DataFrame(columns=columns)
+    # users x months activity matrix, filled by fancy indexing
+    month = (usage['day'].dt.year * 12 + usage['day'].dt.month - 1).to_numpy()
+    first = month.min()
+    user_codes, _ = pd.factorize(usage['user_id'])
+    matrix = np.zeros((user_codes.max() + 1, month.max() - first + 1), dtype=bool)
+    matrix[user_codes, month - first] = True
+    if matrix.shape[1] < 2:
+        return pd.DataFrame(columns=columns)
+    prev, cur = matrix[:, :-1], matrix[:, 1:]
+    active_prev = prev.sum(axis=0)
+    churned = (prev & ~cur).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rate = np.where(active_prev > 0, churned / active_prev, np.nan)
+    months = np.arange(first + 1, month.max() + 1)
+    labels = [f'{m // 12}-{m % 12 + 1:02d}' for m in months]
+    return pd.DataFrame({'month': labels, 'active_prev': active_prev, 'active': cur.sum(axis=0),
+                         'churned': churned, 'churn_rate': rate})
+
+
+def analyze(prices=None, now=None, snapshot=None, refresh=True):
+    """Refresh the snapshot and return every metric as plain Python structures"""
+    snapshot = snapshot or Snapshot()
+    info = snapshot.refresh() if refresh else dict(snapshot.state)
+    now = pd.Timestamp(now or datetime.now(timezone.utc).replace(tzinfo=None))
+
+    start = time.perf_counter()
+    users = load_users()
+    usage = snapshot.usage()
+    revenue = snapshot.revenue()
+    prices = tier_prices(revenue, prices)
+
+    by_cohort, users = cohorts(users, revenue, prices)
+    by_tier = revenue_by_tier(revenue, now)
+    usage_tiers = usage_by_tier(usage, users, now)
+    churn_by_month = churn(usage, users)
+    collected_30d = float(revenue.loc[revenue['payment_date'] > now - pd.Timedelta(days=30), 'amount'].sum())
+    converted = int(users['converted'].sum())
+    info['compute_s'] = time.perf_counter() - start
+
+    return {
+        'generated_at': now.isoformat(),
+        'snapshot': info,
+        'mrr': {'current': float(users['mrr'].sum()), 'collected_30d': collected_30d},
+        'revenue_by_tier': _records(by_tier),
+        'usage_by_tier': _records(usage_tiers),
+        'conversion': {
+            'signups': int(len(users)),
+            'converted': converted,
+            'rate': converted / len(users) if len(users) else 0.0,
+            'median_days_to_convert': float(users['days_to_convert'].median())
+            if converted else None,
+        },
+        'cohorts': _records(by_cohort),
+        'churn': _records(churn_by_month),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Incremental revenue and usage analytics')
+    parser.add_argument('--snapshot', default=SNAPSHOT_DIR, help='snapshot directory')
+    parser.add_argument('--refresh-only', action='store_true', help='extend the snapshot and exit')
+    parser.add_argument('--no-refresh', action='store_true', help='analyze the snapshot as it is')
+    args = parser.parse_args()
+
+    snapshot = Snapshot(args.snapshot)
+    if args.refresh_only:
+        print(json.dumps(snapshot.refresh(), indent=2))
+        return
+    print(json.dumps(analyze(snapshot=snapshot, refresh=not args.no_refresh), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,127 +3,222 @@ DataScrape Pro - Revenue-generating web scraping and analytics service
 Tiered pricing model with API access and custom analytics
 """
 
-from flask import Flask, request, jsonify, render_template_string
-import requests
-from bs4 import BeautifulSoup
-import sqlite3
-import json
+from flask import Flask, Response, request, jsonify
+import hmac
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
+import uuid
 from urllib.parse import urljoin, urlparse
-import pandas as pd
+
+import auth
+import dashboard
+import db
+import export
+import extraction
+import fetcher
+import fingerprints
+import hosts
+import instrumentation
+import jobs
+import results as result_store
+import responses
+import rollups
+import scraper
+import state
+import structured
+from quota import QuotaManager
+from usage_log import usage_logger
 
 app = Flask(__name__)
+# jsonify() through orjson when installed, compact and in insertion order
+app.json = responses.JSONProvider(app)
+
+# Maximum number of jobs accepted by one /api/scrape/batch call
+MAX_BATCH_SIZE = 100
+
+# Operator token for the /api/admin endpoints; they are disabled while unset
+ADMIN_TOKEN = os.environ.get('DATASCRAPE_ADMIN_TOKEN')
+
+MB = 1024 * 1024
 
-# Pricing tiers (monthly in USD)
+# Pricing tiers (monthly in USD); max_page_bytes and max_fetch_seconds cap one target page
 PRICING_TIERS = {
-    'free': {'requests_per_month': 100, 'price': 0, 'features': ['Basic scraping', 'JSON export']},
-    'starter': {'requests_per_month': 5000, 'price': 29, 'features': ['Advanced scraping', 'CSV/JSON export', 'API access']},
-    'professional': {'requests_per_month': 50000, 'price': 99, 'features': ['Unlimited scraping', 'All exports', 'Priority support', 'Custom analytics']},
-    'enterprise': {'requests_per_month': -1, 'price': 299, 'features': ['Everything in Pro', 'Custom integrations', 'Dedicated support']}
+    'free': {'requests_per_month': 100, 'price': 0, 'features': ['Basic scraping', 'JSON export'],
+             'cache_hits_count': True, 'burst': 10, 'rate_per_second': 1, 'export_formats': ['jsonl'],
+             'scheduled_jobs': 0, 'max_page_bytes': 5 * MB, 'max_fetch_seconds': 15},
+    'starter': {'requests_per_month': 5000, 'price': 29, 'features': ['Advanced scraping', 'CSV/JSON export', 'API access'],
+                'cache_hits_count': True, 'burst': 50, 'rate_per_second': 5, 'export_formats': ['csv', 'jsonl'],
+                'scheduled_jobs': 5, 'max_page_bytes': 20 * MB, 'max_fetch_seconds': 30},
+    'professional': {'requests_per_month': 50000, 'price': 99, 'features': ['Unlimited scraping', 'All exports', 'Priority support', 'Custom analytics'],
+                     'cache_hits_count': False, 'burst': 200, 'rate_per_second': 20,
+                     'export_formats': ['csv', 'jsonl', 'parquet'], 'scheduled_jobs': 100,
+                     'max_page_bytes': 50 * MB, 'max_fetch_seconds': 60},
+    'enterprise': {'requests_per_month': -1, 'price': 299, 'features': ['Everything in Pro', 'Custom integrations', 'Dedicated support'],
+                   'cache_hits_count': False, 'burst': 1000, 'rate_per_second': 100,
+                   'export_formats': ['csv', 'jsonl', 'parquet'], 'scheduled_jobs': -1,
+                   'max_page_bytes': 200 * MB, 'max_fetch_seconds': 120}
 }
 
+quota_manager = QuotaManager(PRICING_TIERS)
+metrics_cache = dashboard.MetricsCache(PRICING_TIERS)
+
 def init_db():
     """Initialize SQLite database for users, usage tracking, and revenue"""
-    conn = sqlite3.connect('datascrape.db')
-    c = conn.cursor()
-    
-    # Users table
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        api_key TEXT UNIQUE NOT NULL,
-        tier TEXT DEFAULT 'free',
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        last_payment TIMESTAMP,
-        requests_used INTEGER DEFAULT 0,
-        monthly_reset TIMESTAMP
-    )''')
-    
-    # Revenue tracking
-    c.execute('''CREATE TABLE IF NOT EXISTS revenue (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        amount REAL,
-        tier TEXT,
-        payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )''')
-    
-    # API usage logs
-    c.execute('''CREATE TABLE IF NOT EXISTS api_usage (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        endpoint TEXT,
-        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        response_size INTEGER,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )''')
-    
-    conn.commit()
-    conn.close()
-
-def get_user_by_api_key(api_key):
+    with db.transaction() as conn:
+        # Users table
+        conn.execute('''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            api_key TEXT UNIQUE NOT NULL,
+            tier TEXT DEFAULT 'free',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_payment TIMESTAMP,
+            requests_used INTEGER DEFAULT 0,
+            monthly_reset TIMESTAMP
+        )''')
+
+        # Revenue tracking
+        conn.execute('''CREATE TABLE IF NOT EXISTS revenue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount REAL,
+            tier TEXT,
+            payment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )''')
+
+        # API usage logs
+        conn.execute('''CREATE TABLE IF NOT EXISTS api_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            endpoint TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            response_size INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )''')
+        
+        # Indexes and pre-aggregated usage rollups
+        rollups.create_schema(conn)
+        
+        # Stored scrape results, read back by /api/export
+        result_store.create_schema(conn)
+        
+        # Per-user fingerprints of the last result for each url and selector set
+        fingerprints.create_schema(conn)
+        
+        # Scheduled jobs, their work queue and webhook deliveries
+        jobs.create_schema(conn)
+        
+        # API keys selected for sampled profiling
+        instrumentation.create_schema(conn)
+        
+        # Migrations, tracked in SQLite's user_version
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            rollups.backfill_rollups(conn)
+            conn.execute('PRAGMA user_version = 1')
+
+def get_user_by_api_key(api_key, conn=None):
     """Get user information by API key"""
-    conn = sqlite3.connect('datascrape.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM users WHERE api_key = ?', (api_key,))
-    user = c.fetchone()
-    conn.close()
-    return user
-
-def check_rate_limit(user_id, tier):
-    """Check if user has exceeded their monthly limit"""
-    conn = sqlite3.connect('datascrape.db')
-    c = conn.cursor()
-    
-    # Reset monthly usage if needed
-    c.execute('SELECT monthly_reset, requests_used FROM users WHERE id = ?', (user_id,))
-    result = c.fetchone()
-    
-    if result:
-        monthly_reset, requests_used = result
-        if monthly_reset:
-            reset_date = datetime.fromisoformat(monthly_reset)
-            if datetime.now() > reset_date:
-                # Reset usage
-                c.execute('UPDATE users SET requests_used = 0, monthly_reset = ? WHERE id = ?',
-                         (datetime.now() + timedelta(days=30), user_id))
-                requests_used = 0
-        else:
-            # Set initial reset date
-            c.execute('UPDATE users SET monthly_reset = ? WHERE id = ?',
-                     (datetime.now() + timedelta(days=30), user_id))
-    
-    limit = PRICING_TIERS[tier]['requests_per_month']
-    if limit == -1:  # Unlimited
-        conn.commit()
-        conn.close()
-        return True
-    
-    if requests_used >= limit:
-        conn.close()
-        return False
-    
-    # Increment usage
-    c.execute('UPDATE users SET requests_used = requests_used + 1 WHERE id = ?', (user_id,))
-    conn.commit()
-    conn.close()
-    return True
-
-def log_api_usage(user_id, endpoint, response_size):
-    """Log API usage for analytics"""
-    conn = sqlite3.connect('datascrape.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO api_usage (user_id, endpoint, response_size) VALUES (?, ?, ?)',
-              (user_id, endpoint, response_size))
-    conn.commit()
-    conn.close()
+    return auth.user_cache.get(api_key, conn)
 
-@app.route('/')
-def home():
-    """Landing page with pricing and signup"""
-    return render_template_string("""
+def check_rate_limit(user_id, tier, count=1):
+    """Check if user has exceeded their burst or monthly limit, reserving count requests"""
+    return quota_manager.consume(user_id, tier, count)
+
+def rate_limit_response(tier, decision, requested=1):
+    """429 response explaining which limit a QuotaDecision hit"""
+    if decision.reason == 'burst':
+        body = {
+            'error': 'Too many requests',
+            'current_tier': tier,
+            'burst': PRICING_TIERS[tier]['burst'],
+            'requested': requested
+        }
+        response = jsonify(body)
+        if decision.retry_after is not None:
+            response.headers['Retry-After'] = str(max(1, int(decision.retry_after + 0.999)))
+        return response, 429
+    return jsonify({
+        'error': 'Rate limit exceeded',
+        'upgrade_url': '/',
+        'current_tier': tier,
+        'limit': PRICING_TIERS[tier]['requests_per_month'],
+        'requested': requested
+    }), 429
+
+def page_limit_response(tier, error):
+    """422 response for a target page over the tier's size or time cap"""
+    return jsonify({
+        'error': f'Page exceeds the {error.reason} limit of the {tier} tier ({error.limit} '
+                 f'{"bytes" if error.reason == "size" else "seconds"}); '
+                 'pass "limit" to extract while streaming, or upgrade',
+        'upgrade_url': '/',
+        'current_tier': tier
+    }), 422
+
+def upstream_error_response(error):
+    """503/403/502 response for a target that is down, refused by robots.txt or failing"""
+    if isinstance(error, hosts.HostUnavailable):
+        response = jsonify({'error': f'Target unavailable: {error}', 'retry_after': round(error.retry_after)})
+        response.headers['Retry-After'] = str(max(1, int(error.retry_after + 0.999)))
+        return response, 503
+    if isinstance(error, hosts.RobotsDisallowed):
+        return jsonify({'error': str(error)}), 403
+    return jsonify({'error': f'Target fetch failed: {error}'}), 502
+
+def parse_limits(limit, selectors):
+    """Per-selector match limits from an int (every selector) or a {key: int} dict"""
+    if limit is None:
+        return None
+    if isinstance(limit, int) and not isinstance(limit, bool):
+        limit = {key: limit for key in selectors}
+    if not isinstance(limit, dict) or not all(
+            key in selectors and isinstance(n, int) and not isinstance(n, bool) and n > 0
+            for key, n in limit.items()):
+        raise ValueError('limit must be a positive integer or a {selector key: positive integer} object')
+    return limit
+
+def parse_cache_ttl(cache_ttl):
+    """Client freshness bound in whole seconds, or None for the cache's default"""
+    if cache_ttl is None:
+        return None
+    try:
+        ttl = int(cache_ttl)
+    except (TypeError, ValueError, OverflowError):
+        ttl = -1
+    if isinstance(cache_ttl, bool) or ttl < 0:
+        raise ValueError('cache_ttl must be a non-negative number of seconds')
+    return ttl
+
+def request_selectors(data):
+    """Selectors of a scrape request; "structured": true adds all structured data under that key
+
+    Values starting with $ are JSONPath over the page's JSON-LD, microdata,
+    OpenGraph and embedded JSON state. Raises ValueError for a malformed one.
+    """
+    selectors = data.get('selectors') or {}
+    if data.get('structured') is True:
+        selectors = dict(selectors, structured='$')
+    structured.validate(selectors)
+    return selectors
+
+def change_tier(user_id, tier):
+    """Move a user to another tier, recording revenue and invalidating cached state"""
+    state.get_backend().change_tier(user_id, tier, PRICING_TIERS[tier]['price'])
+    auth.user_cache.invalidate(user_id=user_id)
+    quota_manager.forget(user_id)
+
+def log_api_usage(user_id, endpoint, response_size, tier=None):
+    """Log API usage for analytics (buffered, written in the background)"""
+    usage_logger.log(user_id, endpoint, response_size, tier)
+
+def log_api_usage_many(rows, tier=None):
+    """Log (user_id, endpoint, response_size) rows for analytics in one batch"""
+    usage_logger.log_many(rows, tier)
+
+# Templates are compiled once at import instead of on every request
+HOME_TEMPLATE = app.jinja_env.from_string("""
 <!DOCTYPE html>
 <html>
 <head>
@@ -195,96 +290,9 @@ def home():
     </div>
 </body>
 </html>
-    """, pricing=PRICING_TIERS)
+""")
 
-@app.route('/api/scrape', methods=['POST'])
-def api_scrape():
-    """Main scraping endpoint - the revenue generator"""
-    api_key = request.headers.get('X-API-Key')
-    if not api_key:
-        return jsonify({'error': 'API key required', 'upgrade_url': '/'}), 401
-    
-    user = get_user_by_api_key(api_key)
-    if not user:
-        return jsonify({'error': 'Invalid API key', 'signup_url': '/'}), 401
-    
-    user_id, api_key, tier = user[0], user[1], user[2]
-    
-    if not check_rate_limit(user_id, tier):
-        return jsonify({
-            'error': 'Rate limit exceeded',
-            'upgrade_url': '/',
-            'current_tier': tier,
-            'limit': PRICING_TIERS[tier]['requests_per_month']
-        }), 429
-    
-    data = request.json
-    url = data.get('url')
-    selectors = data.get('selectors', {})
-    
-    if not url:
-        return jsonify({'error': 'URL required'}), 400
-    
-    try:
-        # Perform the scraping
-        headers = {'User-Agent': 'DataScrape Pro Bot 1.0'}
-        response = requests.get(url, headers=headers, timeout=10)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        results = {}
-        
-        # Extract data based on selectors
-        if selectors:
-            for key, selector in selectors.items():
-                elements = soup.select(selector)
-                results[key] = [elem.get_text(strip=True) for elem in elements]
-        else:
-            # Default extraction - get title and meta description
-            results['title'] = soup.title.string if soup.title else None
-            meta_desc = soup.find('meta', attrs={'name': 'description'})
-            results['description'] = meta_desc.get('content') if meta_desc else None
-            results['headings'] = [h.get_text(strip=True) for h in soup.find_all(['h1', 'h2', 'h3'])]
-        
-        response_data = {
-            'url': url,
-            'data': results,
-            'timestamp': datetime.now().isoformat(),
-            'remaining_requests': PRICING_TIERS[tier]['requests_per_month'] - (user[7] if len(user) > 7 else 0) if PRICING_TIERS[tier]['requests_per_month'] != -1 else 'unlimited'
-        }
-        
-        # Log usage
-        log_api_usage(user_id, '/api/scrape', len(json.dumps(response_data)))
-        
-        return jsonify(response_data)
-        
-    except Exception as e:
-        return jsonify({'error': f'Scraping failed: {str(e)}'}), 500
-
-@app.route('/revenue-dashboard')
-def revenue_dashboard():
-    """Live revenue tracking dashboard"""
-    conn = sqlite3.connect('datascrape.db')
-    
-    # Get current revenue metrics
-    c = conn.cursor()
-    c.execute('SELECT COUNT(*) FROM users')
-    total_users = c.fetchone()[0]
-    
-    c.execute('SELECT tier, COUNT(*) FROM users GROUP BY tier')
-    user_tiers = dict(c.fetchall())
-    
-    c.execute('SELECT SUM(amount) FROM revenue WHERE payment_date > date("now", "-30 days")')
-    monthly_revenue = c.fetchone()[0] or 0
-    
-    c.execute('SELECT COUNT(*) FROM api_usage WHERE timestamp > date("now", "-1 day")')
-    daily_api_calls = c.fetchone()[0]
-    
-    conn.close()
-    
-    # Calculate projected MRR
-    projected_mrr = sum(PRICING_TIERS[tier]['price'] * count for tier, count in user_tiers.items() if tier != 'free')
-    
-    return render_template_string("""
+DASHBOARD_TEMPLATE = app.jinja_env.from_string("""
 <!DOCTYPE html>
 <html>
 <head>
@@ -366,12 +374,536 @@ def revenue_dashboard():
     </div>
 </body>
 </html>
-    """, 
-    monthly_revenue=monthly_revenue, 
-    projected_mrr=projected_mrr,
-    total_users=total_users,
-    daily_api_calls=daily_api_calls,
-    user_tiers=user_tiers)
+""")
+
+_home_page = None
+_dashboard_page = None
+
+@app.route('/')
+def home():
+    """Landing page with pricing and signup"""
+    global _home_page
+    # The landing page only depends on PRICING_TIERS, so render it once
+    if _home_page is None:
+        _home_page = HOME_TEMPLATE.render(pricing=PRICING_TIERS)
+    return _home_page
+
+@app.route('/api/scrape', methods=['POST'])
+@instrumentation.traced('/api/scrape')
+def api_scrape():
+    """Main scraping endpoint - the revenue generator"""
+    api_key = request.headers.get('X-API-Key')
+    if not api_key:
+        return jsonify({'error': 'API key required', 'upgrade_url': '/'}), 401
+    
+    data = request.json
+    url = data.get('url')
+    job_id = data.get('job')
+    # 'delta' returns only the selector keys that changed since the last scrape
+    mode = data.get('mode', 'full')
+    # Extract while the page downloads, stopping once each selector has limit matches
+    stream = bool(data.get('stream')) or data.get('limit') is not None
+    
+    if not url:
+        return jsonify({'error': 'URL required'}), 400
+    if mode not in ('full', 'delta'):
+        return jsonify({'error': "mode must be 'full' or 'delta'"}), 400
+    try:
+        selectors = request_selectors(data)
+        limits = parse_limits(data.get('limit'), selectors)
+        cache_ttl = parse_cache_ttl(data.get('cache_ttl'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Auth and quota are answered from memory; SQLite sees batched writes
+    with instrumentation.span('auth'):
+        user = get_user_by_api_key(api_key)
+    if not user:
+        return jsonify({'error': 'Invalid API key', 'signup_url': '/'}), 401
+    
+    user_id, api_key, tier = user[0], user[1], user[2]
+    instrumentation.identify(user_id, tier)
+    
+    # Some tiers get cache hits without spending quota; the charge is
+    # settled against the status the fetch actually returns
+    count = 1
+    if not stream and not PRICING_TIERS[tier]['cache_hits_count'] and scraper.is_cached(url, cache_ttl):
+        count = 0
+    
+    with instrumentation.span('quota'):
+        decision = check_rate_limit(user_id, tier, count)
+    if not decision:
+        return rate_limit_response(tier, decision)
+    
+    try:
+        # Scrape against what this user last received for the same url and
+        # selectors: the fetch is conditional and an unchanged body is not re-parsed
+        with instrumentation.span('fingerprint-load'):
+            previous = fingerprints.fingerprint_writer.latest(user_id, url, selectors)
+        config = PRICING_TIERS[tier]
+        if stream:
+            # Streamed pages bypass the page cache; the body is never held in memory
+            results, cache_info, fingerprint = scraper.scrape_streaming(
+                url, selectors, limits, previous, timeout=10,
+                max_bytes=config['max_page_bytes'], max_seconds=config['max_fetch_seconds'])
+        else:
+            results, cache_info, fingerprint = scraper.scrape_incremental(
+                url, selectors, previous, timeout=10, ttl=cache_ttl,
+                max_bytes=config['max_page_bytes'], max_seconds=config['max_fetch_seconds'])
+        count = quota_manager.settle(user_id, tier, count, cache_info['page'] == 'hit')
+        if not fingerprint.same_as(previous):
+            # Buffered and written in the background, like usage
+            with instrumentation.span('fingerprint-save'):
+                fingerprints.fingerprint_writer.save(user_id, url, selectors, fingerprint)
+        
+        response_data = {
+            'url': url,
+            'cache': cache_info,
+            'fingerprint': fingerprint.as_dict(),
+            'changed': previous is None or previous.result_hash != fingerprint.result_hash,
+            'timestamp': datetime.now().isoformat(),
+            'remaining_requests': decision.remaining
+        }
+        
+        # Delta against the client's base: the result hash it last saw, by default our stored one
+        since = data.get('since')
+        if mode == 'delta' and since == fingerprint.result_hash:
+            response_data.update(mode='delta', base=since, changes={}, removed=[])
+        elif mode == 'delta' and previous is not None and since in (None, previous.result_hash):
+            changes, removed = fingerprints.diff(previous.results, results)
+            response_data.update(mode='delta', base=previous.result_hash, changes=changes, removed=removed)
+        else:
+            response_data.update(mode='full', data=results)
+        
+        # JSON or MessagePack per Accept, compressed per Accept-Encoding, encoded once
+        with instrumentation.span('serialize'):
+            response = responses.respond(response_data)
+        
+        # Keep the results for /api/export (buffered, written in the background)
+        with instrumentation.span('usage-log'):
+            result_store.result_writer.store(user_id, job_id, url, results)
+            
+            # Log usage, sized from the bytes actually sent
+            log_api_usage(user_id, '/api/scrape', response.content_length, tier)
+        
+        return response
+        
+    except fetcher.FetchLimitExceeded as e:
+        # Nothing was scraped, so the request is not charged
+        quota_manager.refund(user_id, tier, count)
+        return page_limit_response(tier, e)
+    except fetcher.UPSTREAM_ERRORS as e:
+        quota_manager.refund(user_id, tier, count)
+        return upstream_error_response(e)
+    except Exception as e:
+        return jsonify({'error': f'Scraping failed: {str(e)}'}), 500
+
+@app.route('/api/scrape/batch', methods=['POST'])
+@instrumentation.traced('/api/scrape/batch')
+def api_scrape_batch():
+    """Batch scraping endpoint - many URLs per call, results streamed as NDJSON"""
+    api_key = request.headers.get('X-API-Key')
+    if not api_key:
+        return jsonify({'error': 'API key required', 'upgrade_url': '/'}), 401
+    
+    data = request.json or {}
+    jobs = data.get('jobs')
+    if not isinstance(jobs, list) or not jobs:
+        return jsonify({'error': 'jobs must be a non-empty list of {url, selectors}'}), 400
+    if len(jobs) > MAX_BATCH_SIZE:
+        return jsonify({'error': f'At most {MAX_BATCH_SIZE} jobs per batch'}), 400
+    if not all(isinstance(job, dict) and job.get('url') for job in jobs):
+        return jsonify({'error': 'URL required for every job'}), 400
+    try:
+        selector_sets = [request_selectors(job) for job in jobs]
+        cache_ttls = [parse_cache_ttl(job.get('cache_ttl')) for job in jobs]
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # One auth lookup and one quota reservation for the whole batch
+    with instrumentation.span('auth'):
+        user = get_user_by_api_key(api_key)
+    if not user:
+        return jsonify({'error': 'Invalid API key', 'signup_url': '/'}), 401
+    
+    user_id, tier = user[0], user[2]
+    instrumentation.identify(user_id, tier)
+    
+    # A batch larger than the tier's burst could never be admitted, however long the client waits
+    burst = PRICING_TIERS[tier]['burst']
+    if len(jobs) > burst:
+        return jsonify({
+            'error': f'At most {burst} jobs per batch on the {tier} tier',
+            'upgrade_url': '/',
+            'current_tier': tier,
+            'burst': burst,
+            'requested': len(jobs)
+        }), 400
+    
+    # Some tiers get cache hits without spending quota; each job's charge
+    # is settled against the status its fetch actually returns
+    cached = set()
+    if not PRICING_TIERS[tier]['cache_hits_count']:
+        cached = {index for index, (job, ttl) in enumerate(zip(jobs, cache_ttls))
+                  if scraper.is_cached(job['url'], ttl)}
+    count = len(jobs) - len(cached)
+    
+    with instrumentation.span('quota'):
+        decision = check_rate_limit(user_id, tier, count)
+    if not decision:
+        return rate_limit_response(tier, decision, count)
+    
+    # Results of the batch can be exported later by job id
+    job_id = str(data.get('job') or uuid.uuid4().hex)
+    # NDJSON or MessagePack records, compressed as a stream as negotiated
+    encoder = responses.RecordStream()
+    
+    def generate():
+        usage = []
+        stored = []
+        refunds = 0
+        try:
+            specs = [(job['url'], selectors, ttl) for job, selectors, ttl in zip(jobs, selector_sets, cache_ttls)]
+            config = PRICING_TIERS[tier]
+            for index, results, cache_info, error in scraper.scrape_many(
+                    specs, timeout=10, max_bytes=config['max_page_bytes'], max_seconds=config['max_fetch_seconds']):
+                line = {'index': index, 'url': jobs[index]['url']}
+                if error is None:
+                    line['data'] = results
+                    line['cache'] = cache_info
+                    line['timestamp'] = datetime.now().isoformat()
+                    stored.append((jobs[index]['url'], results))
+                    quota_manager.settle(user_id, tier, int(index not in cached), cache_info['page'] == 'hit')
+                else:
+                    line['error'] = f'Scraping failed: {str(error)}'
+                    if isinstance(error, fetcher.UNBILLED_ERRORS) and index not in cached:
+                        refunds += 1
+                chunk = encoder.encode(line)
+                usage.append((user_id, '/api/scrape/batch', len(chunk)))
+                yield chunk
+            tail = encoder.finish()
+            if tail:
+                # The end of a compressed stream is billed with the last result
+                user, endpoint, size = usage[-1]
+                usage[-1] = (user, endpoint, size + len(tail))
+                yield tail
+        finally:
+            # Log usage for every result that was produced, in one insert
+            if usage:
+                log_api_usage_many(usage, tier)
+            if stored:
+                result_store.result_writer.store_many(user_id, job_id, stored)
+            # Jobs whose target failed are not charged
+            if refunds:
+                quota_manager.refund(user_id, tier, refunds)
+    
+    return Response(generate(), mimetype=encoder.mimetype, headers={**encoder.headers, 'X-Job-Id': job_id})
+
+@app.route('/api/export')
+def api_export():
+    """Stream stored scrape results or usage as JSONL, CSV or Parquet"""
+    api_key = request.headers.get('X-API-Key')
+    if not api_key:
+        return jsonify({'error': 'API key required', 'upgrade_url': '/'}), 401
+    
+    user = get_user_by_api_key(api_key)
+    if not user:
+        return jsonify({'error': 'Invalid API key', 'signup_url': '/'}), 401
+    
+    user_id, tier = user[0], user[2]
+    
+    fmt = request.args.get('format', 'jsonl')
+    if fmt not in export.FORMATS:
+        return jsonify({'error': f'format must be one of {", ".join(export.FORMATS)}'}), 400
+    if fmt not in PRICING_TIERS[tier]['export_formats']:
+        return jsonify({
+            'error': f'{fmt} export is not included in your plan',
+            'upgrade_url': '/',
+            'current_tier': tier,
+            'export_formats': PRICING_TIERS[tier]['export_formats']
+        }), 403
+    if fmt == 'parquet' and not export.parquet_available():
+        return jsonify({'error': 'Parquet export is not available on this server'}), 501
+    
+    try:
+        query = export.ExportQuery(
+            user_id,
+            dataset=request.args.get('dataset', 'results'),
+            since=request.args.get('since'),
+            until=request.args.get('until'),
+            url=request.args.get('url'),
+            job=request.args.get('job'),
+            cursor=request.args.get('cursor')
+        )
+    except export.ExportError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Parquet is compressed already
+    encoding = responses.negotiate_encoding() if fmt != 'parquet' else None
+    compressor = responses.StreamCompressor(encoding) if encoding is not None else None
+    
+    def generate():
+        sent = 0
+        try:
+            for chunk in export.stream(fmt, query):
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                sent += len(chunk)
+                yield chunk
+            if compressor is not None:
+                chunk = compressor.finish()
+                sent += len(chunk)
+                yield chunk
+        finally:
+            # Exports are billed by bytes sent, like every other endpoint
+            log_api_usage(user_id, '/api/export', sent, tier)
+    
+    mimetype, extension = export.FORMATS[fmt]
+    filename = f'datascrape-{query.dataset}.{extension}'
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"', 'Vary': 'Accept-Encoding'}
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return Response(generate(), mimetype=mimetype, headers=headers)
+
+def authenticate():
+    """(user, None) for the request's X-API-Key, or (None, error response)"""
+    api_key = request.headers.get('X-API-Key')
+    if not api_key:
+        return None, (jsonify({'error': 'API key required', 'upgrade_url': '/'}), 401)
+    user = get_user_by_api_key(api_key)
+    if not user:
+        return None, (jsonify({'error': 'Invalid API key', 'signup_url': '/'}), 401)
+    return user, None
+
+def epoch_iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts is not None else None
+
+@app.route('/api/jobs', methods=['POST'])
+def api_create_job():
+    """Create a scheduled scrape; runs are executed by the jobs.py worker pool"""
+    user, error = authenticate()
+    if error:
+        return error
+    user_id, tier = user[0], user[2]
+    
+    data = request.json or {}
+    url = data.get('url')
+    schedule = data.get('schedule')
+    webhook_url = data.get('webhook_url')
+    jitter = data.get('jitter', jobs.DEFAULT_JITTER)
+    if not url or not schedule:
+        return jsonify({'error': 'url and schedule required'}), 400
+    if not isinstance(url, str) or not isinstance(schedule, str):
+        return jsonify({'error': 'url and schedule must be strings'}), 400
+    if webhook_url and (not isinstance(webhook_url, str) or
+                        urlparse(webhook_url).scheme not in ('http', 'https')):
+        return jsonify({'error': 'webhook_url must be an http(s) URL'}), 400
+    if not isinstance(jitter, int) or isinstance(jitter, bool):
+        return jsonify({'error': 'jitter must be an integer number of seconds'}), 400
+    try:
+        selectors = request_selectors(data)
+        cache_ttl = parse_cache_ttl(data.get('cache_ttl'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    allowed = PRICING_TIERS[tier]['scheduled_jobs']
+    with db.transaction() as conn:
+        active = conn.execute('SELECT COUNT(*) FROM scheduled_jobs WHERE user_id = ? AND enabled = 1',
+                              (user_id,)).fetchone()[0]
+        if allowed != -1 and active >= allowed:
+            return jsonify({
+                'error': 'Scheduled job limit reached',
+                'upgrade_url': '/',
+                'current_tier': tier,
+                'limit': allowed
+            }), 403
+        try:
+            job_id = jobs.create_job(conn, user_id, url, schedule,
+                                     selectors=selectors,
+                                     cache_ttl=cache_ttl,
+                                     webhook_url=webhook_url,
+                                     jitter=jitter)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        next_run_at = conn.execute('SELECT next_run_at FROM scheduled_jobs WHERE id = ?',
+                                   (job_id,)).fetchone()[0]
+    
+    return jsonify({'id': job_id, 'schedule': schedule, 'next_run_at': epoch_iso(next_run_at)}), 201
+
+@app.route('/api/jobs')
+def api_list_jobs():
+    """List the caller's scheduled jobs"""
+    user, error = authenticate()
+    if error:
+        return error
+    
+    with db.connection() as conn:
+        rows = conn.execute(
+            '''SELECT id, url, schedule, jitter, webhook_url, next_run_at, last_run_at, last_status
+               FROM scheduled_jobs WHERE user_id = ? AND enabled = 1 ORDER BY id''', (user[0],)).fetchall()
+    return jsonify({'jobs': [{
+        'id': job_id,
+        'url': url,
+        'schedule': schedule,
+        'jitter': jitter,
+        'webhook_url': webhook_url,
+        'next_run_at': epoch_iso(next_run_at),
+        'last_run_at': epoch_iso(last_run_at),
+        'last_status': last_status
+    } for job_id, url, schedule, jitter, webhook_url, next_run_at, last_run_at, last_status in rows]})
+
+@app.route('/api/jobs/<int:job_id>', methods=['DELETE'])
+def api_delete_job(job_id):
+    """Stop a scheduled job; its stored results remain exportable"""
+    user, error = authenticate()
+    if error:
+        return error
+    
+    with db.transaction() as conn:
+        updated = conn.execute('UPDATE scheduled_jobs SET enabled = 0 WHERE id = ? AND user_id = ?',
+                               (job_id, user[0])).rowcount
+        conn.execute("DELETE FROM job_queue WHERE schedule_id = ? AND status = 'queued'", (job_id,))
+    if not updated:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'id': job_id, 'enabled': False})
+
+@app.route('/api/jobs/<int:job_id>/runs')
+def api_job_runs(job_id):
+    """Recent runs of one scheduled job"""
+    user, error = authenticate()
+    if error:
+        return error
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    
+    with db.connection() as conn:
+        rows = conn.execute(
+            '''SELECT q.id, q.status, q.scheduled_for, q.started_at, q.finished_at, q.attempts, q.error
+               FROM job_queue q JOIN scheduled_jobs s ON s.id = q.schedule_id
+               WHERE q.schedule_id = ? AND s.user_id = ?
+               ORDER BY q.id DESC LIMIT ?''', (job_id, user[0], limit)).fetchall()
+    return jsonify({'job_id': job_id, 'runs': [{
+        'id': run_id,
+        'status': status,
+        'scheduled_for': epoch_iso(scheduled_for),
+        'started_at': epoch_iso(started_at),
+        'finished_at': epoch_iso(finished_at),
+        'attempts': attempts,
+        'error': run_error
+    } for run_id, status, scheduled_for, started_at, finished_at, attempts, run_error in rows]})
+
+@app.route('/revenue-dashboard')
+def revenue_dashboard():
+    """Live revenue tracking dashboard"""
+    global _dashboard_page
+    snapshot = metrics_cache.get()
+    
+    # Re-render only when the metrics snapshot has changed
+    if _dashboard_page is None or _dashboard_page[0] != snapshot.etag:
+        _dashboard_page = (snapshot.etag, DASHBOARD_TEMPLATE.render(**snapshot.metrics))
+    return _dashboard_page[1]
+
+@app.route('/api/metrics')
+def api_metrics():
+    """Revenue metrics as JSON, served from the background snapshot"""
+    snapshot = metrics_cache.get()
+    response = jsonify(dict(snapshot.metrics, generated_at=snapshot.generated_at))
+    response.set_etag(snapshot.etag)
+    response.headers['Cache-Control'] = f'public, max-age={int(dashboard.REFRESH_INTERVAL)}'
+    return response.make_conditional(request)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Per-stage latency histograms and SQLite lock counters for Prometheus"""
+    return Response(instrumentation.render(), mimetype='text/plain; version=0.0.4')
+
+def require_admin():
+    """403 response unless the request carries the operator token"""
+    token = request.headers.get('X-Admin-Token', '')
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        return jsonify({'error': 'Admin token required'}), 403
+    return None
+
+@app.route('/api/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def api_admin_profile():
+    """Switch sampled cProfile/tracemalloc captures on or off for one API key"""
+    error = require_admin()
+    if error:
+        return error
+    
+    if request.method == 'GET':
+        with db.connection() as conn:
+            return jsonify(instrumentation.profiling_status(conn))
+    
+    data = request.json or {}
+    api_key = data.get('api_key')
+    if not api_key:
+        return jsonify({'error': 'api_key required'}), 400
+    
+    if request.method == 'DELETE':
+        with db.transaction() as conn:
+            removed = instrumentation.disable_profiling(conn, api_key)
+        return jsonify({'removed': removed})
+    
+    try:
+        samples = int(data.get('samples', 10))
+        sample_rate = float(data.get('sample_rate', 1.0))
+        ttl = int(data.get('ttl', 600))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'samples, sample_rate and ttl must be numbers'}), 400
+    if samples < 1 or not 0 < sample_rate <= 1 or ttl < 1:
+        return jsonify({'error': 'samples and ttl must be positive, sample_rate in (0, 1]'}), 400
+    
+    with db.transaction() as conn:
+        instrumentation.enable_profiling(conn, api_key, samples, sample_rate, bool(data.get('memory')), ttl)
+    return jsonify({
+        'samples': samples,
+        'sample_rate': sample_rate,
+        'memory': bool(data.get('memory')),
+        'expires_in': ttl,
+        # Workers pick the change up on their next sync
+        'active_within_s': instrumentation.SYNC_INTERVAL,
+        'profile_dir': instrumentation.PROFILE_DIR
+    }), 201
+
+@app.route('/api/admin/profile/<name>')
+def api_admin_profile_capture(name):
+    """Top functions of one capture by cumulative time"""
+    error = require_admin()
+    if error:
+        return error
+    
+    path = os.path.join(instrumentation.PROFILE_DIR, os.path.basename(name))
+    if not path.endswith('.prof') or not os.path.exists(path):
+        return jsonify({'error': 'Capture not found'}), 404
+    return Response(instrumentation.summarize_profile(path), mimetype='text/plain')
+
+@app.route('/api/admin/tier', methods=['POST'])
+def api_admin_tier():
+    """Move an API key's user to another tier, e.g. after a payment or a downgrade"""
+    error = require_admin()
+    if error:
+        return error
+    
+    data = request.json or {}
+    api_key = data.get('api_key')
+    tier = data.get('tier')
+    if not api_key:
+        return jsonify({'error': 'api_key required'}), 400
+    if tier not in PRICING_TIERS:
+        return jsonify({'error': f'tier must be one of {", ".join(PRICING_TIERS)}'}), 400
+    
+    user = get_user_by_api_key(api_key)
+    if not user:
+        return jsonify({'error': 'Unknown API key'}), 404
+    if user[2] != tier:
+        change_tier(user[0], tier)
+    return jsonify({
+        'user_id': user[0],
+        'tier': tier,
+        'previous_tier': user[2],
+        # Other workers drop their cached user row within its TTL
+        'active_within_s': auth.USER_TTL
+    })
 
 @app.route('/api/signup', methods=['POST'])
 def api_signup():
@@ -386,18 +918,11 @@ def api_signup():
     
     api_key = 'ds_' + secrets.token_urlsafe(20)
     
-    conn = sqlite3.connect('datascrape.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO users (api_key, tier) VALUES (?, ?)', (api_key, tier))
-    user_id = c.lastrowid
+    # Records revenue too if paid tier
+    state.get_backend().create_user(api_key, tier, PRICING_TIERS[tier]['price'])
     
-    # Record revenue if paid tier
-    if PRICING_TIERS[tier]['price'] > 0:
-        c.execute('INSERT INTO revenue (user_id, amount, tier) VALUES (?, ?, ?)',
-                  (user_id, PRICING_TIERS[tier]['price'], tier))
-    
-    conn.commit()
-    conn.close()
+    # Drop any negative cache entry for the new key
+    auth.user_cache.invalidate(api_key)
     
     return jsonify({
         'api_key': api_key,
@@ -406,15 +931,27 @@ def api_signup():
         'monthly_cost': PRICING_TIERS[tier]['price']
     })
 
+def create_app():
+    """Application factory for gunicorn's 'app:create_app()'
+
+    Does the one-off work a worker would otherwise repeat, so with
+    preload_app it happens once in the master and every worker shares
+    the result copy-on-write. The schema is not touched here: init_db()
+    runs once per deployment (see gunicorn.conf.py).
+    """
+    home()
+    # Parser and encoder backends are imported on first use; load them
+    # here rather than in each worker's first request
+    extraction.preload()
+    responses.preload()
+    return app
+
 if __name__ == '__main__':
     init_db()
     # Add some demo users for demonstration
-    conn = sqlite3.connect('datascrape.db')
-    c = conn.cursor()
-    
+    backend = state.get_backend()
     # Check if demo users exist
-    c.execute('SELECT COUNT(*) FROM users')
-    if c.fetchone()[0] == 0:
+    if backend.count_users() == 0:
         # Add demo users to show revenue potential
         demo_users = [
             ('demo_free_001', 'free'),
@@ -425,16 +962,7 @@ if __name__ == '__main__':
         ]
         
         for api_key, tier in demo_users:
-            c.execute('INSERT INTO users (api_key, tier, requests_used) VALUES (?, ?, ?)', 
-                     (api_key, tier, 50))
-            user_id = c.lastrowid
-            
-            # Add revenue records for paid tiers
-            if PRICING_TIERS[tier]['price'] > 0:
-                c.execute('INSERT INTO revenue (user_id, amount, tier) VALUES (?, ?, ?)',
-                          (user_id, PRICING_TIERS[tier]['price'], tier))
-    
-    conn.commit()
-    conn.close()
+            # Revenue records are added for paid tiers
+            backend.create_user(api_key, tier, PRICING_TIERS[tier]['price'], requests_used=50)
     
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,58 @@
+"""
+API-key authentication cache for DataScrape Pro
+Keeps user rows in process memory so the hot path skips the state backend lookup
+"""
+
+import os
+import threading
+import time
+
+import state
+
+# How long a worker trusts a cached user row. Invalidation is immediate in
+# the worker that made the change; other workers converge within this bound.
+USER_TTL = float(os.environ.get('DATASCRAPE_USER_CACHE_TTL', 60))
+# Unknown keys are cached briefly so key-guessing floods stay off SQLite
+NEGATIVE_TTL = float(os.environ.get('DATASCRAPE_USER_CACHE_NEGATIVE_TTL', 5))
+MAX_ENTRIES = 100_000
+
+
+class UserCache:
+    """api_key -> users row, with positive and negative TTLs"""
+
+    def __init__(self, ttl=USER_TTL, negative_ttl=NEGATIVE_TTL, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_key, conn=None):
+        now = time.monotonic()
+        entry = self._entries.get(api_key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+        user = state.get_backend().get_user(api_key, conn)
+
+        expires = now + (self.ttl if user else self.negative_ttl)
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+            self._entries[api_key] = (user, expires)
+        return user
+
+    def invalidate(self, api_key=None, user_id=None):
+        """Forget one key, every key of a user, or everything"""
+        with self._lock:
+            if api_key is None and user_id is None:
+                self._entries.clear()
+                return
+            self._entries.pop(api_key, None)
+            if user_id is not None:
+                for key, (user, _) in list(self._entries.items()):
+                    if user and user[0] == user_id:
+                        del self._entries[key]
+
+
+user_cache = UserCache()
@@ -0,0 +1,143 @@
+"""
+Background workers for DataScrape Pro
+Fork-aware periodic threads and buffered writers used to move work off the request path
+"""
+
+import atexit
+import logging
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicWorker:
+    """Runs task() every interval seconds, or sooner when woken
+
+    The thread is started lazily by ensure_started(), so a module-level
+    worker created before gunicorn forks starts fresh in each worker
+    process. With drain_on_exit the task runs one final time at
+    interpreter exit so buffered state is not lost.
+    """
+
+    def __init__(self, name, interval, task, drain_on_exit=True):
+        self.name = name
+        self.interval = interval
+        self.task = task
+        self.drain_on_exit = drain_on_exit
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._wake = threading.Event()
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            if self._pid is None:
+                atexit.register(self.stop)
+            self._pid = os.getpid()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run_task(self):
+        try:
+            self.task()
+        except Exception:
+            logger.exception('%s task failed', self.name)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                break
+            self._run_task()
+
+    def stop(self):
+        """Stop the thread, running the task a final time if draining"""
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=10)
+        if self.drain_on_exit:
+            self._run_task()
+        self._pid = None
+
+
+class BufferedWriter(ABC):
+    """Ring buffer of rows persisted in batches by a PeriodicWorker
+
+    Subclasses implement write_batch(batch). Rows are dropped oldest-first
+    if the buffer overflows, and drained at interpreter exit.
+    """
+
+    def __init__(self, name, buffer_size, batch_size, interval):
+        self.name = name
+        self.batch_size = batch_size
+        self.dropped = 0
+        self._buffer = deque(maxlen=buffer_size)
+        self._pid = os.getpid()
+        self._flush_lock = threading.Lock()
+        self.flusher = PeriodicWorker(name, interval, self.flush)
+
+    def append_many(self, rows):
+        """Queue rows for the next flush; never touches SQLite"""
+        if self._pid != os.getpid():
+            # Rows inherited from the parent are the parent's to write
+            self._buffer.clear()
+            self._pid = os.getpid()
+        self.flusher.ensure_started()
+        buffer = self._buffer
+        for row in rows:
+            if len(buffer) == buffer.maxlen:
+                self.dropped += 1
+            buffer.append(row)
+        if len(buffer) >= self.batch_size:
+            self.flusher.wake()
+
+    def _take(self, limit):
+        batch = []
+        buffer = self._buffer
+        try:
+            while len(batch) < limit:
+                batch.append(buffer.popleft())
+        except IndexError:
+            pass
+        return batch
+
+    def flush(self):
+        """Write everything buffered, batch_size rows per transaction"""
+        with self._flush_lock:
+            if self.dropped:
+                logger.warning('%s buffer overflowed, %d rows dropped', self.name, self.dropped)
+                self.dropped = 0
+            while True:
+                batch = self._take(self.batch_size)
+                if not batch:
+                    return
+                try:
+                    self.write_batch(batch)
+                except Exception:
+                    # Put the batch back so a transient lock does not lose it
+                    self._buffer.extendleft(reversed(batch))
+                    raise
+
+    @abstractmethod
+    def write_batch(self, batch):
+        """Persist one batch; a failure puts it back for the next flush"""
+
+    def __len__(self):
+        return len(self._buffer)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Fetch Benchmark - compare blocking requests.get against the concurrent fetch engine
+Runs against the local target simulator so results are reproducible offline
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+
+from fetcher import FetchEngine, USER_AGENT
+from target_simulator import TargetSimulator
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(name, latencies, elapsed, failed=0):
+    return {
+        'mode': name,
+        'requests': len(latencies),
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'elapsed_s': elapsed,
+        'failed': failed,
+    }
+
+
+def bench_blocking(urls, workers, timeout):
+    """Model the current service: each sync worker does one requests.get at a time"""
+    start = time.perf_counter()
+    latencies = []
+    failed = []
+
+    def job(url):
+        try:
+            requests.get(url, headers={'User-Agent': USER_AGENT}, timeout=timeout).raise_for_status()
+        except requests.RequestException:
+            failed.append(url)
+        else:
+            latencies.append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(job, urls))
+    return summarize(f'blocking ({workers} workers)', latencies, time.perf_counter() - start, len(failed))
+
+
+def bench_engine(urls, max_in_flight, max_per_host, timeout):
+    """Submit every fetch to one FetchEngine, as a single gunicorn worker would"""
+    engine = FetchEngine(max_in_flight=max_in_flight, max_per_host=max_per_host)
+    start = time.perf_counter()
+    latencies = []
+    failed = []
+
+    def done(future):
+        if future.exception() is not None:
+            failed.append(future)
+        else:
+            latencies.append(time.perf_counter() - start)
+
+    futures = []
+    for url in urls:
+        future = engine.submit(url, timeout=timeout)
+        future.add_done_callback(done)
+        futures.append(future)
+    wait(futures)
+    elapsed = time.perf_counter() - start
+    engine.shutdown()
+    return summarize(f'engine (1 worker, {max_in_flight} in flight)', latencies, elapsed, len(failed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--hosts', type=int, default=50, help='distinct simulated target hosts')
+    parser.add_argument('--latency', type=float, default=0.2, help='simulated server latency (s)')
+    parser.add_argument('--size', type=int, default=20_000, help='page size in bytes')
+    parser.add_argument('--workers', type=int, default=4, help='blocking gunicorn workers to model')
+    parser.add_argument('--in-flight', type=int, default=256)
+    parser.add_argument('--per-host', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=30, help='per-fetch timeout (s)')
+    parser.add_argument('--degraded', type=float, default=0.0,
+                        help='share of fetches sent to one host that times out')
+    args = parser.parse_args()
+
+    sim = TargetSimulator(latency=args.latency, page_size=args.size).start()
+    urls = [sim.host_url(i % args.hosts, f'/page/{i}') for i in range(args.requests)]
+    if args.degraded:
+        # A popular target going down: it answers slower than the timeout
+        every = max(1, round(1 / args.degraded))
+        urls = [sim.host_url(253, f'/down/{i}?latency={args.timeout + 1}') if i % every == 0 else url
+                for i, url in enumerate(urls)]
+
+    print(f"⏱️  {args.requests} fetches over {args.hosts} hosts, "
+          f"{args.latency * 1000:.0f} ms server latency, {args.size} B pages"
+          + (f", {args.degraded:.0%} to a host that is down" if args.degraded else ''))
+    results = [bench_blocking(urls, args.workers, args.timeout),
+               bench_engine(urls, args.in_flight, args.per_host, args.timeout)]
+    sim.stop()
+
+    print(f"{'mode':<36}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'failed':>8}")
+    for r in results:
+        print(f"{r['mode']:<36}{r['throughput_rps']:>10.1f}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+              f"{r['failed']:>8}")
+    return results
+
+
+if __name__ == '__main__':
+    main()
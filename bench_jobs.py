@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Job Queue Benchmark - throughput and scheduling lag of the jobs.py worker pool
+Runs queued and scheduled scrapes against the local target simulator in a scratch database
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+
+from target_simulator import TargetSimulator
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=2000, help='one-off queue items')
+    parser.add_argument('--schedules', type=int, default=200, help='scheduled jobs due at start')
+    parser.add_argument('--jitter', type=int, default=5, help='jitter of the scheduled jobs (s)')
+    parser.add_argument('--hosts', type=int, default=50, help='distinct simulated target hosts')
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated server latency (s)')
+    parser.add_argument('--size', type=int, default=20_000, help='page size in bytes')
+    parser.add_argument('--processes', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--host-delay', type=float, default=0.0, help='politeness delay per host (s)')
+    parser.add_argument('--host-concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    # Configure before the project modules read their settings at import
+    os.environ['DATASCRAPE_DB'] = os.path.join(tempfile.mkdtemp(), 'bench_jobs.db')
+    os.environ['DATASCRAPE_JOB_HOST_DELAY'] = str(args.host_delay)
+    os.environ['DATASCRAPE_JOB_HOST_CONCURRENCY'] = str(args.host_concurrency)
+    import app
+    import db
+    import jobs
+
+    app.init_db()
+    sim = TargetSimulator(latency=args.latency, page_size=args.size).start()
+    start = time.time()
+    with db.transaction() as conn:
+        user_id = conn.execute("INSERT INTO users (api_key, tier) VALUES ('bench', 'enterprise')").lastrowid
+        for i in range(args.jobs):
+            jobs.enqueue(conn, user_id, sim.host_url(i % args.hosts, f'/job/{i}'), {'h': 'h2'}, run_at=start)
+        for i in range(args.schedules):
+            job_id = jobs.create_job(conn, user_id, sim.host_url(i % args.hosts, f'/schedule/{i}'),
+                                     '@hourly', {'h': 'h2'}, jitter=args.jitter)
+            conn.execute('UPDATE scheduled_jobs SET next_run_at = ? WHERE id = ?', (start, job_id))
+    db.get_pool().close()
+
+    total = args.jobs + args.schedules
+    print(f"⏱️  {args.jobs} queued + {args.schedules} scheduled jobs over {args.hosts} hosts, "
+          f"{args.processes} processes x {args.concurrency} in flight, "
+          f"{args.latency * 1000:.0f} ms server latency")
+    pool = multiprocessing.get_context('fork').Process(
+        target=jobs.run_pool, args=(args.processes, args.concurrency, app.PRICING_TIERS))
+    pool.start()
+    try:
+        while True:
+            time.sleep(0.5)
+            with db.connection() as conn:
+                finished = conn.execute('SELECT COUNT(*) FROM job_queue WHERE finished_at IS NOT NULL').fetchone()[0]
+            if finished >= total:
+                break
+    finally:
+        os.kill(pool.pid, signal.SIGTERM)
+        pool.join()
+        sim.stop()
+    elapsed = time.time() - start
+
+    stats = jobs.queue_stats(window=elapsed + 1)
+    stats['throughput_per_s'] = total / elapsed
+    stats['elapsed_s'] = elapsed
+    print(json.dumps(stats, indent=2))
+    return stats
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Startup Benchmark - app import time, gunicorn boot time and memory per worker
+Compares workers that each import the app with workers forked from a preloaded master
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmark import children, free_port
+from target_simulator import TargetSimulator
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPORT_SNIPPET = 'import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)'
+
+
+def import_seconds(env, runs):
+    """Median wall time of 'import app' in a fresh interpreter"""
+    times = [float(subprocess.run([sys.executable, '-c', IMPORT_SNIPPET], env=env, cwd=HERE,
+                                  capture_output=True, text=True, check=True).stdout)
+             for _ in range(runs)]
+    return statistics.median(times)
+
+
+def heaviest_imports(env, count):
+    """(module, ms) of the modules app imports directly, by cumulative import time"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], env=env, cwd=HERE,
+                            capture_output=True, text=True, check=True).stderr
+    direct = []
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|( +)(\S+)$', line)
+        # app's own imports are nested one level (two spaces) below it
+        if match and len(match.group(2)) == 3:
+            direct.append((match.group(3), int(match.group(1)) / 1000))
+    return sorted(direct, key=lambda item: -item[1])[:count]
+
+
+def memory_mb(pid):
+    """RSS, PSS and USS (private) of pid in MB from /proc/<pid>/smaps_rollup"""
+    fields = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {'rss': fields['Rss'], 'pss': fields['Pss'],
+            'uss': fields['Private_Clean'] + fields['Private_Dirty']}
+
+
+def cpu_seconds(pids):
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / ticks
+
+
+def boot(preload, args, env, urls):
+    """Start gunicorn, wait until its workers are idle, drive some traffic, then measure"""
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-w', str(args.workers),
+         '-b', f'127.0.0.1:{port}', '--log-level', 'warning'],
+        env=dict(env, DATASCRAPE_PRELOAD='1' if preload else '0'), cwd=HERE)
+    base = f'http://127.0.0.1:{port}'
+    try:
+        while True:
+            try:
+                requests.get(base + '/', timeout=1)
+                break
+            except requests.RequestException:
+                if time.perf_counter() - started > 60 or server.poll() is not None:
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.05)
+        first_response = time.perf_counter() - started
+
+        # Booted once every worker has finished importing and the CPU goes quiet
+        workers = []
+        busy, ready = None, first_response
+        while True:
+            workers = children(server.pid)
+            used = cpu_seconds([server.pid] + workers)
+            if used != busy or len(workers) < args.workers:
+                busy, ready = used, time.perf_counter() - started
+            elif time.perf_counter() - started - ready > 1.0:
+                break
+            time.sleep(0.1)
+        boot_cpu = busy
+
+        headers = {'X-API-Key': args.api_key}
+        with requests.Session() as session, ThreadPoolExecutor(16) as pool:
+            statuses = Counter(pool.map(
+                lambda url: session.post(base + '/api/scrape', json={'url': url, 'selectors': {'h': 'h1'}},
+                                         headers=headers, timeout=30).status_code, urls))
+        memory = [memory_mb(pid) for pid in workers]
+        master = memory_mb(server.pid)
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+    per_worker = {key: statistics.mean(m[key] for m in memory) for key in ('rss', 'pss', 'uss')}
+    return {'mode': 'preload' if preload else 'import per worker', 'first_response_s': first_response,
+            'ready_s': ready, 'boot_cpu_s': boot_cpu, 'master_rss_mb': master['rss'],
+            'statuses': dict(statuses), **{f'{key}_mb': value for key, value in per_worker.items()}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters timed for the import')
+    parser.add_argument('--requests', type=int, default=200, help='scrapes sent before measuring memory')
+    args = parser.parse_args()
+
+    env = dict(os.environ, DATASCRAPE_DB=os.path.join(tempfile.mkdtemp(), 'bench_startup.db'),
+               DATASCRAPE_METRICS_DIR=tempfile.mkdtemp())
+    os.environ.update(env)
+    import app
+    import state
+
+    app.init_db()
+    args.api_key = 'bench_startup'
+    state.get_backend().create_user(args.api_key, 'enterprise', 0)
+
+    print(f"⏱️  import app: {import_seconds(env, args.runs) * 1000:.0f} ms (median of {args.runs})")
+    for module, ms in heaviest_imports(env, 6):
+        print(f"   {module:<20}{ms:>8.0f} ms")
+
+    sim = TargetSimulator(page_size=20_000).start()
+    urls = [sim.host_url(i % 20, f'/page/{i}') for i in range(args.requests)]
+    results = [boot(False, args, env, urls), boot(True, args, env, urls)]
+    sim.stop()
+
+    print(f"{args.workers} gunicorn workers, memory after {args.requests} scrapes")
+    print(f"{'mode':<20}{'first 200 s':>12}{'ready s':>10}{'boot CPU s':>12}"
+          f"{'RSS MB':>9}{'PSS MB':>9}{'USS MB':>9}  statuses")
+    for r in results:
+        print(f"{r['mode']:<20}{r['first_response_s']:>12.2f}{r['ready_s']:>10.2f}{r['boot_cpu_s']:>12.2f}"
+              f"{r['rss_mb']:>9.1f}{r['pss_mb']:>9.1f}{r['uss_mb']:>9.1f}  {r['statuses']}")
+    return results
+
+
+if __name__ == '__main__':
+    main()
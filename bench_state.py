@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Shared State Benchmark - quota and usage-log throughput of 1..N nodes on one state backend
+Every node is a separate process with its own quota and usage buffers, as on separate machines
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from redis_standin import RedisStandin
+
+
+def run_node(user_ids, tier, threads, duration, results):
+    """Admit and log requests from threads until duration runs out"""
+    import app
+
+    stop = time.monotonic() + duration
+
+    def loop(offset):
+        requests = admitted = 0
+        i = offset
+        while time.monotonic() < stop:
+            user_id = user_ids[i % len(user_ids)]
+            i += threads
+            requests += 1
+            if app.quota_manager.consume(user_id, tier, burst=False):
+                admitted += 1
+                app.log_api_usage(user_id, '/api/scrape', 1000, tier)
+        return requests, admitted
+
+    with ThreadPoolExecutor(threads) as pool:
+        counts = list(pool.map(loop, range(threads)))
+    app.quota_manager.flush()
+    app.usage_logger.flush()
+    results.put((sum(c[0] for c in counts), sum(c[1] for c in counts)))
+
+
+def run_nodes(nodes, user_ids, tier, threads, duration):
+    ctx = multiprocessing.get_context('fork')
+    results = ctx.Queue()
+    procs = [ctx.Process(target=run_node, args=(user_ids, tier, threads, duration, results))
+             for _ in range(nodes)]
+    started = time.perf_counter()
+    for proc in procs:
+        proc.start()
+    counts = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    elapsed = time.perf_counter() - started
+    return sum(c[0] for c in counts), sum(c[1] for c in counts), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--state', default='standin',
+                        help='standin (local RESP stand-in), sqlite, or a redis:// URL')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--threads', type=int, default=8, help='request threads per node')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per run')
+    parser.add_argument('--users', type=int, default=200, help='API keys the load is spread over')
+    args = parser.parse_args()
+
+    # Configure before the project modules read their settings at import
+    os.environ['DATASCRAPE_DB'] = os.path.join(tempfile.mkdtemp(), 'bench_state.db')
+    standin = None
+    if args.state == 'standin':
+        standin = RedisStandin().start()
+        os.environ['DATASCRAPE_STATE'] = standin.url
+    else:
+        os.environ['DATASCRAPE_STATE'] = args.state
+    import app
+    import db
+    import state
+
+    app.init_db()
+    backend = state.get_backend()
+    db.get_pool().close()
+    label = 'stand-in' if standin else args.state
+    print(f"⏱️  {args.duration:.0f} s per run, {args.threads} threads per node, "
+          f"{args.users} professional keys, state backend: {label}")
+    print(f"{'nodes':>5}{'req/s':>12}{'per node':>12}{'backend cmds/req':>18}")
+    for nodes in args.nodes:
+        user_ids = [backend.create_user(f'bench_{nodes}_{i}', 'professional', 0) for i in range(args.users)]
+        calls = standin.calls if standin else 0
+        requests, _, elapsed = run_nodes(nodes, user_ids, 'professional', args.threads, args.duration)
+        ratio = f'{(standin.calls - calls) / requests:.3f}' if standin else 'n/a'
+        print(f"{nodes:>5}{requests / elapsed:>12.0f}{requests / elapsed / nodes:>12.0f}{ratio:>18}")
+
+    # Every node hammers one Starter key: every admission must be counted, and
+    # admissions may pass the limit only by the bound documented in quota.py
+    nodes = max(args.nodes)
+    limit = app.PRICING_TIERS['starter']['requests_per_month']
+    user_id = backend.create_user('bench_exact', 'starter', 0)
+    requests, admitted, _ = run_nodes(nodes, [user_id], 'starter', args.threads, args.duration)
+    used = backend.add_usage({}, [user_id]).get(user_id)
+    verdict = 'exact' if admitted <= limit else f'over by {admitted - limit}'
+    if used != admitted:
+        verdict += ', USAGE LOST'
+    print(f"🔒 {nodes} nodes, {requests} requests on one Starter key: "
+          f"{admitted} admitted, {used} counted, limit {limit} ({verdict})")
+
+
+if __name__ == '__main__':
+    main()
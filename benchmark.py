@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+"""
+API Benchmark - load-test /api/scrape, /api/signup and /revenue-dashboard
+Drives the app through Flask's test client and a real gunicorn against the target simulator,
+reporting throughput, latency percentiles, SQLite lock wait and memory per worker
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench_fetch import percentile
+from target_simulator import TargetSimulator
+
+SCENARIOS = ('scrape', 'signup', 'dashboard')
+MICRO = ('check_rate_limit', 'log_api_usage')
+# Relative change that counts as a regression against a baseline
+DEFAULT_THRESHOLD = 0.2
+
+
+def summarize(latencies, elapsed, statuses):
+    return {
+        'requests': len(latencies),
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'elapsed_s': elapsed,
+        'statuses': {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+def rss_mb(pid):
+    """Resident set size of pid from /proc, or None where /proc is unavailable"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def children(pid):
+    pids = []
+    for stat in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            pids.append(int(stat.split('/')[2]))
+    return pids
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Workload:
+    """Request generator shared by both drivers"""
+
+    def __init__(self, sim, api_keys, hosts, pages, cache_ttl, tiers):
+        self.sim = sim
+        self.api_keys = api_keys
+        self.hosts = hosts
+        self.pages = pages
+        self.cache_ttl = cache_ttl
+        self.tiers = tiers
+
+    def request(self, scenario, i):
+        """(method, path, json body, headers) for the i-th request of scenario"""
+        if scenario == 'scrape':
+            page = i % self.pages
+            body = {'url': self.sim.host_url(page % self.hosts, f'/page/{page}'),
+                    'selectors': {'titles': 'h2', 'prices': 'span.price'}}
+            if self.cache_ttl is not None:
+                body['cache_ttl'] = self.cache_ttl
+            return 'POST', '/api/scrape', body, {'X-API-Key': self.api_keys[i % len(self.api_keys)]}
+        if scenario == 'signup':
+            return 'POST', '/api/signup', {'tier': random.choice(self.tiers)}, {}
+        return 'GET', '/revenue-dashboard', None, {}
+
+
+def drive(send, workload, scenario, count, concurrency):
+    """Issue count requests from concurrency threads; send returns a status code"""
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+
+    def one(i):
+        method, path, body, headers = workload.request(scenario, i)
+        start = time.perf_counter()
+        try:
+            status = send(method, path, body, headers)
+        except requests.RequestException:
+            status = 'error'
+        took = time.perf_counter() - start
+        with lock:
+            latencies.append(took)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(count)))
+    return summarize(latencies, time.perf_counter() - start, statuses)
+
+
+def run_testclient(workload, args):
+    """Every scenario in this process through app.test_client()"""
+    import app
+    import db
+
+    local = threading.local()
+
+    def send(method, path, body, headers):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.app.test_client()
+        return client.open(path, method=method, json=body, headers=headers).status_code
+
+    results = {}
+    for scenario in args.scenarios:
+        db.get_pool().lock_stats.reset()
+        result = drive(send, workload, scenario, args.requests, args.concurrency)
+        result.update(db.lock_stats())
+        result['rss_mb'] = {'benchmark': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+        results[scenario] = result
+        report('testclient', scenario, result)
+    return results
+
+
+def run_gunicorn(workload, args, env):
+    """Each scenario against a fresh gunicorn, so lock stats and memory are per scenario"""
+    results = {}
+    for scenario in args.scenarios:
+        port = free_port()
+        stats_dir = tempfile.mkdtemp(prefix='dbstats-')
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-w', str(args.workers),
+             '--threads', str(args.threads), '-b', f'127.0.0.1:{port}', '--log-level', 'warning'],
+            env=dict(env, DATASCRAPE_DB_STATS_DIR=stats_dir),
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        base = f'http://127.0.0.1:{port}'
+        deadline = time.time() + 30
+        while True:
+            try:
+                requests.get(base + '/', timeout=1)
+                break
+            except requests.RequestException:
+                if time.time() > deadline or server.poll() is not None:
+                    server.kill()
+                    raise RuntimeError('gunicorn did not start')
+                time.sleep(0.2)
+
+        local = threading.local()
+
+        def send(method, path, body, headers):
+            session = getattr(local, 'session', None)
+            if session is None:
+                session = local.session = requests.Session()
+            return session.request(method, base + path, json=body, headers=headers, timeout=60).status_code
+
+        result = drive(send, workload, scenario, args.requests, args.concurrency)
+        workers = children(server.pid)
+        result['rss_mb'] = {str(pid): rss_mb(pid) for pid in workers}
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+
+        lock = {'transactions': 0, 'lock_wait_s': 0.0, 'lock_wait_max_ms': 0.0, 'lock_held_s': 0.0}
+        for path in glob.glob(os.path.join(stats_dir, 'dbstats-*.json')):
+            with open(path) as f:
+                stats = json.load(f)
+            for key in ('transactions', 'lock_wait_s', 'lock_held_s'):
+                lock[key] += stats[key]
+            lock['lock_wait_max_ms'] = max(lock['lock_wait_max_ms'], stats['lock_wait_max_ms'])
+        result.update(lock)
+        results[scenario] = result
+        report('gunicorn', scenario, result)
+    return results
+
+
+def run_micro(user_id, args):
+    """Per-call cost of the quota check and the usage logger, in this process"""
+    import app
+
+    results = {}
+    calls = {
+        'check_rate_limit': lambda: app.check_rate_limit(user_id, 'enterprise'),
+        'log_api_usage': lambda: app.log_api_usage(user_id, '/api/scrape', 1000, 'enterprise'),
+    }
+    for name in MICRO:
+        fn = calls[name]
+        fn()
+        latencies = []
+        start = time.perf_counter()
+        for _ in range(args.micro_calls):
+            t = time.perf_counter()
+            fn()
+            latencies.append(time.perf_counter() - t)
+        result = summarize(latencies, time.perf_counter() - start, {})
+        results[name] = result
+        report('micro', name, result)
+    app.usage_logger.flush()
+    return results
+
+
+def report(mode, name, r):
+    rss = [v for v in r.get('rss_mb', {}).values() if v is not None]
+    rss_text = f"{max(rss):>8.1f}" if rss else f"{'-':>8}"
+    lock_text = f"{r['lock_wait_s'] * 1000:>10.1f}" if 'lock_wait_s' in r else f"{'-':>10}"
+    print(f"{mode:<11}{name:<18}{r['throughput_rps']:>10.1f}{r['p50_ms']:>9.2f}{r['p95_ms']:>9.2f}"
+          f"{r['p99_ms']:>9.2f}{lock_text}{rss_text}  {r['statuses']}")
+
+
+def compare(results, baseline, threshold):
+    """Print regressions against a baseline file; returns how many were found"""
+    regressions = 0
+    for mode, scenarios in results['results'].items():
+        for name, r in scenarios.items():
+            base = baseline.get('results', {}).get(mode, {}).get(name)
+            if not base:
+                continue
+            checks = [('throughput_rps', r['throughput_rps'] < base['throughput_rps'] * (1 - threshold)),
+                      ('p99_ms', r['p99_ms'] > base['p99_ms'] * (1 + threshold))]
+            for metric, worse in checks:
+                change = (r[metric] - base[metric]) / base[metric] * 100 if base[metric] else 0.0
+                marker = 'REGRESSION' if worse else 'ok'
+                print(f"{marker:<11}{mode:<11}{name:<18}{metric:<15}{base[metric]:>10.2f} -> {r[metric]:>10.2f}"
+                      f" ({change:+.1f}%)")
+                regressions += worse
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True,
+                                       stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mode', choices=('testclient', 'gunicorn', 'both'), default='both')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+    parser.add_argument('--concurrency', type=int, default=32, help='client threads')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=64, help='threads per gunicorn worker')
+    parser.add_argument('--users', type=int, default=50, help='API keys the scrape load is spread over')
+    parser.add_argument('--hosts', type=int, default=20, help='distinct simulated target hosts')
+    parser.add_argument('--pages', type=int, default=200, help='distinct target pages')
+    parser.add_argument('--cache-ttl', type=int, default=None, help='cache_ttl sent with each scrape')
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated server latency (s)')
+    parser.add_argument('--size', type=int, default=20_000, help='simulated page size in bytes')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of simulated 500s')
+    parser.add_argument('--micro-calls', type=int, default=20_000)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare against a previous --output file')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative change that counts as a regression')
+    args = parser.parse_args()
+
+    # A scratch database, configured before the app modules are imported
+    workdir = tempfile.mkdtemp(prefix='datascrape-bench-')
+    env = dict(os.environ, DATASCRAPE_DB=os.path.join(workdir, 'bench.db'))
+    os.environ.update(env)
+    import app
+    import db
+    import state
+
+    app.init_db()
+    tiers = list(app.PRICING_TIERS)
+    user_ids = [state.get_backend().create_user(f'bench_{i}', 'enterprise', 0) for i in range(args.users)]
+    db.get_pool().close()
+    api_keys = [f'bench_{i}' for i in range(args.users)]
+
+    sim = TargetSimulator(latency=args.latency, page_size=args.size, error_rate=args.error_rate).start()
+    workload = Workload(sim, api_keys, args.hosts, args.pages, args.cache_ttl, tiers)
+
+    print(f"⏱️  {args.requests} requests per scenario, {args.concurrency} client threads, "
+          f"{args.latency * 1000:.0f} ms target latency, {args.size} B pages")
+    print(f"{'mode':<11}{'scenario':<18}{'req/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'lock ms':>10}{'RSS MB':>8}  statuses")
+    results = {}
+    try:
+        if args.mode in ('gunicorn', 'both'):
+            results['gunicorn'] = run_gunicorn(workload, args, env)
+        if args.mode in ('testclient', 'both'):
+            results['testclient'] = run_testclient(workload, args)
+        results['micro'] = run_micro(user_ids[0], args)
+    finally:
+        sim.stop()
+
+    output = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f"💾 Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"\n📏 Compared with {args.baseline} ({baseline.get('git_revision')}):")
+        if compare(output, baseline, args.threshold):
+            sys.exit(1)
+    return output
+
+
+if __name__ == '__main__':
+    main()
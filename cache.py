@@ -0,0 +1,318 @@
+"""
+Response cache for DataScrape Pro
+Content-addressed page and extraction caches with TTLs, conditional GETs and an optional disk tier
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import db
+import fetcher
+import state
+
+# Seconds a fetched page is served without contacting the target site
+DEFAULT_TTL = int(os.environ.get('DATASCRAPE_CACHE_TTL', 300))
+# Longest TTL a client may ask for with cache_ttl
+MAX_TTL = 24 * 3600
+# Memory budgets per worker process
+PAGE_CACHE_BYTES = int(os.environ.get('DATASCRAPE_PAGE_CACHE_BYTES', 64 * 1024 * 1024))
+EXTRACTION_CACHE_BYTES = int(os.environ.get('DATASCRAPE_EXTRACTION_CACHE_BYTES', 16 * 1024 * 1024))
+# Optional SQLite file shared by all gunicorn workers on this machine; without
+# it, a redis:// DATASCRAPE_STATE shares pages across every node instead
+DISK_CACHE_PATH = os.environ.get('DATASCRAPE_CACHE_DB')
+DISK_CACHE_BYTES = int(os.environ.get('DATASCRAPE_DISK_CACHE_BYTES', 1024 * 1024 * 1024))
+# Expired entries are kept this long so they can still be revalidated
+STALE_RETENTION = 24 * 3600
+
+
+def content_hash(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def selectors_key(selectors):
+    """Canonical form of a selector set, independent of key order"""
+    return json.dumps(selectors or {}, sort_keys=True, separators=(',', ':'))
+
+
+def conditional_headers(etag, last_modified):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+class CachedPage:
+    """A fetched page body plus the validators needed to revalidate it"""
+
+    __slots__ = ('url', 'body', 'encoding', 'etag', 'last_modified',
+                 'content_hash', 'fetched_at', 'expires_at')
+
+    def __init__(self, url, body, encoding, etag, last_modified, fetched_at, expires_at, digest=None):
+        self.url = url
+        self.body = body
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_hash = digest or content_hash(body)
+        self.fetched_at = fetched_at
+        self.expires_at = expires_at
+
+    @classmethod
+    def from_response(cls, url, response, ttl):
+        now = time.time()
+        return cls(url, response.content, response.encoding,
+                   response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                   now, now + ttl)
+
+    @property
+    def text(self):
+        return self.body.decode(self.encoding or 'utf-8', errors='replace')
+
+    @property
+    def size(self):
+        return len(self.body) + len(self.url)
+
+    def is_fresh(self, now=None):
+        return (now or time.time()) < self.expires_at
+
+    def conditional_headers(self):
+        return conditional_headers(self.etag, self.last_modified)
+
+
+class LRUCache:
+    """Thread-safe LRU mapping bounded by the total size of its values"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskCache:
+    """Page tier in a SQLite file shared by every worker process"""
+
+    def __init__(self, path, max_bytes=DISK_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.pool = db.ConnectionPool(path, size=4)
+        self._puts = 0
+        with self.pool.connection() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS page_cache (
+                url TEXT PRIMARY KEY,
+                body BLOB,
+                encoding TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT,
+                fetched_at REAL,
+                expires_at REAL
+            )''')
+
+    def get(self, url):
+        with self.pool.connection() as conn:
+            row = conn.execute('''SELECT url, body, encoding, etag, last_modified, fetched_at,
+                                  expires_at, content_hash FROM page_cache WHERE url = ?''',
+                               (url,)).fetchone()
+        return CachedPage(*row) if row else None
+
+    def put(self, page):
+        with self.pool.connection() as conn:
+            conn.execute('INSERT OR REPLACE INTO page_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (page.url, page.body, page.encoding, page.etag, page.last_modified,
+                          page.content_hash, page.fetched_at, page.expires_at))
+            self._puts += 1
+            if self._puts % 100 == 0:
+                self.prune(conn)
+
+    def prune(self, conn):
+        """Drop long-expired entries, then the oldest ones while over budget"""
+        conn.execute('DELETE FROM page_cache WHERE expires_at < ?', (time.time() - STALE_RETENTION,))
+        total = conn.execute('SELECT COALESCE(SUM(LENGTH(body)), 0) FROM page_cache').fetchone()[0]
+        if total > self.max_bytes:
+            conn.execute('''DELETE FROM page_cache WHERE url IN (
+                SELECT url FROM page_cache ORDER BY fetched_at LIMIT
+                (SELECT COUNT(*) / 4 + 1 FROM page_cache))''')
+
+
+class RedisCache:
+    """Page tier in the Redis every node shares (DATASCRAPE_STATE=redis://...)
+
+    Entries expire STALE_RETENTION after their TTL; the server's maxmemory
+    policy bounds the total size.
+    """
+
+    FIELDS = ('url', 'body', 'encoding', 'etag', 'last_modified', 'fetched_at', 'expires_at', 'content_hash')
+
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, url):
+        values = self.client.hmget(self.prefix + url, self.FIELDS)
+        if values[1] is None:
+            return None
+        url, body, encoding, etag, last_modified, fetched_at, expires_at, digest = (
+            value.decode() if value and i != 1 else value for i, value in enumerate(values))
+        return CachedPage(url, body, encoding or None, etag or None, last_modified or None,
+                          float(fetched_at), float(expires_at), digest)
+
+    def put(self, page):
+        key = self.prefix + page.url
+        pipe = self.client.pipeline()
+        pipe.hset(key, mapping={
+            'url': page.url, 'body': page.body, 'encoding': page.encoding or '',
+            'etag': page.etag or '', 'last_modified': page.last_modified or '',
+            'fetched_at': page.fetched_at, 'expires_at': page.expires_at,
+            'content_hash': page.content_hash,
+        })
+        pipe.expireat(key, int(page.expires_at + STALE_RETENTION))
+        pipe.execute()
+
+
+class PageCache:
+    """Fetch-through cache in front of the fetch engine"""
+
+    def __init__(self, max_bytes=PAGE_CACHE_BYTES, disk_path=DISK_CACHE_PATH, default_ttl=DEFAULT_TTL):
+        self.default_ttl = default_ttl
+        self.memory = LRUCache(max_bytes)
+        # A local disk tier wins over the shared one of a multi-node deployment
+        self.disk = DiskCache(disk_path) if disk_path else state.get_backend().page_store()
+
+    def lookup(self, url):
+        """Return the cached page for url, fresh or stale, or None"""
+        page = self.memory.get(url)
+        if page is None and self.disk is not None:
+            page = self.disk.get(url)
+            if page is not None:
+                self.memory.put(url, page, page.size)
+        return page
+
+    def peek_fresh(self, url, ttl=None):
+        """True if url would be answered from cache without a fetch"""
+        ttl = self.default_ttl if ttl is None else max(0, min(int(ttl), MAX_TTL))
+        page = self.lookup(url)
+        now = time.time()
+        return page is not None and page.is_fresh(now) and now - page.fetched_at < ttl
+
+    def store(self, page):
+        self.memory.put(page.url, page, page.size)
+        if self.disk is not None:
+            self.disk.put(page)
+
+    def submit(self, url, ttl=None, timeout=fetcher.DEFAULT_TIMEOUT, validators=None,
+               max_bytes=None, max_seconds=None):
+        """Return a Future of (CachedPage, status) where status is hit, revalidated or miss
+
+        ttl is the client's freshness bound for this call: a cached page
+        older than ttl seconds is revalidated even if it has not expired.
+        validators is an (etag, last_modified) pair the caller already holds
+        a result for; it is used when nothing is cached here, and a 304
+        then resolves to (None, 'not_modified'). max_bytes and max_seconds
+        cap the download (see FetchEngine.submit).
+        """
+        result = Future()
+        if self.peek_fresh(url, ttl):
+            result.set_result((self.lookup(url), 'hit'))
+            return result
+
+        ttl = self.default_ttl if ttl is None else max(0, min(int(ttl), MAX_TTL))
+        cached = self.lookup(url)
+
+        if cached is not None:
+            headers = cached.conditional_headers()
+        elif validators is not None:
+            headers = conditional_headers(*validators) or None
+        else:
+            headers = None
+        upstream = fetcher.get_engine().submit(url, headers=headers, timeout=timeout,
+                                               max_bytes=max_bytes, max_seconds=max_seconds)
+
+        def done(future):
+            try:
+                response = future.result()
+                if response.status_code == 304 and cached is not None:
+                    now = time.time()
+                    page = CachedPage(url, cached.body, cached.encoding,
+                                      response.headers.get('ETag', cached.etag),
+                                      response.headers.get('Last-Modified', cached.last_modified),
+                                      now, now + ttl, cached.content_hash)
+                    status = 'revalidated'
+                elif response.status_code == 304 and headers:
+                    result.set_result((None, 'not_modified'))
+                    return
+                else:
+                    page = CachedPage.from_response(url, response, ttl)
+                    status = 'miss'
+                no_store = 'no-store' in response.headers.get('Cache-Control', '')
+                if response.status_code in (200, 304) and ttl and not no_store:
+                    self.store(page)
+            except BaseException as e:
+                result.set_exception(e)
+            else:
+                result.set_result((page, status))
+
+        upstream.add_done_callback(done)
+        return result
+
+    def fetch(self, url, ttl=None, timeout=fetcher.DEFAULT_TIMEOUT, validators=None,
+              max_bytes=None, max_seconds=None):
+        return self.submit(url, ttl, timeout, validators, max_bytes, max_seconds).result()
+
+
+class ExtractionCache:
+    """Extraction results keyed by (content hash, selectors)"""
+
+    def __init__(self, max_bytes=EXTRACTION_CACHE_BYTES):
+        self.memory = LRUCache(max_bytes)
+
+    def get(self, digest, selectors):
+        return self.memory.get((digest, selectors_key(selectors)))
+
+    def put(self, digest, selectors, results):
+        key = (digest, selectors_key(selectors))
+        self.memory.put(key, results, len(json.dumps(results)) + len(key[1]))
+
+
+_caches = None
+_caches_lock = threading.Lock()
+
+
+def get_caches():
+    """Return this process's (PageCache, ExtractionCache)"""
+    global _caches
+    if _caches is None:
+        with _caches_lock:
+            if _caches is None:
+                _caches = (PageCache(), ExtractionCache())
+    return _caches
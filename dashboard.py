@@ -0,0 +1,84 @@
+"""
+Revenue metrics snapshot for DataScrape Pro
+Dashboard metrics computed in the background and served from memory
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import state
+from background import PeriodicWorker
+
+# How often the refresher recomputes the metrics
+REFRESH_INTERVAL = float(os.environ.get('DATASCRAPE_METRICS_REFRESH', 15))
+# Oldest snapshot a reader will accept before recomputing inline
+MAX_STALENESS = float(os.environ.get('DATASCRAPE_METRICS_MAX_STALENESS', 60))
+
+
+def compute_metrics(tiers):
+    """Run the dashboard aggregates; every query is index-, rollup- or counter-backed"""
+    user_tiers, monthly_revenue, daily_api_calls = state.get_backend().dashboard_totals()
+    total_users = sum(user_tiers.values())
+
+    # Calculate projected MRR
+    projected_mrr = sum(tiers[tier]['price'] * count for tier, count in user_tiers.items()
+                        if tier != 'free' and tier in tiers)
+
+    return {
+        'total_users': total_users,
+        'user_tiers': user_tiers,
+        'monthly_revenue': monthly_revenue,
+        'daily_api_calls': daily_api_calls,
+        'projected_mrr': projected_mrr,
+    }
+
+
+class Snapshot:
+    __slots__ = ('metrics', 'etag', 'computed_at', 'generated_at')
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.etag = hashlib.sha1(json.dumps(metrics, sort_keys=True).encode()).hexdigest()
+        self.computed_at = time.monotonic()
+        self.generated_at = datetime.now(timezone.utc).isoformat()
+
+    @property
+    def age(self):
+        return time.monotonic() - self.computed_at
+
+
+class MetricsCache:
+    """Holds the latest metrics snapshot and keeps it fresh in the background
+
+    The refresher only starts in a process that actually serves the
+    dashboard, so workers that only scrape never run the aggregates.
+    """
+
+    def __init__(self, tiers, refresh_interval=REFRESH_INTERVAL, max_staleness=MAX_STALENESS):
+        self.tiers = tiers
+        self.max_staleness = max_staleness
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self.refresher = PeriodicWorker('metrics-refresh', refresh_interval, self.refresh,
+                                        drain_on_exit=False)
+
+    def refresh(self):
+        snapshot = Snapshot(compute_metrics(self.tiers))
+        self._snapshot = snapshot
+        return snapshot
+
+    def get(self, max_staleness=None):
+        """Return a snapshot no older than max_staleness seconds"""
+        self.refresher.ensure_started()
+        bound = self.max_staleness if max_staleness is None else max_staleness
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.age > bound:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot.age > bound:
+                    snapshot = self.refresh()
+        return snapshot
@@ -0,0 +1,222 @@
+"""
+Shared SQLite data layer for DataScrape Pro
+Per-worker connection pooling, WAL journaling and reusable prepared statements
+"""
+
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DATABASE_PATH = os.environ.get('DATASCRAPE_DB', 'datascrape.db')
+
+# Pragmas applied to every pooled connection. WAL lets readers run alongside
+# the single writer, so the dashboard never blocks the scrape path and the
+# gunicorn workers stop tripping over each other's rollback journals.
+# synchronous=NORMAL is durable across application crashes in WAL mode and
+# only fsyncs at checkpoints instead of on every commit.
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', 5000),
+    ('cache_size', -16000),
+    ('temp_store', 'MEMORY'),
+    ('mmap_size', 64 * 1024 * 1024),
+)
+
+POOL_SIZE = int(os.environ.get('DATASCRAPE_DB_POOL_SIZE', 8))
+
+# sqlite3 keeps a per-connection LRU of compiled statements keyed by SQL text.
+# Because connections are pooled and all queries below are constant strings,
+# each statement is prepared once per connection and reused across requests.
+STATEMENT_CACHE_SIZE = 128
+
+# When set, every process writes its lock statistics to
+# <dir>/dbstats-<pid>.json at exit (used by benchmark.py)
+STATS_DIR = os.environ.get('DATASCRAPE_DB_STATS_DIR')
+
+
+class LockStats:
+    """Time this process spent waiting for and holding the SQLite write lock"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.transactions = 0
+            self.wait_s = 0.0
+            self.max_wait_s = 0.0
+            self.held_s = 0.0
+
+    def record(self, wait, held):
+        with self._lock:
+            self.transactions += 1
+            self.wait_s += wait
+            self.held_s += held
+            if wait > self.max_wait_s:
+                self.max_wait_s = wait
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'transactions': self.transactions,
+                'lock_wait_s': self.wait_s,
+                'lock_wait_max_ms': self.max_wait_s * 1000,
+                'lock_held_s': self.held_s,
+            }
+
+
+class ConnectionPool:
+    """Pool of SQLite connections owned by a single process"""
+
+    def __init__(self, path, size=POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self.lock_stats = LockStats()
+        # Connections inherited across fork() must never be used or closed by
+        # the child (closing can checkpoint and remove the parent's WAL), so
+        # they are parked here for the lifetime of the process.
+        self._inherited = []
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None,
+                               check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        for name, value in PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    while True:
+                        try:
+                            self._inherited.append(self._idle.get_nowait())
+                        except queue.Empty:
+                            break
+                    self._idle = queue.LifoQueue()
+                    self._created = 0
+                    self.lock_stats = LockStats()
+                    self._pid = os.getpid()
+
+    def acquire(self):
+        self._check_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            self._inherited.append(conn)
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self):
+        """Close idle connections, e.g. in the master before workers fork"""
+        with self._lock:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                conn.close()
+                self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection in autocommit mode"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Borrow a connection inside a single write transaction
+
+        BEGIN IMMEDIATE takes the write lock up front, so a transaction that
+        reads and then updates cannot deadlock against another worker.
+        """
+        with self.connection() as conn:
+            requested = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            acquired = time.perf_counter()
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+            finally:
+                self.lock_stats.record(acquired - requested, time.perf_counter() - acquired)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide pool for DATABASE_PATH"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DATABASE_PATH)
+    return _pool
+
+
+def connection():
+    """Borrow a pooled connection in autocommit mode"""
+    return get_pool().connection()
+
+
+def transaction():
+    """Borrow a pooled connection inside one write transaction"""
+    return get_pool().transaction()
+
+
+def lock_stats():
+    """Write-lock statistics of this process"""
+    return get_pool().lock_stats.snapshot()
+
+
+def _dump_stats():
+    if _pool is None or _pool._pid != os.getpid():
+        return
+    path = os.path.join(STATS_DIR, f'dbstats-{os.getpid()}.json')
+    with open(path, 'w') as f:
+        json.dump(lock_stats(), f)
+
+
+if STATS_DIR:
+    atexit.register(_dump_stats)
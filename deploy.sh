@@ -7,18 +7,26 @@ echo "🚀 Deploying DataScrape Pro - Revenue Generation Service"
 echo "📦 Installing dependencies..."
 pip install -r requirements.txt
 
-# Initialize database
-echo "🗄️ Initializing database..."
-python3 -c "from app import init_db; init_db()"
-
 # Start the service
 echo "🌐 Starting DataScrape Pro service..."
 echo "💰 Revenue target: $3,000 MRR in 6 months"
 echo "🎯 Break-even target: $500 MRR in 3 months"
 
-# In production, use gunicorn
+# In production, use gunicorn (settings in gunicorn.conf.py): its master
+# migrates the schema once and preloads the app for its threaded workers.
+# Without gunicorn, app.py initializes the database itself.
 if [ "$ENVIRONMENT" = "production" ]; then
-    gunicorn -w 4 -b 0.0.0.0:5000 app:app
+    # Workers share their request metrics through this directory
+    export DATASCRAPE_METRICS_DIR="${DATASCRAPE_METRICS_DIR:-/tmp/datascrape-metrics}"
+    rm -rf "$DATASCRAPE_METRICS_DIR"
+    # With a shared DATASCRAPE_STATE=redis://..., exactly one node copies
+    # users, revenue and usage into its SQLite for analytics, exports and jobs
+    if [ -n "$DATASCRAPE_STATE" ] && [ "$DATASCRAPE_STATE" != "sqlite" ] && [ "$DATASCRAPE_DRAIN" = "1" ]; then
+        python3 state.py drain --follow &
+    fi
+    # Scheduled jobs run in their own worker pool
+    python3 jobs.py worker --processes 2 &
+    gunicorn -c gunicorn.conf.py
 else
     python3 app.py
 fi
\ No newline at end of file
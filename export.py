@@ -0,0 +1,210 @@
+"""
+Streaming export for DataScrape Pro
+Keyset-paged queries encoded as CSV, JSONL or Parquet chunks with resumable cursors
+"""
+
+import base64
+import csv
+import io
+import json
+from datetime import datetime, timezone
+
+import db
+
+# Rows fetched per query; memory use is bounded by one page
+PAGE_SIZE = 2000
+
+DATASETS = {
+    'results': {
+        'table': 'scrape_results',
+        'columns': ('id', 'created_at', 'job_id', 'url', 'data'),
+        'time': 'created_at',
+        'filters': ('url', 'job'),
+    },
+    'usage': {
+        'table': 'api_usage',
+        'columns': ('id', 'timestamp', 'endpoint', 'response_size'),
+        'time': 'timestamp',
+        'filters': (),
+    },
+}
+
+FORMATS = {
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+class ExportError(ValueError):
+    """Invalid export parameters, reported to the client as a 400"""
+
+
+def encode_cursor(dataset, row_id):
+    raw = json.dumps([dataset, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, dataset):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        cursor_dataset, row_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ExportError('Invalid cursor')
+    if cursor_dataset != dataset or not isinstance(row_id, int):
+        raise ExportError('Cursor belongs to a different export')
+    return row_id
+
+
+def parse_time(value, name):
+    """ISO 8601 date or datetime -> SQLite CURRENT_TIMESTAMP format in UTC"""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ExportError(f'{name} must be an ISO 8601 date or datetime')
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class ExportQuery:
+    """Filters for one user's export, paged by primary key"""
+
+    def __init__(self, user_id, dataset='results', since=None, until=None,
+                 url=None, job=None, cursor=None):
+        if dataset not in DATASETS:
+            raise ExportError(f'dataset must be one of {", ".join(DATASETS)}')
+        spec = DATASETS[dataset]
+        if url and 'url' not in spec['filters'] or job and 'job' not in spec['filters']:
+            raise ExportError('url and job filters only apply to the results dataset')
+        self.dataset = dataset
+        self.spec = spec
+        self.columns = spec['columns']
+        self.after_id = decode_cursor(cursor, dataset) if cursor else 0
+
+        where = ['user_id = ?', 'id > ?']
+        self.params = [user_id]
+        if since:
+            where.append(f'{spec["time"]} >= ?')
+            self.params.append(parse_time(since, 'since'))
+        if until:
+            where.append(f'{spec["time"]} < ?')
+            self.params.append(parse_time(until, 'until'))
+        if url:
+            # Shell-style pattern, e.g. https://example.com/products/*
+            where.append('url GLOB ?')
+            self.params.append(url)
+        if job:
+            where.append('job_id = ?')
+            self.params.append(job)
+        self.sql = (f'SELECT {", ".join(self.columns)} FROM {spec["table"]} '
+                    f'WHERE {" AND ".join(where)} ORDER BY id LIMIT {PAGE_SIZE}')
+
+    def pages(self):
+        """Yield lists of rows, one short read transaction per page
+
+        Keyset paging (id > last seen) keeps memory constant and, unlike one
+        long-lived cursor, never pins an old WAL snapshot for the length of
+        a multi-million-row download.
+        """
+        after_id = self.after_id
+        while True:
+            with db.connection() as conn:
+                params = self.params[:1] + [after_id] + self.params[1:]
+                rows = conn.execute(self.sql, params).fetchall()
+            if not rows:
+                return
+            yield rows
+            if len(rows) < PAGE_SIZE:
+                return
+            after_id = rows[-1][0]
+
+
+def _jsonl(query):
+    columns = query.columns
+    has_data = 'data' in columns
+    for rows in query.pages():
+        lines = []
+        for row in rows:
+            record = dict(zip(columns, row))
+            record['cursor'] = encode_cursor(query.dataset, row[0])
+            if has_data:
+                # data is already JSON text; splice it in instead of re-parsing
+                data = record.pop('data') or 'null'
+                lines.append(json.dumps(record)[:-1] + ', "data": ' + data + '}\n')
+            else:
+                lines.append(json.dumps(record) + '\n')
+        yield ''.join(lines).encode()
+
+
+def _csv(query):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(query.columns + ('cursor',))
+    for rows in query.pages():
+        for row in rows:
+            writer.writerow(row + (encode_cursor(query.dataset, row[0]),))
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _DrainSink(io.RawIOBase):
+    """Write-only file whose contents are handed out as they are produced"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _parquet(query):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {'id': pa.int64(), 'response_size': pa.int64()}
+    schema = pa.schema([(name, types.get(name, pa.string())) for name in query.columns + ('cursor',)])
+    sink = _DrainSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    try:
+        for rows in query.pages():
+            # One row group per page
+            columns = list(zip(*rows))
+            arrays = {name: list(values) for name, values in zip(query.columns, columns)}
+            arrays['cursor'] = [encode_cursor(query.dataset, row_id) for row_id in arrays['id']]
+            writer.write_table(pa.table(arrays, schema=schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def parquet_available():
+    try:
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def stream(fmt, query):
+    """Return a generator of encoded byte chunks"""
+    return {'jsonl': _jsonl, 'csv': _csv, 'parquet': _parquet}[fmt](query)
@@ -0,0 +1,480 @@
+"""
+Extraction backends for DataScrape Pro
+Compiled CSS selector plans for lxml, selectolax or html.parser, and JSONPath over structured data
+"""
+
+import functools
+import json
+import os
+import re
+from collections import deque
+from html.parser import HTMLParser
+from importlib.util import find_spec
+
+import instrumentation
+import structured
+
+# lxml/cssselect and selectolax are optional accelerators. Like bs4 they
+# are imported on first use, so importing the app does not load them.
+HAS_LXML = find_spec('lxml') is not None and find_spec('cssselect') is not None
+HAS_SELECTOLAX = find_spec('selectolax') is not None
+
+# Preferred backend: auto, lxml, selectolax or html.parser
+PARSER = os.environ.get('DATASCRAPE_PARSER', 'auto')
+
+HEADING_TAGS = ('h1', 'h2', 'h3')
+# Their text is not page text: BeautifulSoup's get_text() leaves it out
+NON_TEXT_TAGS = ('script', 'style', 'template')
+
+# Selectors that look at following siblings, position or descendants of the
+# matched element cannot be decided while the document is still arriving
+STREAM_UNSAFE = re.compile(r'[+~]|:(nth-|first-|last-|only-|empty|has|root)')
+
+
+def _join_text(strings):
+    """Match BeautifulSoup's get_text(strip=True)"""
+    return ''.join(s.strip() for s in strings)
+
+
+@functools.lru_cache(maxsize=None)
+def _visible_text():
+    import lxml.etree
+    return lxml.etree.XPath(
+        './/text()[not(ancestor::script or ancestor::style or ancestor::template)]', smart_strings=False)
+
+
+def _element_text(element):
+    """Text of an lxml element as BeautifulSoup's get_text(strip=True) gives it"""
+    if element.tag in NON_TEXT_TAGS:
+        # A script, style or template selected directly yields its own text
+        return _join_text(element.itertext())
+    return _join_text(_visible_text()(element))
+
+
+class SoupBackend:
+    """Pure-Python fallback: html.parser tree with precompiled soupsieve patterns"""
+
+    name = 'html.parser'
+
+    def compile(self, selector):
+        import soupsieve
+        return soupsieve.compile(selector)
+
+    def parse(self, html):
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(html, 'html.parser')
+
+    def select(self, soup, compiled):
+        # A single walk calling pattern.match() per element measured slower
+        # than one compiled select() per selector, since soupsieve builds a
+        # matcher on every match() call.
+        return {key: [el.get_text(strip=True) for el in pattern.select(soup)]
+                for key, pattern in compiled}
+
+
+class LxmlBackend:
+    """libxml2 parser with selectors translated to precompiled XPath"""
+
+    name = 'lxml'
+
+    def __init__(self):
+        from cssselect import HTMLTranslator
+        self._translator = HTMLTranslator()
+
+    def compile(self, selector):
+        import lxml.etree
+        from cssselect import SelectorError
+        try:
+            return lxml.etree.XPath(self._translator.css_to_xpath(selector))
+        except SelectorError as e:
+            raise ValueError(f'Unsupported selector {selector!r}: {e}')
+
+    def parse(self, html):
+        import lxml.html
+        if not html.strip():
+            return None
+        try:
+            return lxml.html.document_fromstring(html)
+        except lxml.etree.ParserError:
+            # Only comments or whitespace, nothing to select from
+            return None
+        except ValueError:
+            # Unicode input with an XML encoding declaration
+            return lxml.html.document_fromstring(html.encode('utf-8'),
+                                                 parser=lxml.html.HTMLParser(encoding='utf-8'))
+
+    def select(self, doc, compiled):
+        if doc is None:
+            return {key: [] for key, _ in compiled}
+        return {key: [_element_text(el) for el in xpath(doc)] for key, xpath in compiled}
+
+    def metadata(self, html):
+        doc = self.parse(html)
+        if doc is None:
+            return {'title': None, 'description': None, 'headings': []}
+        title = doc.find('.//title')
+        description = doc.xpath('//meta[@name="description"]/@content')
+        headings = doc.xpath('//h1 | //h2 | //h3')
+        return {
+            'title': title.text if title is not None and len(title) == 0 else None,
+            'description': description[0] if description else None,
+            'headings': [_element_text(h) for h in headings],
+        }
+
+
+class SelectolaxBackend:
+    """Modest/lexbor C parser with native CSS matching"""
+
+    name = 'selectolax'
+
+    def compile(self, selector):
+        return selector
+
+    def parse(self, html):
+        from selectolax.parser import HTMLParser as SelectolaxParser
+        return SelectolaxParser(html)
+
+    def select(self, tree, compiled):
+        return {key: [node.text(strip=True) for node in tree.css(selector)]
+                for key, selector in compiled}
+
+    def metadata(self, html):
+        tree = self.parse(html)
+        title = tree.css_first('title')
+        meta = tree.css_first('meta[name="description"]')
+        return {
+            'title': title.text() if title is not None and title.child is not None else None,
+            'description': meta.attributes.get('content') if meta is not None else None,
+            'headings': [h.text(strip=True) for h in tree.css('h1, h2, h3')],
+        }
+
+
+class MetadataParser(HTMLParser):
+    """Streaming title/description/headings extraction without building a tree"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = None
+        self.description = None
+        self.headings = []
+        self._in_title = False
+        self._title_parts = None
+        self._heading_depth = 0
+        self._heading_parts = None
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'title' and self._title_parts is None:
+            self._in_title = True
+            self._title_parts = []
+        elif tag == 'meta' and self.description is None:
+            attrs = dict(attrs)
+            if attrs.get('name') == 'description':
+                self.description = attrs.get('content')
+        elif tag in NON_TEXT_TAGS:
+            self._skip_depth += 1
+        elif tag in HEADING_TAGS:
+            if self._heading_depth == 0:
+                self._heading_parts = []
+            self._heading_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self._in_title:
+            self._in_title = False
+            self.title = ''.join(self._title_parts) or None
+        elif tag in NON_TEXT_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+        elif tag in HEADING_TAGS and self._heading_depth:
+            self._heading_depth -= 1
+            if self._heading_depth == 0:
+                self.headings.append(_join_text(self._heading_parts))
+
+    def handle_data(self, data):
+        if self._in_title:
+            self._title_parts.append(data)
+        if self._heading_depth and not self._skip_depth:
+            self._heading_parts.append(data)
+
+    def results(self):
+        return {'title': self.title, 'description': self.description, 'headings': self.headings}
+
+
+def _available_backends():
+    backends = {'html.parser': SoupBackend}
+    if HAS_LXML:
+        backends['lxml'] = LxmlBackend
+    if HAS_SELECTOLAX:
+        backends['selectolax'] = SelectolaxBackend
+    return backends
+
+
+@functools.lru_cache(maxsize=None)
+def get_backend(name=None):
+    """Return the named backend, or the fastest installed one for auto"""
+    name = name or PARSER
+    backends = _available_backends()
+    if name == 'auto':
+        name = next(n for n in ('lxml', 'selectolax', 'html.parser') if n in backends)
+    if name not in backends:
+        raise ValueError(f'Parser backend {name!r} is not installed')
+    return backends[name]()
+
+
+def preload():
+    """Import the backend get_backend() picks now, e.g. in a master before it forks workers"""
+    get_backend().parse('<html></html>')
+
+
+class SelectorPlan:
+    """A selector set compiled once for one backend"""
+
+    def __init__(self, selectors, backend=None):
+        self.backend = backend or get_backend()
+        try:
+            self.compiled = [(key, self.backend.compile(sel)) for key, sel in selectors.items()]
+        except ValueError:
+            # Selectors the fast backend cannot express fall back to soupsieve
+            if isinstance(self.backend, SoupBackend):
+                raise
+            self.backend = get_backend('html.parser')
+            self.compiled = [(key, self.backend.compile(sel)) for key, sel in selectors.items()]
+
+    def parse(self, html):
+        return self.backend.parse(html)
+
+    def select(self, doc):
+        return self.backend.select(doc, self.compiled)
+
+    def evaluate(self, html):
+        with instrumentation.span('parse'):
+            doc = self.parse(html)
+        with instrumentation.span('select'):
+            return self.select(doc)
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_plan(selectors_json):
+    return SelectorPlan(json.loads(selectors_json))
+
+
+def compile_plan(selectors):
+    """Return the cached compiled plan for a selector set"""
+    return _compile_plan(json.dumps(selectors, sort_keys=True))
+
+
+def extract_metadata(html):
+    """Default extraction - title, meta description and h1-h3 headings"""
+    with instrumentation.span('metadata'):
+        return _metadata(html)
+
+
+def _metadata(html):
+    backend = get_backend()
+    if hasattr(backend, 'metadata'):
+        return backend.metadata(html)
+    parser = MetadataParser()
+    parser.feed(html)
+    parser.close()
+    return parser.results()
+
+
+def split_selectors(selectors):
+    """(CSS selectors, JSONPath selectors) of a selector set"""
+    css, paths = {}, {}
+    for key, selector in selectors.items():
+        (paths if structured.is_path(selector) else css)[key] = selector
+    return css, paths
+
+
+def extract(html, selectors):
+    """Extract selector results, or title/description/headings by default
+
+    Selectors starting with $ are JSONPath over the page's structured data;
+    when every selector is one, no DOM is built at all.
+    """
+    if not selectors:
+        return extract_metadata(html)
+    css, paths = split_selectors(selectors)
+    if not paths:
+        return compile_plan(selectors).evaluate(html)
+    results = structured.query(html, paths)
+    if css:
+        results.update(compile_plan(css).evaluate(html))
+    return {key: results[key] for key in selectors}
+
+
+def apply_limits(results, limits):
+    """Cut each selector's matches to its limit"""
+    if not limits:
+        return results
+    return {key: values[:limits[key]] if key in limits and isinstance(values, list) else values
+            for key, values in results.items()}
+
+
+class StreamingExtractor:
+    """Evaluates selectors on lxml's partial tree while the document arrives
+
+    After each chunk the compiled XPaths run against what has been parsed
+    so far; matches whose end tag has been seen are recorded and every
+    finished subtree is dropped, unless an element still open needs it for
+    its own text. Memory therefore follows the depth of the document, not
+    its size, and feed() reports when every selector reached its limit.
+    """
+
+    def __init__(self, selectors, limits=None):
+        import lxml.etree
+        from cssselect import HTMLTranslator
+        translator = HTMLTranslator()
+        self.compiled = [(key, lxml.etree.XPath(translator.css_to_xpath(selector)))
+                         for key, selector in selectors.items()]
+        self.limits = limits or {}
+        self.results = {key: [] for key in selectors}
+        self.done = False
+        self._parser = lxml.etree.HTMLPullParser(events=('end',))
+        self._root = None
+        self._last_closed = None
+        self._open = []
+        # Recorded matches still attached below an open matched element
+        self._seen = set()
+
+    def feed(self, text):
+        """Parse one chunk of text; True once nothing more is needed"""
+        if not self.done:
+            self._parser.feed(text)
+            self._evaluate()
+        return self.done
+
+    def close(self):
+        import lxml.etree
+        if not self.done:
+            try:
+                self._parser.close()
+            except lxml.etree.XMLSyntaxError:
+                # Nothing parseable arrived
+                pass
+            self._evaluate()
+        return self.results
+
+    def _open_path(self):
+        """Elements whose end tag has not arrived yet, from the root down
+
+        They are the last-child chain from the root, up to the element
+        closed most recently: anything finished later than it would have
+        been closed after it.
+        """
+        path = []
+        element = self._root
+        while element is not self._last_closed:
+            path.append(element)
+            if not len(element):
+                break
+            element = element[-1]
+            if not isinstance(element.tag, str):
+                # Comments and processing instructions have no end event
+                break
+        return path
+
+    def _evaluate(self):
+        # Only the most recent end event matters; draining them in C keeps
+        # per-element work out of Python
+        last = deque(self._parser.read_events(), maxlen=1)
+        if last:
+            self._last_closed = last[0][1]
+            if self._root is None:
+                self._root = self._last_closed.getroottree().getroot()
+        if self._root is None:
+            return
+        self._open = self._open_path()
+
+        open_elements = set(self._open)
+        # Depth of the shallowest open element a selector matched: its
+        # subtree must be kept until its end tag arrives
+        keep = len(self._open)
+        for key, xpath in self.compiled:
+            found = self.results[key]
+            limit = self.limits.get(key)
+            for element in xpath(self._root):
+                if element in open_elements:
+                    keep = min(keep, self._open.index(element))
+                elif element not in self._seen:
+                    self._seen.add(element)
+                    if limit is None or len(found) < limit:
+                        found.append(_element_text(element))
+        self.done = bool(self.limits) and all(
+            key in self.limits and len(found) >= self.limits[key] for key, found in self.results.items())
+
+        # Drop finished subtrees above the kept element. The last child of the
+        # innermost open element stays: libxml2 may still append its tail text.
+        pruned = False
+        for depth in range(keep):
+            parent = self._open[depth]
+            if depth + 1 < len(self._open):
+                current, children = self._open[depth + 1], list(parent)
+            else:
+                current, children = None, list(parent)[:-1]
+            for child in children:
+                if child is current:
+                    break
+                parent.remove(child)
+                pruned = True
+        if pruned and self._seen:
+            self._seen = {element for element in self._seen if self._attached(element)}
+
+    def _attached(self, element):
+        top = element
+        for top in element.iterancestors():
+            pass
+        return top is self._root
+
+
+class StreamingMetadata:
+    """Default extraction fed chunk by chunk through MetadataParser"""
+
+    done = False
+
+    def __init__(self):
+        self._parser = MetadataParser()
+
+    def feed(self, text):
+        self._parser.feed(text)
+        return False
+
+    def close(self):
+        self._parser.close()
+        return self._parser.results()
+
+
+class BufferedExtractor:
+    """Fallback for selectors that need the whole document; the fetch caps bound its size"""
+
+    done = False
+
+    def __init__(self, selectors, limits=None):
+        self.selectors = selectors
+        self.limits = limits
+        self._chunks = []
+
+    def feed(self, text):
+        self._chunks.append(text)
+        return False
+
+    def close(self):
+        html = ''.join(self._chunks)
+        self._chunks = []
+        return apply_limits(extract(html, self.selectors), self.limits)
+
+
+def streaming_extractor(selectors, limits=None):
+    """An extractor with feed(text) -> done and close() -> results for selectors"""
+    if not selectors:
+        return StreamingMetadata()
+    # Structured data can sit anywhere in the page, so JSONPath selectors read all of it
+    if HAS_LXML and not any(STREAM_UNSAFE.search(selector) or structured.is_path(selector)
+                                    for selector in selectors.values()):
+        from cssselect import SelectorError
+        try:
+            return StreamingExtractor(selectors, limits)
+        except SelectorError:
+            # Left to soupsieve, as in SelectorPlan
+            pass
+    return BufferedExtractor(selectors, limits)
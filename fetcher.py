@@ -0,0 +1,451 @@
+"""
+Concurrent fetch engine for DataScrape Pro
+Bounded thread pool with shared keep-alive connection pools and health-adaptive per-host limits
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NameResolutionError, NewConnectionError
+from urllib3.exceptions import HTTPError as UrllibError
+
+import hosts
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'DataScrape Pro Bot 1.0'
+DEFAULT_TIMEOUT = 10
+
+# Global cap on fetches running at once in this worker process
+MAX_IN_FLIGHT = int(os.environ.get('DATASCRAPE_FETCH_WORKERS', 256))
+# Cap per target host, so one popular site cannot take every slot; the
+# limit of a failing host adapts below this
+MAX_PER_HOST = int(os.environ.get('DATASCRAPE_FETCH_PER_HOST', 8))
+# Number of distinct hosts whose keep-alive pools are retained
+HOST_POOLS = int(os.environ.get('DATASCRAPE_FETCH_HOST_POOLS', 128))
+# Default caps on one response body, for callers without a tier of their own
+MAX_BODY_BYTES = int(os.environ.get('DATASCRAPE_FETCH_MAX_BYTES', 50 * 1024 * 1024))
+MAX_FETCH_SECONDS = float(os.environ.get('DATASCRAPE_FETCH_MAX_SECONDS', 60))
+# Bytes read from the socket at a time
+CHUNK_SIZE = 64 * 1024
+
+# Addresses of target hosts, shared by every engine in the process
+dns_cache = hosts.DNSCache()
+
+# Failures of the target site rather than of the request; callers do not charge for them
+UPSTREAM_ERRORS = (requests.RequestException, hosts.HostUnavailable, hosts.RobotsDisallowed)
+
+
+class FetchLimitExceeded(Exception):
+    """A body grew past its byte cap or kept streaming past its time cap"""
+
+    def __init__(self, url, reason, limit):
+        self.url = url
+        self.reason = reason
+        self.limit = limit
+        unit = 'bytes' if reason == 'size' else 'seconds'
+        super().__init__(f'{url} exceeded the {limit} {unit} {reason} limit')
+
+
+# Fetches ending in any of these scraped nothing, so they are refunded
+UNBILLED_ERRORS = UPSTREAM_ERRORS + (FetchLimitExceeded,)
+
+
+def iter_chunks(response):
+    """Body chunks of a streamed response as soon as they arrive
+
+    read1() returns whatever the socket has, so the time cap is checked
+    even while a server trickles a few bytes at a time.
+    """
+    raw = response.raw
+    if not hasattr(raw, 'read1'):
+        yield from response.iter_content(CHUNK_SIZE)
+        return
+    try:
+        while True:
+            chunk = raw.read1(CHUNK_SIZE, decode_content=True)
+            if not chunk:
+                return
+            yield chunk
+    except UrllibError as e:
+        raise requests.ConnectionError(e)
+
+
+def read_body(response, max_bytes=MAX_BODY_BYTES, max_seconds=MAX_FETCH_SECONDS, started=None):
+    """Read a streamed response's body, raising FetchLimitExceeded past either cap"""
+    declared = response.headers.get('Content-Length')
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise FetchLimitExceeded(response.url, 'size', max_bytes)
+    deadline = (started or time.monotonic()) + max_seconds
+    chunks, size = [], 0
+    for chunk in iter_chunks(response):
+        size += len(chunk)
+        if size > max_bytes:
+            raise FetchLimitExceeded(response.url, 'size', max_bytes)
+        if time.monotonic() > deadline:
+            raise FetchLimitExceeded(response.url, 'time', max_seconds)
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def stream_body(response, consumer, max_bytes=MAX_BODY_BYTES, max_seconds=MAX_FETCH_SECONDS, started=None):
+    """Hand a streamed response's body to consumer.feed() chunk by chunk
+
+    Nothing is kept here. Reading stops when feed() returns True or a cap
+    is reached; returns (bytes read, truncated by a cap).
+    """
+    deadline = (started or time.monotonic()) + max_seconds
+    size = 0
+    for chunk in iter_chunks(response):
+        if size + len(chunk) > max_bytes:
+            consumer.feed(chunk[:max_bytes - size])
+            return max_bytes, True
+        size += len(chunk)
+        if consumer.feed(chunk):
+            return size, False
+        if time.monotonic() > deadline:
+            return size, True
+    return size, False
+
+
+class _CachedDNSConnection(HTTPConnection):
+    """Connects to the address in the shared DNS cache instead of resolving every time"""
+
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            self._dns_host = dns_cache.resolve(host, self.port)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        try:
+            return super()._new_conn()
+        except (NewConnectionError, ConnectTimeoutError):
+            # The address may have moved; look it up again next time
+            dns_cache.forget(host, self.port)
+            raise
+        finally:
+            self._dns_host = host
+
+
+class _CachedDNSHTTPSConnection(_CachedDNSConnection, HTTPSConnection):
+    pass
+
+
+class _HTTPPool(HTTPConnectionPool):
+    ConnectionCls = _CachedDNSConnection
+
+
+class _HTTPSPool(HTTPSConnectionPool):
+    ConnectionCls = _CachedDNSHTTPSConnection
+
+
+class _Adapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _HTTPPool, 'https': _HTTPSPool}
+
+
+class _Timers:
+    """Calls functions at monotonic times from one thread, so waiting jobs hold no pool thread"""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_at(self, when, fn, *args):
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._counter), fn, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='fetch-timers', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        _, _, fn, args = heapq.heappop(self._heap)
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception('fetch timer failed')
+
+
+class _Job:
+    __slots__ = ('future', 'url', 'headers', 'timeout', 'max_bytes', 'max_seconds', 'consumer',
+                 'attempts', 'deadline')
+
+    def __init__(self, url, headers, timeout, max_bytes, max_seconds, consumer):
+        self.future = Future()
+        self.url = url
+        self.headers = headers
+        self.timeout = timeout
+        self.max_bytes = max_bytes or MAX_BODY_BYTES
+        self.max_seconds = max_seconds or MAX_FETCH_SECONDS
+        self.consumer = consumer
+        self.attempts = 0
+        # Retries must start before this monotonic time
+        self.deadline = time.monotonic() + hosts.RETRY_BUDGET
+
+
+class _HostState:
+    __slots__ = ('active', 'pending', 'waking')
+
+    def __init__(self):
+        self.active = 0
+        self.pending = deque()
+        # A timer will dispatch the queue once the host's pacing allows
+        self.waking = False
+
+
+class FetchEngine:
+    """Runs HTTP fetches on a bounded pool, off the request thread
+
+    Jobs over a host's concurrency limit wait in a per-host queue rather
+    than in a pool thread, so a slow host only ever occupies its limit of
+    threads and fetches to other hosts keep flowing. The limit adapts to
+    the host's health (see hosts.HostHealth): failures shrink it, a host
+    that keeps failing has its circuit opened and its fetches fail fast
+    with HostUnavailable, and idempotent failures are retried with
+    jittered backoff or after the host's Retry-After, from a timer rather
+    than a sleeping thread.
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, max_per_host=MAX_PER_HOST,
+                 host_pools=HOST_POOLS, robots_mode=hosts.ROBOTS_MODE):
+        self.max_per_host = max_per_host
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight,
+                                            thread_name_prefix='fetch')
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = USER_AGENT
+        adapter = _Adapter(pool_connections=host_pools, pool_maxsize=max_per_host)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._hosts = {}
+        # Health outlives the host's queue, which goes away when idle
+        self._health = OrderedDict()
+        self._lock = threading.Lock()
+        self._timers = _Timers()
+        self.robots = hosts.RobotsCache(self._fetch_robots, USER_AGENT, robots_mode)
+
+    def submit(self, url, headers=None, timeout=DEFAULT_TIMEOUT, max_bytes=None, max_seconds=None):
+        """Schedule a GET for url and return a Future of the response
+
+        The body is read in chunks and the future fails with
+        FetchLimitExceeded if it grows past max_bytes or takes longer
+        than max_seconds, so one huge page cannot exhaust the worker. It
+        fails with HostUnavailable when the host's circuit is open or it
+        still answers 429/502/503/504 after the retries.
+        """
+        return self._submit(_Job(url, headers, timeout, max_bytes, max_seconds, None))
+
+    def stream(self, url, consumer, headers=None, timeout=DEFAULT_TIMEOUT, max_bytes=None, max_seconds=None):
+        """Schedule a GET whose body goes to consumer instead of memory
+
+        consumer.start(response) is called once the headers arrive, then
+        consumer.feed(chunk) until it returns True or a cap is reached, and
+        consumer.close() after that, all on the fetch thread (lxml parsers
+        must stay on one thread). The future resolves to (response, bytes
+        read, truncated).
+        """
+        return self._submit(_Job(url, headers, timeout, max_bytes, max_seconds, consumer))
+
+    def _submit(self, job):
+        self._enqueue(urlsplit(job.url).netloc.lower(), job)
+        return job.future
+
+    def fetch(self, url, headers=None, timeout=DEFAULT_TIMEOUT, max_bytes=None, max_seconds=None):
+        """Fetch url through the engine and wait for the response"""
+        return self.submit(url, headers, timeout, max_bytes, max_seconds).result()
+
+    def health(self, host):
+        """The HostHealth of host, created on first use; the lock is held"""
+        health = self._health.get(host)
+        if health is None:
+            health = self._health[host] = hosts.HostHealth(host, self.max_per_host)
+            while len(self._health) > hosts.MAX_HOSTS:
+                self._health.popitem(last=False)
+        else:
+            self._health.move_to_end(host)
+        return health
+
+    def _enqueue(self, host, job):
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                state = self._hosts[host] = _HostState()
+            if job.attempts:
+                # A retry has waited its turn already
+                state.pending.appendleft(job)
+            else:
+                state.pending.append(job)
+            started, failed = self._dispatch(host, state)
+        self._launch(host, started, failed)
+
+    def _dispatch(self, host, state):
+        """Take the jobs of host that may start now, and those that must fail; the lock is held"""
+        health = self.health(host)
+        now = time.monotonic()
+        started = []
+        try:
+            while state.pending and health.admit(now, state.active):
+                started.append(state.pending.popleft())
+                state.active += 1
+        except hosts.HostUnavailable as e:
+            failed = [(job, e) for job in state.pending]
+            state.pending.clear()
+            self._discard(host, state)
+            return started, failed
+        if state.pending and not state.waking and health.not_before > now:
+            state.waking = True
+            self._timers.call_at(health.not_before, self._wake, host)
+        return started, []
+
+    def _discard(self, host, state):
+        # _dispatch() may have dropped the host already, when its circuit is open
+        if self._hosts.get(host) is state and not state.active and not state.pending and not state.waking:
+            del self._hosts[host]
+
+    def _launch(self, host, started, failed):
+        for job in started:
+            self._executor.submit(self._run, host, job)
+        for job, error in failed:
+            if job.attempts or job.future.set_running_or_notify_cancel():
+                job.future.set_exception(hosts.HostUnavailable(error.host, error.retry_after, error.reason))
+
+    def _wake(self, host):
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None:
+                return
+            state.waking = False
+            started, failed = self._dispatch(host, state)
+            self._discard(host, state)
+        self._launch(host, started, failed)
+
+    def _run(self, host, job):
+        future = job.future
+        verdict = retry_after = retry_at = None
+        try:
+            if not job.attempts and not future.set_running_or_notify_cancel():
+                return
+            try:
+                crawl_delay = self.robots.check(job.url)
+                if crawl_delay:
+                    with self._lock:
+                        self.health(host).crawl_delay = crawl_delay
+                started = time.monotonic()
+                response = self._session.get(job.url, headers=job.headers, timeout=job.timeout, stream=True)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                verdict = hosts.FAILURE
+                retry_at = self._retry_at(job, None)
+                if retry_at is None:
+                    future.set_exception(e)
+                return
+            except BaseException as e:
+                future.set_exception(e)
+                return
+            if response.status_code in hosts.RETRY_STATUSES:
+                verdict = hosts.THROTTLED if response.status_code == 429 else hosts.FAILURE
+                retry_after = hosts.parse_retry_after(response.headers.get('Retry-After'))
+                response.close()
+                retry_at = self._retry_at(job, retry_after)
+                if retry_at is None:
+                    wait = retry_after if retry_after is not None else hosts.BREAKER_COOLDOWN
+                    future.set_exception(hosts.HostUnavailable(host, wait, f'HTTP {response.status_code}'))
+                return
+            verdict = hosts.SUCCESS
+            try:
+                # Read the body here so the caller never touches the socket
+                try:
+                    if job.consumer is None:
+                        response._content = read_body(response, job.max_bytes, job.max_seconds, started)
+                        result = response
+                    else:
+                        job.consumer.start(response)
+                        size, truncated = stream_body(response, job.consumer, job.max_bytes,
+                                                      job.max_seconds, started)
+                        job.consumer.close()
+                        result = (response, size, truncated)
+                finally:
+                    response.close()
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+        finally:
+            self._finish(host, verdict, retry_after)
+            if retry_at is not None:
+                job.attempts += 1
+                self._timers.call_at(retry_at, self._enqueue, host, job)
+
+    def _retry_at(self, job, retry_after):
+        """Monotonic time to retry job at, or None if it has used its retries or budget"""
+        if job.attempts >= hosts.RETRIES:
+            return None
+        if retry_after is None:
+            retry_after = hosts.backoff(job.attempts)
+        elif retry_after > hosts.MAX_RETRY_WAIT:
+            return None
+        retry_at = time.monotonic() + retry_after
+        return retry_at if retry_at <= job.deadline else None
+
+    def _finish(self, host, verdict, retry_after):
+        with self._lock:
+            self.health(host).record(verdict, time.monotonic(), retry_after)
+            state = self._hosts[host]
+            state.active -= 1
+            started, failed = self._dispatch(host, state)
+            self._discard(host, state)
+        self._launch(host, started, failed)
+
+    def _fetch_robots(self, url, timeout):
+        response = self._session.get(url, timeout=timeout, stream=True)
+        try:
+            body = read_body(response, hosts.ROBOTS_MAX_BYTES, timeout)
+        finally:
+            response.close()
+        return response.status_code, body.decode('utf-8', 'replace')
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._session.close()
+
+
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return this process's engine, creating it after fork if needed"""
+    global _engine, _engine_pid
+    if _engine_pid != os.getpid():
+        with _engine_lock:
+            if _engine_pid != os.getpid():
+                _engine = FetchEngine()
+                _engine_pid = os.getpid()
+    return _engine
+
+
+def fetch(url, headers=None, timeout=DEFAULT_TIMEOUT, max_bytes=None, max_seconds=None):
+    """Fetch url through the shared engine"""
+    return get_engine().fetch(url, headers, timeout, max_bytes, max_seconds)
@@ -0,0 +1,173 @@
+"""
+Change detection for DataScrape Pro
+Per-(user, url, selectors) fingerprints of the page body and the extracted result
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+import db
+from background import BufferedWriter
+from cache import selectors_key
+
+BUFFER_SIZE = int(os.environ.get('DATASCRAPE_FINGERPRINTS_BUFFER', 50_000))
+BATCH_SIZE = int(os.environ.get('DATASCRAPE_FINGERPRINTS_BATCH', 200))
+FLUSH_INTERVAL = float(os.environ.get('DATASCRAPE_FINGERPRINTS_FLUSH_INTERVAL', 1.0))
+# Fingerprints not updated for this long are pruned, unless a scheduled job
+# still watches their url; a scrape after that reports changed: true once
+RETENTION_DAYS = int(os.environ.get('DATASCRAPE_FINGERPRINT_RETENTION_DAYS', 90))
+DELETE_CHUNK = 10_000
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS scrape_fingerprints (
+        user_id INTEGER NOT NULL,
+        url TEXT NOT NULL,
+        selectors_key TEXT NOT NULL,
+        body_hash TEXT NOT NULL,
+        result_hash TEXT NOT NULL,
+        results TEXT NOT NULL,
+        etag TEXT,
+        last_modified TEXT,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (user_id, url, selectors_key)
+    ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS idx_scrape_fingerprints_updated ON scrape_fingerprints (updated_at)',
+)
+
+UPSERT_SQL = '''INSERT INTO scrape_fingerprints
+        (user_id, url, selectors_key, body_hash, result_hash, results, etag, last_modified, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id, url, selectors_key) DO UPDATE SET
+        body_hash = excluded.body_hash, result_hash = excluded.result_hash,
+        results = excluded.results, etag = excluded.etag,
+        last_modified = excluded.last_modified, updated_at = excluded.updated_at'''
+
+
+def create_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def result_hash(results):
+    canonical = json.dumps(results, sort_keys=True, separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+class Fingerprint:
+    """What a user last received for one url and selector set"""
+
+    __slots__ = ('body_hash', 'result_hash', 'results', 'etag', 'last_modified')
+
+    def __init__(self, body_hash, result_hash, results, etag=None, last_modified=None):
+        self.body_hash = body_hash
+        self.result_hash = result_hash
+        self.results = results
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @classmethod
+    def of(cls, page, results, digest=None):
+        return cls(page.content_hash, digest or result_hash(results), results,
+                   page.etag, page.last_modified)
+
+    def validators(self):
+        return self.etag, self.last_modified
+
+    def same_as(self, other):
+        return other is not None and (self.body_hash, self.result_hash, self.etag, self.last_modified) == \
+            (other.body_hash, other.result_hash, other.etag, other.last_modified)
+
+    def as_dict(self):
+        return {'body': self.body_hash or None, 'result': self.result_hash}
+
+
+def load(conn, user_id, url, selectors):
+    row = conn.execute('''SELECT body_hash, result_hash, results, etag, last_modified
+                          FROM scrape_fingerprints
+                          WHERE user_id = ? AND url = ? AND selectors_key = ?''',
+                       (user_id, url, selectors_key(selectors))).fetchone()
+    if row is None:
+        return None
+    return Fingerprint(row[0], row[1], json.loads(row[2]), row[3], row[4])
+
+
+def save_many(conn, items):
+    """Store (user_id, url, selectors, Fingerprint) items"""
+    now = time.time()
+    conn.executemany(UPSERT_SQL, [
+        (user_id, url, selectors_key(selectors), fp.body_hash, fp.result_hash,
+         json.dumps(fp.results), fp.etag, fp.last_modified, now)
+        for user_id, url, selectors, fp in items])
+
+
+class FingerprintWriter(BufferedWriter):
+    """Buffers fingerprint upserts off the request path
+
+    Fingerprints saved by this process are served by latest() until they
+    are written, so a repeat scrape compares against what the client was
+    just sent; other workers see them after the next flush.
+    """
+
+    def __init__(self, buffer_size=BUFFER_SIZE, batch_size=BATCH_SIZE, interval=FLUSH_INTERVAL):
+        super().__init__('fingerprints-flush', buffer_size, batch_size, interval)
+        self._unsaved = {}
+        self._unsaved_lock = threading.Lock()
+
+    def save(self, user_id, url, selectors, fingerprint):
+        key = (user_id, url, selectors_key(selectors))
+        with self._unsaved_lock:
+            if self._pid != os.getpid():
+                # The parent's unsaved fingerprints are the parent's to write
+                self._unsaved.clear()
+            self._unsaved[key] = fingerprint
+        self.append_many([key + (fingerprint, time.time())])
+
+    def latest(self, user_id, url, selectors):
+        """The last Fingerprint saved for (user_id, url, selectors), flushed or not"""
+        fingerprint = self._unsaved.get((user_id, url, selectors_key(selectors)))
+        if fingerprint is not None:
+            return fingerprint
+        with db.connection() as conn:
+            return load(conn, user_id, url, selectors)
+
+    def write_batch(self, batch):
+        with db.transaction() as conn:
+            conn.executemany(UPSERT_SQL, [
+                (user_id, url, key, fp.body_hash, fp.result_hash, json.dumps(fp.results),
+                 fp.etag, fp.last_modified, saved_at)
+                for user_id, url, key, fp, saved_at in batch])
+        with self._unsaved_lock:
+            for user_id, url, key, fp, _ in batch:
+                if self._unsaved.get((user_id, url, key)) is fp:
+                    del self._unsaved[(user_id, url, key)]
+
+
+fingerprint_writer = FingerprintWriter()
+
+
+def prune(max_age_days=RETENTION_DAYS, now=None):
+    """Delete fingerprints not updated for max_age_days, in short transactions"""
+    cutoff = (time.time() if now is None else now) - max_age_days * 86400
+    deleted = 0
+    while True:
+        with db.transaction() as conn:
+            count = conn.execute('''DELETE FROM scrape_fingerprints
+                WHERE (user_id, url, selectors_key) IN (
+                    SELECT f.user_id, f.url, f.selectors_key FROM scrape_fingerprints f
+                    WHERE f.updated_at < ? AND NOT EXISTS (
+                        SELECT 1 FROM scheduled_jobs s
+                        WHERE s.user_id = f.user_id AND s.url = f.url AND s.enabled = 1)
+                    LIMIT ?)''', (cutoff, DELETE_CHUNK)).rowcount
+        deleted += count
+        if count < DELETE_CHUNK:
+            return deleted
+
+
+def diff(old, new):
+    """Selector keys whose values changed or appeared, and keys that disappeared"""
+    changes = {key: value for key, value in new.items() if key not in old or old[key] != value}
+    removed = [key for key in old if key not in new]
+    return changes, removed
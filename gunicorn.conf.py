@@ -0,0 +1,46 @@
+"""
+Gunicorn settings for DataScrape Pro
+Threaded workers forked from a preloaded master; the schema is migrated once, on the master
+"""
+
+import gc
+import os
+import subprocess
+import sys
+
+wsgi_app = 'app:create_app()'
+bind = os.environ.get('DATASCRAPE_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('DATASCRAPE_WORKERS', 4))
+# Threaded workers keep many scrapes in flight while the fetch engine does the I/O
+worker_class = 'gthread'
+threads = int(os.environ.get('DATASCRAPE_THREADS', 64))
+# Import the app once in the master; workers share those pages copy-on-write
+# instead of each importing it again. DATASCRAPE_PRELOAD=0 turns this off,
+# e.g. to pick up code changes with a HUP.
+preload_app = os.environ.get('DATASCRAPE_PRELOAD', '1') != '0'
+
+# Until the workers fork, the cyclic GC would only touch (and so copy) the
+# master's pages; when_ready freezes what the master allocated instead
+gc.disable()
+
+
+def on_starting(server):
+    """Migrate the schema once per deployment, before any worker exists"""
+    if server.cfg.preload_app:
+        import app
+        app.init_db()
+    else:
+        # Keep the app out of the master, so every (re)started worker imports it afresh
+        subprocess.run([sys.executable, '-c', 'from app import init_db; init_db()'], check=True)
+
+
+def when_ready(server):
+    """Last step in the master before the first fork"""
+    db = sys.modules.get('db')
+    if db is not None:
+        # Workers open their own connections; don't hand them the master's
+        db.get_pool().close()
+    # Objects allocated so far move to a permanent generation the GC never
+    # scans, so collections in workers leave the shared pages alone
+    gc.freeze()
+    gc.enable()
@@ -0,0 +1,281 @@
+"""
+Per-host fetch policy for DataScrape Pro
+Host health with adaptive concurrency and circuit breakers, retry backoff, and DNS and robots.txt caches
+"""
+
+import os
+import random
+import socket
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+
+# Retries of one fetch after a connection error, timeout or retryable status
+RETRIES = int(os.environ.get('DATASCRAPE_FETCH_RETRIES', 2))
+RETRY_STATUSES = frozenset((429, 502, 503, 504))
+# Full-jitter exponential backoff: attempt n waits up to RETRY_BACKOFF * 2**n seconds
+RETRY_BACKOFF = float(os.environ.get('DATASCRAPE_FETCH_RETRY_BACKOFF', 0.25))
+RETRY_MAX_BACKOFF = 4.0
+# No retry of a fetch starts later than this many seconds after it was submitted
+RETRY_BUDGET = float(os.environ.get('DATASCRAPE_FETCH_RETRY_BUDGET', 15))
+# A longer Retry-After is not waited out: the host's circuit opens for that long
+MAX_RETRY_WAIT = float(os.environ.get('DATASCRAPE_FETCH_MAX_RETRY_WAIT', 10))
+# Consecutive failures that open a host's circuit, and how long it stays open
+# at first; each failed probe doubles the cooldown up to BREAKER_MAX_COOLDOWN
+BREAKER_FAILURES = int(os.environ.get('DATASCRAPE_BREAKER_FAILURES', 5))
+BREAKER_COOLDOWN = float(os.environ.get('DATASCRAPE_BREAKER_COOLDOWN', 15))
+BREAKER_MAX_COOLDOWN = 300.0
+# Hosts whose health, DNS answers and robots.txt are remembered
+MAX_HOSTS = int(os.environ.get('DATASCRAPE_FETCH_HOSTS', 10000))
+DNS_TTL = float(os.environ.get('DATASCRAPE_DNS_TTL', 300))
+# Failed lookups are remembered too, so a dead domain fails without a resolver round trip
+DNS_NEGATIVE_TTL = 30.0
+# robots.txt handling: 'ignore' never fetches it, 'delay' honors Crawl-delay,
+# 'obey' also refuses disallowed URLs. Off by default: a Crawl-delay paces
+# every fetch to that host, for all customers, to one per delay per worker.
+ROBOTS_MODE = os.environ.get('DATASCRAPE_ROBOTS', 'ignore')
+ROBOTS_TTL = float(os.environ.get('DATASCRAPE_ROBOTS_TTL', 3600))
+# An unreachable robots.txt allows everything until it is retried
+ROBOTS_ERROR_TTL = 600.0
+ROBOTS_TIMEOUT = 5
+ROBOTS_MAX_BYTES = 512 * 1024
+MAX_CRAWL_DELAY = 10.0
+
+# Verdicts of one fetch attempt for HostHealth.record
+SUCCESS = 'success'
+FAILURE = 'failure'
+THROTTLED = 'throttled'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class HostUnavailable(Exception):
+    """Fetches to a host fail fast: its circuit is open or it keeps failing"""
+
+    def __init__(self, host, retry_after, reason):
+        self.host = host
+        self.retry_after = retry_after
+        self.reason = reason
+        super().__init__(f'{host} is unavailable ({reason}); retry in {retry_after:.0f} s')
+
+
+class RobotsDisallowed(Exception):
+    """robots.txt disallows the URL for our user agent"""
+
+    def __init__(self, url):
+        self.url = url
+        super().__init__(f'{url} is disallowed by robots.txt')
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header (delta or HTTP date), or None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def backoff(attempt):
+    """Full-jitter delay before retry number attempt (0-based)"""
+    return random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * 2 ** attempt))
+
+
+class HostHealth:
+    """Circuit breaker, AIMD concurrency limit and pacing of one host
+
+    The limit starts at max_limit, halves on every failure or throttling
+    response and grows by one after limit successes in a row. Callers
+    hold the fetch engine's lock.
+    """
+
+    __slots__ = ('host', 'max_limit', 'limit', 'successes', 'failures', 'state', 'reason',
+                 'open_until', 'cooldown', 'probing', 'not_before', 'crawl_delay')
+
+    def __init__(self, host, max_limit):
+        self.host = host
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.successes = 0
+        self.failures = 0
+        self.state = CLOSED
+        self.reason = None
+        self.open_until = 0.0
+        self.cooldown = BREAKER_COOLDOWN
+        # Half-open lets a single probe through
+        self.probing = False
+        # Monotonic time before which no fetch starts (Retry-After, Crawl-delay)
+        self.not_before = 0.0
+        self.crawl_delay = 0.0
+
+    def admit(self, now, active):
+        """True if a fetch may start now, False to keep it queued
+
+        Raises HostUnavailable while the circuit is open.
+        """
+        if self.state == OPEN:
+            if now < self.open_until:
+                raise HostUnavailable(self.host, self.open_until - now, self.reason)
+            self.state = HALF_OPEN
+            self.probing = False
+        if self.state == HALF_OPEN:
+            if self.probing or active:
+                return False
+            self.probing = True
+        elif active >= self.limit or now < self.not_before:
+            return False
+        if self.crawl_delay:
+            self.not_before = now + self.crawl_delay
+        return True
+
+    def record(self, verdict, now, retry_after=None):
+        """Account one finished attempt; verdict None means it never reached the host"""
+        self.probing = False
+        if retry_after is not None:
+            if retry_after > MAX_RETRY_WAIT:
+                self._open(now, retry_after, 'Retry-After')
+            else:
+                self.not_before = max(self.not_before, now + retry_after)
+        if verdict == SUCCESS:
+            self.failures = 0
+            if self.state != CLOSED and not (self.state == OPEN and now < self.open_until):
+                self.state = CLOSED
+                self.cooldown = BREAKER_COOLDOWN
+            self.successes += 1
+            if self.successes >= self.limit:
+                self.limit = min(self.max_limit, self.limit + 1)
+                self.successes = 0
+        elif verdict in (FAILURE, THROTTLED):
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
+            if verdict == FAILURE:
+                self.failures += 1
+                # Fetches already in flight when the circuit opened do not reopen it
+                if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= BREAKER_FAILURES):
+                    self._open(now, self.cooldown, f'{self.failures} failures in a row')
+                    self.cooldown = min(BREAKER_MAX_COOLDOWN, self.cooldown * 2)
+
+    def _open(self, now, seconds, reason):
+        self.state = OPEN
+        self.reason = reason
+        self.open_until = max(self.open_until, now + seconds)
+        self.probing = False
+
+
+class DNSCache:
+    """getaddrinfo answers kept for DNS_TTL seconds, failures for DNS_NEGATIVE_TTL"""
+
+    def __init__(self, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL, max_entries=MAX_HOSTS):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        """An address for host, raising socket.gaierror like getaddrinfo"""
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                if isinstance(entry[1], socket.gaierror):
+                    raise entry[1]
+                return entry[1]
+        try:
+            address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][4][0]
+            entry = (now + self.ttl, address)
+        except socket.gaierror as e:
+            entry = (now + self.negative_ttl, e)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        if isinstance(entry[1], socket.gaierror):
+            raise entry[1]
+        return entry[1]
+
+    def forget(self, host, port):
+        """Drop host's address, e.g. after connecting to it failed"""
+        with self._lock:
+            self._entries.pop((host, port), None)
+
+
+class _Robots:
+    __slots__ = ('rules', 'expires', 'ready')
+
+    def __init__(self):
+        self.rules = None
+        self.expires = 0.0
+        self.ready = threading.Event()
+
+
+class RobotsCache:
+    """Parsed robots.txt per origin, fetched once per ROBOTS_TTL
+
+    fetch(url, timeout) returns (status, text). Concurrent first fetches
+    to a host wait for a single robots.txt download.
+    """
+
+    def __init__(self, fetch, user_agent, mode=ROBOTS_MODE, ttl=ROBOTS_TTL, max_entries=MAX_HOSTS):
+        self.fetch = fetch
+        self.user_agent = user_agent
+        self.mode = mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, url):
+        """Crawl delay in seconds for url's host; raises RobotsDisallowed in obey mode"""
+        if self.mode == 'ignore':
+            return 0.0
+        parts = urlsplit(url)
+        rules = self._rules(f'{parts.scheme}://{parts.netloc}')
+        if rules is None:
+            return 0.0
+        if self.mode == 'obey' and not rules.can_fetch(self.user_agent, url):
+            raise RobotsDisallowed(url)
+        delay = rules.crawl_delay(self.user_agent)
+        return min(float(delay), MAX_CRAWL_DELAY) if delay else 0.0
+
+    def _rules(self, origin):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(origin)
+            owner = entry is None or (entry.ready.is_set() and entry.expires <= now)
+            if owner:
+                entry = self._entries[origin] = _Robots()
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            self._entries.move_to_end(origin)
+        if not owner:
+            entry.ready.wait(ROBOTS_TIMEOUT)
+            return entry.rules
+        try:
+            status, text = self.fetch(f'{origin}/robots.txt', ROBOTS_TIMEOUT)
+        except Exception:
+            status, text = None, None
+        if status is not None and 200 <= status < 300:
+            rules = RobotFileParser()
+            rules.parse(text.splitlines())
+            rules.modified()
+            entry.rules, entry.expires = rules, now + self.ttl
+        else:
+            # A missing robots.txt (4xx) allows everything, as RFC 9309 says;
+            # so does an unreachable one, until it is retried
+            ttl = self.ttl if status is not None and 400 <= status < 500 else ROBOTS_ERROR_TTL
+            entry.expires = now + ttl
+        entry.ready.set()
+        return entry.rules
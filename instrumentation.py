@@ -0,0 +1,390 @@
+"""
+Request instrumentation for DataScrape Pro
+Per-stage timing histograms in Prometheus text format and sampled per-key profiling
+"""
+
+import cProfile
+import functools
+import glob
+import io
+import json
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left
+from contextlib import nullcontext
+
+from flask import request
+
+import db
+from background import PeriodicWorker
+
+# Set DATASCRAPE_METRICS=0 to turn every span into a shared no-op
+ENABLED = os.environ.get('DATASCRAPE_METRICS', '1') != '0'
+# Upper bounds of the duration buckets in seconds (+Inf is implicit)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# When set, every process writes its metrics to <dir>/metrics-<pid>.json and
+# /metrics reports the sum over all files, so any gunicorn worker can answer.
+# Clear the directory on deploy; files of exited workers keep their counts.
+METRICS_DIR = os.environ.get('DATASCRAPE_METRICS_DIR')
+# Seconds between metric dumps and reloads of the profiling targets
+SYNC_INTERVAL = float(os.environ.get('DATASCRAPE_METRICS_SYNC_INTERVAL', 5.0))
+# Where profiling captures are written; defaults to profiles/ next to the database
+PROFILE_DIR = os.environ.get('DATASCRAPE_PROFILE_DIR') or os.path.join(
+    os.path.dirname(os.path.abspath(db.DATABASE_PATH)), 'profiles')
+# Allocation sites listed in a memory capture
+TOP_ALLOCATIONS = 25
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS profile_requests (
+        api_key TEXT PRIMARY KEY,
+        remaining INTEGER NOT NULL,
+        sample_rate REAL NOT NULL,
+        memory INTEGER NOT NULL DEFAULT 0,
+        expires_at REAL NOT NULL
+    )''',
+)
+
+_NULL = nullcontext()
+_local = threading.local()
+
+
+def create_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+class Histogram:
+    """Bucket counts, sum and count of one (endpoint, stage, tier) series"""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """This process's stage histograms and request counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._requests = {}
+
+    def observe(self, endpoint, stage, tier, seconds):
+        key = (endpoint, stage, tier)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def observe_request(self, endpoint, tier, status, stages):
+        with self._lock:
+            key = (endpoint, tier, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for stage, seconds in stages:
+                key = (endpoint, stage, tier)
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.observe(seconds)
+
+    def snapshot(self):
+        """JSON-able copy, including this process's SQLite lock statistics"""
+        with self._lock:
+            histograms = [[*key, list(h.counts), h.sum, h.count] for key, h in self._histograms.items()]
+            counters = [[*key, count] for key, count in self._requests.items()]
+        return {'histograms': histograms, 'requests': counters, 'sqlite': db.lock_stats()}
+
+
+registry = Registry()
+
+
+class _Span:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+def span(stage):
+    """Context manager timing one stage of the current request"""
+    if not ENABLED:
+        return _NULL
+    return _Span(stage)
+
+
+def record(stage, seconds):
+    """Attribute seconds to stage, buffered on the request until its tier is known"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.stages.append((stage, seconds))
+    else:
+        registry.observe('', stage, '', seconds)
+
+
+def identify(user_id, tier):
+    """Label the current request's spans with the caller's tier"""
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.user_id = user_id
+        trace.tier = tier
+
+
+class Trace:
+    __slots__ = ('endpoint', 'stages', 'user_id', 'tier', 'start')
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.stages = []
+        self.user_id = None
+        self.tier = ''
+        self.start = time.perf_counter()
+
+
+def traced(endpoint):
+    """Decorate a view so its spans and total time land in the registry"""
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return view(*args, **kwargs)
+            syncer.ensure_started()
+            trace = _local.trace = Trace(endpoint)
+            capture = profiler.start(request.headers.get('X-API-Key'))
+            status = 500
+            try:
+                response = view(*args, **kwargs)
+                if isinstance(response, tuple):
+                    status = response[1]
+                else:
+                    status = getattr(response, 'status_code', 200)
+                return response
+            finally:
+                _local.trace = None
+                trace.stages.append(('request', time.perf_counter() - trace.start))
+                if capture is not None:
+                    capture.finish(trace)
+                registry.observe_request(endpoint, trace.tier, str(status), trace.stages)
+        return wrapper
+    return decorate
+
+
+class Capture:
+    """cProfile (and optionally tracemalloc) recording of one request"""
+
+    def __init__(self, profiler, api_key, memory):
+        self.profiler = profiler
+        self.api_key = api_key
+        self.memory = memory and not tracemalloc.is_tracing()
+        self.before = None
+        if self.memory:
+            tracemalloc.start()
+            self.before = tracemalloc.take_snapshot()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def finish(self, trace):
+        self.profile.disable()
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            name = f'{time.strftime("%Y%m%dT%H%M%S")}-user{trace.user_id}-{os.getpid()}-{id(self):x}'
+            self.profile.dump_stats(os.path.join(PROFILE_DIR, name + '.prof'))
+            if self.memory:
+                self._write_memory(os.path.join(PROFILE_DIR, name + '.alloc.txt'), trace)
+        finally:
+            if self.memory:
+                tracemalloc.stop()
+            self.profiler.finished(self.api_key)
+
+    def _write_memory(self, path, trace):
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        out = io.StringIO()
+        out.write(f'{trace.endpoint} user {trace.user_id}: {current} bytes traced, peak {peak}\n')
+        out.write('Other threads ran during the capture, so unrelated allocations may appear.\n\n')
+        for stat in after.compare_to(self.before, 'lineno')[:TOP_ALLOCATIONS]:
+            out.write(f'{stat}\n')
+        with open(path, 'w') as f:
+            f.write(out.getvalue())
+
+
+class Profiler:
+    """Samples requests of the API keys listed in profile_requests
+
+    Targets are reloaded by the sync worker, so the request path only does a
+    dict lookup when nothing is being profiled. One capture runs at a time
+    per process, as cProfile and tracemalloc would otherwise interfere.
+    """
+
+    def __init__(self):
+        self._targets = {}
+        self._busy = threading.Lock()
+
+    def start(self, api_key):
+        target = self._targets.get(api_key) if api_key else None
+        if target is None or target['remaining'] <= 0 or random.random() >= target['sample_rate']:
+            return None
+        if not self._busy.acquire(blocking=False):
+            return None
+        try:
+            return Capture(self, api_key, target['memory'])
+        except Exception:
+            self._busy.release()
+            raise
+
+    def finished(self, api_key):
+        try:
+            target = self._targets.get(api_key)
+            if target is not None:
+                target['remaining'] -= 1
+            with db.transaction() as conn:
+                conn.execute('UPDATE profile_requests SET remaining = remaining - 1 '
+                             'WHERE api_key = ? AND remaining > 0', (api_key,))
+        finally:
+            self._busy.release()
+
+    def reload(self, conn):
+        rows = conn.execute('SELECT api_key, remaining, sample_rate, memory FROM profile_requests '
+                            'WHERE remaining > 0 AND expires_at > ?', (time.time(),)).fetchall()
+        self._targets = {key: {'remaining': remaining, 'sample_rate': rate, 'memory': bool(memory)}
+                         for key, remaining, rate, memory in rows}
+
+
+profiler = Profiler()
+
+
+def enable_profiling(conn, api_key, samples=10, sample_rate=1.0, memory=False, ttl=600):
+    """Capture up to samples requests of api_key within ttl seconds"""
+    conn.execute('''INSERT INTO profile_requests (api_key, remaining, sample_rate, memory, expires_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (api_key) DO UPDATE SET remaining = excluded.remaining,
+                        sample_rate = excluded.sample_rate, memory = excluded.memory,
+                        expires_at = excluded.expires_at''',
+                 (api_key, samples, sample_rate, int(memory), time.time() + ttl))
+
+
+def disable_profiling(conn, api_key):
+    return conn.execute('DELETE FROM profile_requests WHERE api_key = ?', (api_key,)).rowcount
+
+
+def profiling_status(conn):
+    """Active targets, with keys shortened, and the capture files written so far"""
+    rows = conn.execute('SELECT api_key, remaining, sample_rate, memory, expires_at FROM profile_requests '
+                        'WHERE remaining > 0 AND expires_at > ?', (time.time(),)).fetchall()
+    captures = sorted(os.path.basename(p) for p in glob.glob(os.path.join(PROFILE_DIR, '*.prof')))
+    return {
+        'targets': [{'api_key': key[:6] + '...', 'remaining': remaining, 'sample_rate': rate,
+                     'memory': bool(memory), 'expires_at': expires_at}
+                    for key, remaining, rate, memory, expires_at in rows],
+        'captures': captures,
+        'profile_dir': PROFILE_DIR,
+    }
+
+
+def summarize_profile(path, limit=30):
+    """Top functions of a .prof capture by cumulative time, as text"""
+    out = io.StringIO()
+    pstats.Stats(path, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+
+def _sync():
+    with db.connection() as conn:
+        profiler.reload(conn)
+    if METRICS_DIR:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f'metrics-{os.getpid()}.json')
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(registry.snapshot(), f)
+        os.replace(tmp, path)
+
+
+syncer = PeriodicWorker('metrics-sync', SYNC_INTERVAL, _sync)
+
+
+def _collect():
+    """Snapshots of every process sharing METRICS_DIR, or just this one"""
+    own = registry.snapshot()
+    if not METRICS_DIR:
+        return [own]
+    snapshots = [own]
+    own_file = f'metrics-{os.getpid()}.json'
+    for path in glob.glob(os.path.join(METRICS_DIR, 'metrics-*.json')):
+        if os.path.basename(path) == own_file:
+            continue
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def _labels(**labels):
+    return ','.join(f'{k}="{v}"' for k, v in labels.items())
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    histograms, counters, sqlite = {}, {}, {}
+    for snapshot in _collect():
+        for endpoint, stage, tier, counts, total, count in snapshot['histograms']:
+            merged = histograms.setdefault((endpoint, stage, tier), [[0] * len(counts), 0.0, 0])
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+            merged[2] += count
+        for endpoint, tier, status, count in snapshot['requests']:
+            counters[(endpoint, tier, status)] = counters.get((endpoint, tier, status), 0) + count
+        for key, value in snapshot['sqlite'].items():
+            sqlite[key] = max(sqlite.get(key, 0), value) if key == 'lock_wait_max_ms' else sqlite.get(key, 0) + value
+
+    lines = [
+        '# HELP datascrape_stage_duration_seconds Time spent in each stage of a request',
+        '# TYPE datascrape_stage_duration_seconds histogram',
+    ]
+    for (endpoint, stage, tier), (counts, total, count) in sorted(histograms.items()):
+        labels = _labels(endpoint=endpoint, stage=stage, tier=tier)
+        cumulative = 0
+        for bound, n in zip(BUCKETS, counts):
+            cumulative += n
+            lines.append(f'datascrape_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'datascrape_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f'datascrape_stage_duration_seconds_sum{{{labels}}} {total}')
+        lines.append(f'datascrape_stage_duration_seconds_count{{{labels}}} {count}')
+
+    lines += ['# HELP datascrape_requests_total Instrumented requests by status',
+              '# TYPE datascrape_requests_total counter']
+    for (endpoint, tier, status), count in sorted(counters.items()):
+        lines.append(f'datascrape_requests_total{{{_labels(endpoint=endpoint, tier=tier, status=status)}}} {count}')
+
+    lines += ['# HELP datascrape_sqlite_transactions_total Write transactions committed or rolled back',
+              '# TYPE datascrape_sqlite_transactions_total counter',
+              f'datascrape_sqlite_transactions_total {sqlite.get("transactions", 0)}',
+              '# HELP datascrape_sqlite_lock_wait_seconds_total Time spent waiting for the write lock',
+              '# TYPE datascrape_sqlite_lock_wait_seconds_total counter',
+              f'datascrape_sqlite_lock_wait_seconds_total {sqlite.get("lock_wait_s", 0.0)}',
+              '# HELP datascrape_sqlite_lock_held_seconds_total Time the write lock was held',
+              '# TYPE datascrape_sqlite_lock_held_seconds_total counter',
+              f'datascrape_sqlite_lock_held_seconds_total {sqlite.get("lock_held_s", 0.0)}']
+    return '\n'.join(lines) + '\n'
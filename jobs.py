@@ -0,0 +1,661 @@
+#!/usr/bin/env python3
+"""
+Scheduled scrape jobs for DataScrape Pro
+SQLite-backed work queue, cron schedules, host politeness and webhook delivery,
+run by a worker pool outside the web processes
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
+
+import requests
+
+import cache
+import db
+import fingerprints
+import results as result_store
+import scraper
+from background import PeriodicWorker
+from fetcher import UNBILLED_ERRORS, USER_AGENT, FetchLimitExceeded
+from hosts import RobotsDisallowed
+from quota import QuotaManager
+from usage_log import usage_logger, utc_timestamp
+
+logger = logging.getLogger(__name__)
+
+# Fetches a worker process keeps in flight
+WORKER_CONCURRENCY = int(os.environ.get('DATASCRAPE_JOB_CONCURRENCY', 32))
+# Idle workers poll the queue this often
+POLL_INTERVAL = float(os.environ.get('DATASCRAPE_JOB_POLL_INTERVAL', 0.5))
+# How often due schedules are turned into queue items and stale leases reclaimed
+SCHEDULER_INTERVAL = float(os.environ.get('DATASCRAPE_JOB_SCHEDULER_INTERVAL', 1.0))
+# A claimed item not finished within this many seconds is handed to another worker
+LEASE_SECONDS = float(os.environ.get('DATASCRAPE_JOB_LEASE', 120))
+# Politeness: minimum seconds between job starts on one host, and jobs in flight per host
+HOST_DELAY = float(os.environ.get('DATASCRAPE_JOB_HOST_DELAY', 1.0))
+HOST_CONCURRENCY = int(os.environ.get('DATASCRAPE_JOB_HOST_CONCURRENCY', 2))
+# Default random delay added to each scheduled run, so "0 * * * *" does not
+# put every customer's job on the queue at the same second
+DEFAULT_JITTER = int(os.environ.get('DATASCRAPE_JOB_JITTER', 60))
+MAX_JITTER = 3600
+MIN_INTERVAL = 60
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 30
+# Finished queue items are kept this long for /api/jobs/<id>/runs and stats
+QUEUE_RETENTION_DAYS = 7
+
+WEBHOOK_TIMEOUT = 10
+WEBHOOK_CONCURRENCY = int(os.environ.get('DATASCRAPE_WEBHOOK_CONCURRENCY', 16))
+WEBHOOK_MAX_ATTEMPTS = 8
+WEBHOOK_BACKOFF = 15
+WEBHOOK_MAX_BACKOFF = 3600
+
+# Times in these tables are Unix epoch seconds, which keeps lag arithmetic in SQL simple
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS scheduled_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        url TEXT NOT NULL,
+        selectors TEXT NOT NULL DEFAULT '{}',
+        cache_ttl REAL,
+        schedule TEXT NOT NULL,
+        jitter INTEGER NOT NULL DEFAULT 0,
+        webhook_url TEXT,
+        enabled INTEGER NOT NULL DEFAULT 1,
+        next_run_at REAL NOT NULL,
+        last_run_at REAL,
+        last_status TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )''',
+    'CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_due ON scheduled_jobs (next_run_at) WHERE enabled = 1',
+    'CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_user ON scheduled_jobs (user_id)',
+    '''CREATE TABLE IF NOT EXISTS job_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        schedule_id INTEGER,
+        user_id INTEGER NOT NULL,
+        url TEXT NOT NULL,
+        host TEXT NOT NULL,
+        selectors TEXT NOT NULL DEFAULT '{}',
+        cache_ttl REAL,
+        webhook_url TEXT,
+        status TEXT NOT NULL DEFAULT 'queued',
+        scheduled_for REAL NOT NULL,
+        run_at REAL NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        leased_until REAL,
+        started_at REAL,
+        finished_at REAL,
+        error TEXT
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_job_queue_due ON job_queue (run_at) WHERE status = 'queued'",
+    "CREATE INDEX IF NOT EXISTS idx_job_queue_leases ON job_queue (leased_until) WHERE status = 'running'",
+    'CREATE INDEX IF NOT EXISTS idx_job_queue_schedule ON job_queue (schedule_id, id)',
+    'CREATE INDEX IF NOT EXISTS idx_job_queue_finished ON job_queue (finished_at) WHERE finished_at IS NOT NULL',
+    '''CREATE TABLE IF NOT EXISTS host_slots (
+        host TEXT PRIMARY KEY,
+        next_allowed_at REAL NOT NULL DEFAULT 0,
+        running INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS webhook_deliveries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        queue_id INTEGER,
+        user_id INTEGER NOT NULL,
+        url TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL NOT NULL,
+        last_error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_due ON webhook_deliveries (next_attempt_at) WHERE status = 'pending'",
+)
+
+# Due items whose host has a free slot, oldest first
+CLAIM_SQL = '''SELECT q.id, q.schedule_id, q.user_id, u.tier, q.url, q.host, q.selectors,
+        q.cache_ttl, q.webhook_url, q.scheduled_for, q.run_at, q.attempts
+    FROM job_queue q
+    JOIN users u ON u.id = q.user_id
+    LEFT JOIN host_slots h ON h.host = q.host
+    WHERE q.status = 'queued' AND q.run_at <= ?
+      AND (h.host IS NULL OR (h.next_allowed_at <= ? AND h.running < ?))
+    ORDER BY q.run_at
+    LIMIT ?'''
+
+TAKE_HOST_SQL = '''INSERT INTO host_slots (host, next_allowed_at, running) VALUES (?, ?, 1)
+    ON CONFLICT (host) DO UPDATE SET next_allowed_at = excluded.next_allowed_at, running = running + 1'''
+
+
+def create_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def host_of(url):
+    return urlsplit(url).netloc.lower()
+
+
+_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+}
+# minute, hour, day of month, month, day of week (0 or 7 is Sunday)
+_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def _parse_field(text, low, high):
+    values = set()
+    for part in text.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError(f'invalid step in {text!r}')
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(v) for v in part.split('-', 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high:
+            raise ValueError(f'{text!r} is outside {low}-{high}')
+        values.update(range(start, end + 1, step))
+    return frozenset(values)
+
+
+class Schedule:
+    """A five-field cron expression (UTC), @hourly-style alias, or "@every 15m" """
+
+    def __init__(self, expr):
+        self.expr = expr = expr.strip()
+        self.interval = None
+        if expr.startswith('@every '):
+            amount = expr[len('@every '):].strip()
+            try:
+                self.interval = int(amount[:-1]) * _UNITS[amount[-1]]
+            except (IndexError, KeyError, ValueError):
+                raise ValueError(f'invalid interval {amount!r}, expected e.g. 30m, 2h or 1d')
+            if self.interval < MIN_INTERVAL:
+                raise ValueError(f'schedules may not run more often than every {MIN_INTERVAL} seconds')
+            return
+        fields = _ALIASES.get(expr, expr).split()
+        if len(fields) != 5:
+            raise ValueError('schedule must be a 5-field cron expression, an alias like @hourly, '
+                             'or @every <n>[smhd]')
+        try:
+            minutes, hours, days, months, weekdays = (
+                _parse_field(field, low, high) for field, (low, high) in zip(fields, _FIELDS))
+        except ValueError as e:
+            raise ValueError(f'invalid schedule {expr!r}: {e}')
+        self.minutes, self.hours, self.days, self.months = minutes, hours, days, months
+        self.weekdays = frozenset(day % 7 for day in weekdays)
+        # Cron matches either day field when both are restricted
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+        if self.next_after(time.time()) is None:
+            raise ValueError(f'schedule {expr!r} never fires')
+
+    def _day_matches(self, moment):
+        day = moment.day in self.days
+        weekday = moment.isoweekday() % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def next_after(self, ts):
+        """First firing time strictly after ts, as epoch seconds"""
+        if self.interval is not None:
+            return ts + self.interval
+        moment = datetime.fromtimestamp(ts, timezone.utc).replace(second=0, microsecond=0)
+        moment += timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment.timestamp()
+        return None
+
+
+def create_job(conn, user_id, url, schedule, selectors=None, cache_ttl=None,
+               webhook_url=None, jitter=DEFAULT_JITTER):
+    """Insert a scheduled job; raises ValueError for a bad schedule or jitter"""
+    plan = Schedule(schedule)
+    if not 0 <= jitter <= MAX_JITTER:
+        raise ValueError(f'jitter must be between 0 and {MAX_JITTER} seconds')
+    next_run_at = plan.next_after(time.time())
+    return conn.execute(
+        '''INSERT INTO scheduled_jobs (user_id, url, selectors, cache_ttl, schedule, jitter,
+                                       webhook_url, next_run_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+        (user_id, url, json.dumps(selectors or {}), cache_ttl, plan.expr, jitter,
+         webhook_url, next_run_at)).lastrowid
+
+
+def enqueue(conn, user_id, url, selectors=None, cache_ttl=None, webhook_url=None,
+            run_at=None, schedule_id=None, scheduled_for=None):
+    """Put one run on the queue"""
+    run_at = time.time() if run_at is None else run_at
+    return conn.execute(
+        '''INSERT INTO job_queue (schedule_id, user_id, url, host, selectors, cache_ttl,
+                                  webhook_url, scheduled_for, run_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+        (schedule_id, user_id, url, host_of(url), selectors if isinstance(selectors, str)
+         else json.dumps(selectors or {}), cache_ttl, webhook_url,
+         run_at if scheduled_for is None else scheduled_for, run_at)).lastrowid
+
+
+def enqueue_due(now=None, limit=1000):
+    """Queue a run for every schedule that is due and advance it
+
+    A schedule whose previous run is still queued or running is not queued
+    again, and missed firings are skipped rather than replayed, so a stopped
+    worker pool does not come back to a backlog storm.
+    """
+    now = time.time() if now is None else now
+    queued = 0
+    with db.transaction() as conn:
+        due = conn.execute(
+            '''SELECT id, user_id, url, selectors, cache_ttl, webhook_url, schedule, jitter, next_run_at
+               FROM scheduled_jobs WHERE enabled = 1 AND next_run_at <= ?
+               ORDER BY next_run_at LIMIT ?''', (now, limit)).fetchall()
+        for (schedule_id, user_id, url, selectors, cache_ttl, webhook_url,
+             schedule, jitter, next_run_at) in due:
+            busy = conn.execute(
+                '''SELECT 1 FROM job_queue WHERE schedule_id = ? AND status IN ('queued', 'running')
+                   LIMIT 1''', (schedule_id,)).fetchone()
+            if not busy:
+                run_at = next_run_at + random.uniform(0, jitter)
+                enqueue(conn, user_id, url, selectors, cache_ttl, webhook_url,
+                        run_at=run_at, schedule_id=schedule_id, scheduled_for=next_run_at)
+                queued += 1
+            following = Schedule(schedule).next_after(max(now, next_run_at))
+            conn.execute('UPDATE scheduled_jobs SET next_run_at = ? WHERE id = ?',
+                         (following, schedule_id))
+    return queued
+
+
+def claim(worker, limit, now=None):
+    """Lease up to limit due items, at most one per host, respecting politeness"""
+    now = time.time() if now is None else now
+    with db.transaction() as conn:
+        rows = conn.execute(CLAIM_SQL, (now, now, HOST_CONCURRENCY, limit * 4)).fetchall()
+        claimed, hosts = [], set()
+        for row in rows:
+            if row[5] in hosts:
+                continue
+            hosts.add(row[5])
+            claimed.append(row)
+            if len(claimed) == limit:
+                break
+        if claimed:
+            conn.executemany(
+                '''UPDATE job_queue SET status = 'running', worker = ?, leased_until = ?,
+                       started_at = ?, attempts = attempts + 1 WHERE id = ?''',
+                [(worker, now + LEASE_SECONDS, now, row[0]) for row in claimed])
+            conn.executemany(TAKE_HOST_SQL, [(host, now + HOST_DELAY) for host in hosts])
+    return claimed
+
+
+def housekeeping(now=None):
+    """Requeue items whose worker died, resync host slots and prune old items"""
+    now = time.time() if now is None else now
+    with db.transaction() as conn:
+        expired = conn.execute(
+            '''UPDATE job_queue SET status = 'queued', worker = NULL, leased_until = NULL
+               WHERE status = 'running' AND leased_until < ?''', (now,)).rowcount
+        if expired:
+            conn.execute('''UPDATE host_slots SET running = (
+                SELECT COUNT(*) FROM job_queue WHERE status = 'running' AND host = host_slots.host)''')
+        conn.execute('''DELETE FROM job_queue WHERE id IN (
+            SELECT id FROM job_queue WHERE finished_at < ? LIMIT 10000)''',
+                     (now - QUEUE_RETENTION_DAYS * 86400,))
+        conn.execute('DELETE FROM host_slots WHERE running <= 0 AND next_allowed_at < ?', (now - 3600,))
+    return expired
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def queue_stats(window=300, now=None):
+    """Queue depth, throughput and lag over the last window seconds"""
+    now = time.time() if now is None else now
+    since = now - window
+    with db.connection() as conn:
+        counts = dict(conn.execute('SELECT status, COUNT(*) FROM job_queue GROUP BY status').fetchall())
+        oldest_due = conn.execute(
+            "SELECT MIN(run_at) FROM job_queue WHERE status = 'queued' AND run_at <= ?",
+            (now,)).fetchone()[0]
+        started = conn.execute(
+            '''SELECT started_at - run_at, started_at - scheduled_for FROM job_queue
+               WHERE started_at >= ? AND attempts = 1''', (since,)).fetchall()
+        finished = conn.execute(
+            'SELECT COUNT(*), AVG(finished_at - started_at) FROM job_queue WHERE finished_at >= ?',
+            (since,)).fetchone()
+        webhooks = dict(conn.execute(
+            'SELECT status, COUNT(*) FROM webhook_deliveries GROUP BY status').fetchall())
+    # Queue lag: due -> claimed. Schedule lag also includes the jitter.
+    queue_lags = [row[0] for row in started]
+    schedule_lags = [row[1] for row in started]
+    return {
+        'window_s': window,
+        'status_counts': counts,
+        'oldest_due_s': now - oldest_due if oldest_due is not None else 0.0,
+        'finished': finished[0],
+        'throughput_per_s': finished[0] / window,
+        'avg_run_s': finished[1],
+        'queue_lag_p50_s': _percentile(queue_lags, 50),
+        'queue_lag_p99_s': _percentile(queue_lags, 99),
+        'schedule_lag_p50_s': _percentile(schedule_lags, 50),
+        'schedule_lag_p99_s': _percentile(schedule_lags, 99),
+        'webhooks': webhooks,
+    }
+
+
+class WebhookSender:
+    """Delivers queued webhooks with exponential backoff, signed with the user's API key"""
+
+    def __init__(self, concurrency=WEBHOOK_CONCURRENCY, batch_size=50):
+        self.batch_size = batch_size
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='webhook')
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = USER_AGENT
+        self.worker = PeriodicWorker('webhooks', 1.0, self.deliver_due, drain_on_exit=False)
+
+    def _claim(self, now):
+        with db.transaction() as conn:
+            rows = conn.execute(
+                '''SELECT d.id, d.url, d.payload, d.attempts, u.api_key
+                   FROM webhook_deliveries d JOIN users u ON u.id = d.user_id
+                   WHERE d.status = 'pending' AND d.next_attempt_at <= ?
+                   ORDER BY d.next_attempt_at LIMIT ?''', (now, self.batch_size)).fetchall()
+            if rows:
+                # Lease them so another worker process does not send them too
+                conn.executemany('UPDATE webhook_deliveries SET next_attempt_at = ? WHERE id = ?',
+                                 [(now + WEBHOOK_TIMEOUT * 3, row[0]) for row in rows])
+        return rows
+
+    def _send(self, row):
+        delivery_id, url, payload, attempts, secret = row
+        body = payload.encode()
+        signature = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+        try:
+            response = self._session.post(url, data=body, timeout=WEBHOOK_TIMEOUT, headers={
+                'Content-Type': 'application/json',
+                'X-DataScrape-Delivery': str(delivery_id),
+                'X-DataScrape-Signature': f'sha256={signature}',
+            })
+        except requests.RequestException as e:
+            return str(e)
+        if 200 <= response.status_code < 300:
+            return None
+        return f'HTTP {response.status_code}'
+
+    def deliver_due(self, now=None):
+        now = time.time() if now is None else now
+        rows = self._claim(now)
+        if not rows:
+            return 0
+        errors = list(self._executor.map(self._send, rows))
+        updates = []
+        for row, error in zip(rows, errors):
+            attempts = row[3] + 1
+            if error is None:
+                status, next_attempt_at = 'delivered', now
+            elif attempts >= WEBHOOK_MAX_ATTEMPTS:
+                status, next_attempt_at = 'failed', now
+            else:
+                delay = min(WEBHOOK_MAX_BACKOFF, WEBHOOK_BACKOFF * 2 ** (attempts - 1))
+                status, next_attempt_at = 'pending', time.time() + delay * random.uniform(0.8, 1.2)
+            updates.append((status, attempts, next_attempt_at, error, row[0]))
+        with db.transaction() as conn:
+            conn.executemany(
+                '''UPDATE webhook_deliveries SET status = ?, attempts = ?, next_attempt_at = ?,
+                       last_error = ? WHERE id = ?''', updates)
+        return len(rows)
+
+
+class JobWorker:
+    """Claims queue items and scrapes them through the shared fetch engine
+
+    One JobWorker runs per worker process. Completions are recorded in one
+    transaction per loop iteration, together with their stored results,
+    host slot releases and webhook deliveries.
+    """
+
+    def __init__(self, tiers, name=None, concurrency=WORKER_CONCURRENCY):
+        self.tiers = tiers
+        self.name = name or f'worker-{os.getpid()}'
+        self.concurrency = concurrency
+        self.quota = QuotaManager(tiers)
+        self.webhooks = WebhookSender()
+
+    def _start(self, row, in_flight, finished):
+        queue_id, schedule_id, user_id, tier, url = row[:5]
+        cache_ttl = row[7]
+        charged = 0
+        try:
+            selectors = json.loads(row[6])
+            count = 1
+            if not self.tiers[tier]['cache_hits_count'] and scraper.is_cached(url, cache_ttl):
+                count = 0
+            # The queue already paces scheduled work, so only the monthly limit applies
+            decision = self.quota.consume(user_id, tier, count, burst=False)
+            if not decision:
+                finished.append((row, 'skipped', None, 'Monthly request limit reached'))
+                return
+            charged = count
+            # Fetch conditionally against the last run's fingerprint
+            with db.connection() as conn:
+                previous = fingerprints.load(conn, user_id, url, selectors)
+            validators = previous.validators() if previous is not None else None
+            page_cache = cache.get_caches()[0]
+            config = self.tiers[tier]
+            future = page_cache.submit(url, cache_ttl, validators=validators, max_bytes=config['max_page_bytes'],
+                                       max_seconds=config['max_fetch_seconds'])
+            # What was charged goes with the run, so a failed fetch refunds exactly that
+            in_flight[future] = (row, selectors, previous, charged)
+        except Exception as e:
+            # A malformed row fails on its own instead of taking the worker
+            # down, and with it every worker that claims it after the lease
+            logger.exception('%s could not start queue item %s', self.name, queue_id)
+            self.quota.refund(user_id, tier, charged)
+            finished.append((row, 'failed', None, f'Could not start job: {e}'))
+
+    def _result(self, future, entry):
+        row, selectors, previous, charged = entry
+        try:
+            page, status = future.result()
+            outcome = scraper.extract_incremental(page, status, selectors, previous) + (previous, selectors)
+        except Exception as e:
+            attempts = row[11] + 1
+            if isinstance(e, UNBILLED_ERRORS):
+                # The target failed; only a run that scrapes something is charged
+                self.quota.refund(row[2], row[3], charged)
+            # An oversized or disallowed page will be the same on the next attempt
+            if attempts < MAX_ATTEMPTS and not isinstance(e, (FetchLimitExceeded, RobotsDisallowed)):
+                # The outcome of a retry is the wait the target asked for, if any
+                return row, 'retry', getattr(e, 'retry_after', None), f'Scraping failed: {e}'
+            return row, 'failed', None, f'Scraping failed: {e}'
+        # The page may have expired, or been cached, since the run was charged
+        self.quota.settle(row[2], row[3], charged, status == 'hit')
+        return row, 'done', outcome, None
+
+    def _record(self, finished):
+        now = time.time()
+        usage = []
+        stored = []
+        changed = []
+        with db.transaction() as conn:
+            for row, status, outcome, error in finished:
+                (queue_id, schedule_id, user_id, tier, url, host, selectors,
+                 cache_ttl, webhook_url, scheduled_for, run_at, attempts) = row
+                if status == 'retry':
+                    conn.execute(
+                        '''UPDATE job_queue SET status = 'queued', run_at = ?, worker = NULL,
+                               leased_until = NULL, error = ? WHERE id = ?''',
+                        (now + max(RETRY_BACKOFF * 2 ** attempts, outcome or 0), error, queue_id))
+                else:
+                    conn.execute(
+                        '''UPDATE job_queue SET status = ?, finished_at = ?, leased_until = NULL,
+                               error = ? WHERE id = ?''', (status, now, error, queue_id))
+                    if schedule_id is not None:
+                        conn.execute('UPDATE scheduled_jobs SET last_run_at = ?, last_status = ? WHERE id = ?',
+                                     (now, status, schedule_id))
+                conn.execute('UPDATE host_slots SET running = MAX(running - 1, 0) WHERE host = ?',
+                             (host,))
+                if status == 'retry':
+                    continue
+                job_id = f'schedule-{schedule_id}' if schedule_id is not None else f'queue-{queue_id}'
+                payload = {'event': f'job.{status}', 'job_id': job_id, 'run_id': queue_id,
+                           'url': url, 'scheduled_for': scheduled_for, 'finished_at': now}
+                if status == 'done':
+                    results, cache_info, fingerprint, previous, selectors = outcome
+                    payload['data'] = results
+                    payload['cache'] = cache_info
+                    payload['fingerprint'] = fingerprint.as_dict()
+                    payload['changed'] = previous is None or previous.result_hash != fingerprint.result_hash
+                    if previous is not None:
+                        payload['changes'], payload['removed'] = fingerprints.diff(previous.results, results)
+                    if not fingerprint.same_as(previous):
+                        changed.append((user_id, url, selectors, fingerprint))
+                    stored.append((user_id, job_id, url, json.dumps(results), utc_timestamp()))
+                else:
+                    payload['error'] = error
+                body = json.dumps(payload)
+                if status == 'done':
+                    usage.append((user_id, tier, len(body)))
+                if webhook_url:
+                    conn.execute(
+                        '''INSERT INTO webhook_deliveries (queue_id, user_id, url, payload, next_attempt_at)
+                           VALUES (?, ?, ?, ?, ?)''', (queue_id, user_id, webhook_url, body, now))
+            if stored:
+                conn.executemany(result_store.INSERT_SQL, stored)
+            if changed:
+                fingerprints.save_many(conn, changed)
+        for user_id, tier, size in usage:
+            usage_logger.log(user_id, '/api/jobs', size, tier)
+        if any(row[8] and status != 'retry' for row, status, outcome, error in finished):
+            self.webhooks.worker.wake()
+
+    def run(self, stop):
+        """Process the queue until the stop event is set, then finish in-flight work"""
+        self.webhooks.worker.ensure_started()
+        in_flight = {}
+        next_tick = 0.0
+        while True:
+            stopping = stop.is_set()
+            if stopping and not in_flight:
+                break
+            now = time.time()
+            finished = []
+            if not stopping:
+                if now >= next_tick:
+                    try:
+                        enqueue_due(now)
+                        housekeeping(now)
+                    except Exception:
+                        logger.exception('%s scheduler tick failed', self.name)
+                    next_tick = now + SCHEDULER_INTERVAL
+                free = self.concurrency - len(in_flight)
+                if free > 0:
+                    for row in claim(self.name, free, now):
+                        self._start(row, in_flight, finished)
+            if in_flight:
+                done, _ = wait(in_flight, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finished.append(self._result(future, in_flight.pop(future)))
+            elif not finished:
+                stop.wait(POLL_INTERVAL)
+            if finished:
+                self._record(finished)
+        # Worker processes exit without running atexit handlers
+        self.quota.flush()
+        usage_logger.flush()
+
+
+def _worker_main(index, tiers, concurrency):
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    JobWorker(tiers, f'worker-{index}-{os.getpid()}', concurrency).run(stop)
+
+
+def run_pool(processes, concurrency=WORKER_CONCURRENCY, tiers=None):
+    """Run job worker processes until SIGTERM/SIGINT"""
+    if tiers is None:
+        from app import PRICING_TIERS as tiers
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=_worker_main, args=(i, tiers, concurrency), name=f'job-worker-{i}')
+               for i in range(processes)]
+    for worker in workers:
+        worker.start()
+
+    def shutdown(*_):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    for worker in workers:
+        worker.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Scheduled scrape job workers')
+    commands = parser.add_subparsers(dest='command', required=True)
+    worker = commands.add_parser('worker', help='run the worker pool')
+    worker.add_argument('--processes', type=int, default=os.cpu_count() or 2)
+    worker.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY,
+                        help='fetches in flight per process')
+    stats = commands.add_parser('stats', help='print queue depth, throughput and lag')
+    stats.add_argument('--window', type=int, default=300, help='seconds to aggregate over')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'worker':
+        from app import init_db
+        # Migrate once here, and fork the workers without open connections
+        init_db()
+        db.get_pool().close()
+        print(f"⚙️  Starting {args.processes} job workers, {args.concurrency} fetches in flight each")
+        run_pool(args.processes, args.concurrency)
+    else:
+        print(json.dumps(queue_stats(args.window), indent=2))
+
+
+if __name__ == '__main__':
+    main()
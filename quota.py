@@ -0,0 +1,228 @@
+"""
+Quota enforcement for DataScrape Pro
+In-memory token buckets and monthly counters, flushed to the state backend in batches
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+
+import instrumentation
+import state
+from background import PeriodicWorker
+
+# Seconds between batched flushes of local counters to the state backend
+FLUSH_INTERVAL = float(os.environ.get('DATASCRAPE_QUOTA_FLUSH_INTERVAL', 1.0))
+# A user's local, not yet flushed usage never exceeds this; reaching it
+# forces a synchronous flush. Over-admission across W workers is therefore
+# at most W * MAX_UNFLUSHED plus what other workers admit in one interval.
+MAX_UNFLUSHED = int(os.environ.get('DATASCRAPE_QUOTA_MAX_UNFLUSHED', 10))
+# Within this many requests of the monthly limit every admission is checked
+# and counted synchronously in the backend, so the limit itself is exact.
+SYNC_MARGIN = int(os.environ.get('DATASCRAPE_QUOTA_SYNC_MARGIN', 50))
+
+
+class QuotaDecision:
+    """Result of a quota check; truthy when the request is admitted"""
+
+    __slots__ = ('allowed', 'reason', 'retry_after', 'remaining')
+
+    def __init__(self, allowed, reason=None, retry_after=None, remaining=None):
+        self.allowed = allowed
+        self.reason = reason
+        self.retry_after = retry_after
+        self.remaining = remaining
+
+    def __bool__(self):
+        return self.allowed
+
+
+class _Account:
+    __slots__ = ('user_id', 'used', 'pending', 'monthly_reset', 'tokens', 'refilled_at', 'lock')
+
+    def __init__(self, user_id, used, monthly_reset):
+        self.user_id = user_id
+        # requests_used as last read from the backend, including our flushed usage
+        self.used = used
+        # usage admitted here but not yet written to the backend
+        self.pending = 0
+        self.monthly_reset = monthly_reset
+        self.tokens = None
+        self.refilled_at = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class QuotaManager:
+    """Admits requests against per-tier burst and monthly limits"""
+
+    def __init__(self, tiers):
+        self.tiers = tiers
+        self._accounts = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.flusher = PeriodicWorker('quota-flush', FLUSH_INTERVAL, self.flush)
+
+    def _load(self, user_id):
+        """Read usage, applying the monthly reset like the original check_rate_limit"""
+        quota = state.get_backend().load_quota(user_id)
+        if quota is None:
+            return None
+        return _Account(user_id, *quota)
+
+    def _account(self, user_id):
+        self._check_fork()
+        seen = account = self._accounts.get(user_id)
+        if account is None or datetime.now() > account.monthly_reset:
+            if account is not None:
+                with account.lock:
+                    self._flush_account(account)
+            account = self._load(user_id)
+            if account is None:
+                return None
+            with self._lock:
+                # Another thread may have loaded the account meanwhile; keep
+                # its copy so usage counted there is not lost
+                current = self._accounts.get(user_id)
+                if current is seen:
+                    self._accounts[user_id] = account
+                else:
+                    account = current
+        return account
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # Counters inherited from the parent are the parent's to flush
+            with self._lock:
+                self._accounts = {}
+                self._pid = os.getpid()
+        self.flusher.ensure_started()
+
+    def consume(self, user_id, tier, count=1, burst=True):
+        """Admit count requests for user_id, returning a QuotaDecision
+
+        burst=False skips the token bucket for work the service paces
+        itself, such as scheduled jobs; the monthly limit still applies.
+        """
+        config = self.tiers[tier]
+        account = self._account(user_id)
+        if account is None:
+            return QuotaDecision(False, 'unknown_user')
+        limit = config['requests_per_month']
+
+        with account.lock:
+            # Token bucket: burst capacity refilled at rate_per_second
+            now = time.monotonic()
+            capacity, rate = config['burst'], config['rate_per_second']
+            if account.tokens is None:
+                account.tokens = float(capacity)
+            else:
+                account.tokens = min(capacity, account.tokens + (now - account.refilled_at) * rate)
+            account.refilled_at = now
+            if burst and account.tokens < count:
+                retry_after = (count - account.tokens) / rate if count <= capacity else None
+                return QuotaDecision(False, 'burst', retry_after=retry_after)
+
+            if limit == -1:  # Unlimited
+                if burst:
+                    account.tokens -= count
+                return QuotaDecision(True, remaining='unlimited')
+
+            remaining = limit - account.used - account.pending
+            if remaining - count < SYNC_MARGIN:
+                decision = self._consume_sync(account, limit, count)
+            elif count > remaining:
+                decision = QuotaDecision(False, 'monthly', remaining=remaining)
+            else:
+                account.pending += count
+                decision = QuotaDecision(True, remaining=remaining - count)
+                if account.pending >= MAX_UNFLUSHED:
+                    self._flush_account(account)
+            if decision and burst:
+                account.tokens -= count
+            return decision
+
+    def _consume_sync(self, account, limit, count):
+        """Exact admission near the limit: conditional increment in the backend"""
+        admitted, used = state.get_backend().reserve(account.user_id, account.pending, count, limit)
+        account.pending = 0
+        account.used = used
+        if not admitted:
+            return QuotaDecision(False, 'monthly', remaining=max(0, limit - used))
+        return QuotaDecision(True, remaining=limit - used)
+
+    def _flush_account(self, account):
+        # Callers hold account.lock
+        updates = {account.user_id: account.pending} if account.pending else {}
+        used = state.get_backend().add_usage(updates, [account.user_id])
+        account.used = used.get(account.user_id, account.used + account.pending)
+        account.pending = 0
+
+    def flush(self):
+        """Write every account's pending usage in one batch and refresh totals"""
+        with self._flush_lock:
+            accounts = list(self._accounts.values())
+            if not accounts:
+                return
+            updates = []
+            for account in accounts:
+                with account.lock:
+                    if account.pending:
+                        updates.append((account.pending, account))
+                        account.pending = 0
+            try:
+                with instrumentation.span('quota-flush'):
+                    # Also picks up usage other workers and nodes flushed since our last read
+                    used = state.get_backend().add_usage(
+                        {account.user_id: pending for pending, account in updates},
+                        [account.user_id for account in accounts])
+            except Exception:
+                # Keep the usage for the next attempt rather than dropping it
+                for pending, account in updates:
+                    with account.lock:
+                        account.pending += pending
+                raise
+            for account in accounts:
+                with account.lock:
+                    if account.user_id in used:
+                        account.used = used[account.user_id]
+
+    def refund(self, user_id, tier, count=1):
+        """Give back count admitted requests that produced nothing, e.g. when the target was down"""
+        config = self.tiers[tier]
+        account = self._accounts.get(user_id)
+        # Unlimited tiers never counted the requests in the first place
+        if account is None or not count or config['requests_per_month'] == -1:
+            return
+        with account.lock:
+            # Negative pending usage is flushed like any other, but never
+            # takes the month's total below zero
+            account.pending = max(account.pending - count, -account.used)
+            if account.tokens is not None:
+                account.tokens = min(config['burst'], account.tokens + count)
+
+    def settle(self, user_id, tier, charged, cache_hit):
+        """Reconcile a charge made from a cache lookup with the status the fetch returned
+
+        Returns what the request now costs. A page that expired between
+        the lookup and the fetch is charged afterwards, without the token
+        bucket; at the monthly limit that one fetch goes uncharged.
+        """
+        if self.tiers[tier]['cache_hits_count']:
+            return charged
+        owed = 0 if cache_hit else 1
+        if owed < charged:
+            self.refund(user_id, tier, charged - owed)
+        elif owed > charged:
+            self.consume(user_id, tier, owed - charged, burst=False)
+        return owed
+
+    def forget(self, user_id):
+        """Drop cached state for a user, e.g. after a tier change"""
+        account = self._accounts.get(user_id)
+        if account is not None:
+            with account.lock:
+                self._flush_account(account)
+            with self._lock:
+                self._accounts.pop(user_id, None)
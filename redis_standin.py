@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Redis Stand-in - local stand-in for the Redis server shared by DataScrape Pro nodes
+In-memory RESP2/RESP3 server implementing the commands the shared state backend uses
+"""
+
+import argparse
+import socket
+import socketserver
+import threading
+import time
+
+
+class CommandError(Exception):
+    pass
+
+
+def _int(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise CommandError('ERR value is not an integer or out of range')
+
+
+def _float(value):
+    try:
+        return float(value)
+    except ValueError:
+        raise CommandError('ERR value is not a valid float')
+
+
+def _format_float(value):
+    return repr(value).encode() if value != int(value) else str(int(value)).encode()
+
+
+class Store:
+    """Keyspace with expiry and per-key versions for WATCH; callers hold lock"""
+
+    def __init__(self):
+        self.data = {}
+        self.expires = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def _expired(self, key):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.time():
+            self.data.pop(key, None)
+            del self.expires[key]
+            return True
+        return False
+
+    def get(self, key, kind=None):
+        if self._expired(key):
+            return None
+        value = self.data.get(key)
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise CommandError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.touch(key)
+
+    def touch(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def delete(self, key):
+        self.expires.pop(key, None)
+        self.touch(key)
+        return self.data.pop(key, None) is not None
+
+    def version(self, key):
+        self._expired(key)
+        return self.versions.get(key, 0)
+
+
+class Commands:
+    """One method per command; each returns a Python value the handler encodes as RESP"""
+
+    def __init__(self, store):
+        self.store = store
+        # Commands executed, for benchmarks
+        self.calls = 0
+
+    def ping(self, message=None):
+        return message if message is not None else 'PONG'
+
+    def echo(self, message):
+        return message
+
+    def select(self, index):
+        return 'OK'
+
+    def client(self, *args):
+        return 'OK'
+
+    def flushdb(self, *args):
+        self.store.data.clear()
+        self.store.expires.clear()
+        return 'OK'
+
+    flushall = flushdb
+
+    def dbsize(self):
+        return sum(1 for key in list(self.store.data) if not self.store._expired(key))
+
+    def get(self, key):
+        return self.store.get(key, bytes)
+
+    def set(self, key, value, *options):
+        options = [option.upper() for option in options]
+        if b'NX' in options and self.store.get(key) is not None:
+            return None
+        if b'XX' in options and self.store.get(key) is None:
+            return None
+        self.store.delete(key)
+        self.store.put(key, value)
+        for unit, scale in ((b'EX', 1), (b'PX', 0.001)):
+            if unit in options:
+                self.store.expires[key] = time.time() + _int(options[options.index(unit) + 1]) * scale
+        return 'OK'
+
+    def mget(self, *keys):
+        return [self.store.get(key) if isinstance(self.store.get(key), bytes) else None for key in keys]
+
+    def delete(self, *keys):
+        return sum(self.store.delete(key) for key in keys)
+
+    def exists(self, *keys):
+        return sum(self.store.get(key) is not None for key in keys)
+
+    def incrby(self, key, amount):
+        value = _int(self.store.get(key, bytes) or b'0') + _int(amount)
+        self.store.put(key, str(value).encode())
+        return value
+
+    def incr(self, key):
+        return self.incrby(key, b'1')
+
+    def decrby(self, key, amount):
+        return self.incrby(key, str(-_int(amount)).encode())
+
+    def decr(self, key):
+        return self.incrby(key, b'-1')
+
+    def incrbyfloat(self, key, amount):
+        value = _float(self.store.get(key, bytes) or b'0') + _float(amount)
+        encoded = _format_float(value)
+        self.store.put(key, encoded)
+        return encoded
+
+    def expire(self, key, seconds):
+        return self.expireat(key, str(time.time() + _int(seconds)).encode())
+
+    def expireat(self, key, timestamp):
+        if self.store.get(key) is None:
+            return 0
+        self.store.expires[key] = _float(timestamp)
+        return 1
+
+    def ttl(self, key):
+        if self.store.get(key) is None:
+            return -2
+        deadline = self.store.expires.get(key)
+        return -1 if deadline is None else max(0, int(deadline - time.time() + 0.5))
+
+    def _hash(self, key, create=False):
+        value = self.store.get(key, dict)
+        if value is None and create:
+            value = {}
+            self.store.put(key, value)
+        return value
+
+    def hset(self, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise CommandError("ERR wrong number of arguments for 'hset' command")
+        h = self._hash(key, create=True)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in h
+            h[field] = value
+        self.store.touch(key)
+        return added
+
+    def hsetnx(self, key, field, value):
+        h = self._hash(key, create=True)
+        if field in h:
+            return 0
+        h[field] = value
+        self.store.touch(key)
+        return 1
+
+    def hget(self, key, field):
+        return (self._hash(key) or {}).get(field)
+
+    def hmget(self, key, *fields):
+        h = self._hash(key) or {}
+        return [h.get(field) for field in fields]
+
+    def hgetall(self, key):
+        return dict(self._hash(key) or {})
+
+    def hvals(self, key):
+        return list((self._hash(key) or {}).values())
+
+    def hdel(self, key, *fields):
+        h = self._hash(key) or {}
+        removed = sum(h.pop(field, None) is not None for field in fields)
+        if removed:
+            self.store.touch(key)
+        return removed
+
+    def hincrby(self, key, field, amount):
+        h = self._hash(key, create=True)
+        value = _int(h.get(field, b'0')) + _int(amount)
+        h[field] = str(value).encode()
+        self.store.touch(key)
+        return value
+
+    def _list(self, key, create=False):
+        value = self.store.get(key, list)
+        if value is None and create:
+            value = []
+            self.store.put(key, value)
+        return value
+
+    def rpush(self, key, *values):
+        items = self._list(key, create=True)
+        items.extend(values)
+        self.store.touch(key)
+        return len(items)
+
+    def llen(self, key):
+        return len(self._list(key) or [])
+
+    def lrange(self, key, start, stop):
+        items = self._list(key) or []
+        start, stop = _int(start), _int(stop)
+        if start < 0:
+            start = max(0, len(items) + start)
+        if stop < 0:
+            stop = len(items) + stop
+        return items[start:stop + 1]
+
+    def ltrim(self, key, start, stop):
+        items = self._list(key)
+        if items is not None:
+            kept = self.lrange(key, start, stop)
+            if kept:
+                items[:] = kept
+                self.store.touch(key)
+            else:
+                self.store.delete(key)
+        return 'OK'
+
+
+class StandinHandler(socketserver.StreamRequestHandler):
+    """One client connection: parses RESP arrays and runs them under the store lock"""
+
+    def setup(self):
+        super().setup()
+        # Pipelined replies are written one by one; don't let Nagle hold them back
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        commands = self.server.commands
+        store = commands.store
+        queued = None
+        watched = {}
+        self.protocol = 2
+        while True:
+            try:
+                args = self._read_command()
+            except (ConnectionError, ValueError):
+                return
+            if args is None:
+                return
+            name = args[0].decode().lower()
+            try:
+                if name == 'hello':
+                    if len(args) > 1 and args[1] not in (b'2', b'3'):
+                        raise CommandError('NOPROTO unsupported protocol version')
+                    self.protocol = int(args[1]) if len(args) > 1 else self.protocol
+                    reply = {b'server': b'redis', b'version': b'7.2.0', b'proto': self.protocol,
+                             b'mode': b'standalone', b'role': b'master', b'modules': []}
+                elif name == 'multi':
+                    queued = []
+                    reply = 'OK'
+                elif name == 'watch':
+                    with store.lock:
+                        watched.update((key, store.version(key)) for key in args[1:])
+                    reply = 'OK'
+                elif name == 'unwatch':
+                    watched = {}
+                    reply = 'OK'
+                elif name == 'discard':
+                    queued, watched = None, {}
+                    reply = 'OK'
+                elif name == 'exec':
+                    if queued is None:
+                        raise CommandError('ERR EXEC without MULTI')
+                    with store.lock:
+                        if any(store.version(key) != version for key, version in watched.items()):
+                            reply = None
+                        else:
+                            reply = [self._run(commands, command) for command in queued]
+                    queued, watched = None, {}
+                elif queued is not None:
+                    queued.append(args)
+                    reply = 'QUEUED'
+                else:
+                    with store.lock:
+                        reply = self._run(commands, args)
+                        if isinstance(reply, CommandError):
+                            raise reply
+            except CommandError as e:
+                reply = e
+            self.wfile.write(self._encode(reply))
+            self.wfile.flush()
+
+    def _run(self, commands, args):
+        commands.calls += 1
+        name = args[0].decode().lower()
+        method = getattr(commands, 'delete' if name == 'del' else name, None)
+        if method is None or name.startswith('_'):
+            return CommandError(f"ERR unknown command '{name}'")
+        try:
+            return method(*args[1:])
+        except CommandError as e:
+            return e
+        except TypeError:
+            return CommandError(f"ERR wrong number of arguments for '{name}' command")
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            # Inline command, e.g. from telnet or redis-cli --no-raw PING
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def _encode(self, value):
+        if value is None:
+            return b'_\r\n' if self.protocol == 3 else b'$-1\r\n'
+        if isinstance(value, CommandError):
+            return b'-' + str(value).encode() + b'\r\n'
+        if isinstance(value, str):
+            return b'+' + value.encode() + b'\r\n'
+        if isinstance(value, bool) or isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, bytes):
+            return b'$%d\r\n%s\r\n' % (len(value), value)
+        if isinstance(value, dict):
+            items = [item for pair in value.items() for item in pair]
+            if self.protocol == 3:
+                return b'%%%d\r\n' % len(value) + b''.join(self._encode(item) for item in items)
+            value = items
+        return b'*%d\r\n' % len(value) + b''.join(self._encode(item) for item in value)
+
+
+class RedisStandin:
+    """Threaded RESP server on loopback for tests and multi-node benchmarks"""
+
+    def __init__(self, port=0, host='127.0.0.1'):
+        self.server = socketserver.ThreadingTCPServer((host, port), StandinHandler, bind_and_activate=False)
+        self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        self.server.server_bind()
+        self.server.server_activate()
+        self.server.commands = Commands(Store())
+        self.port = self.server.server_address[1]
+
+    @property
+    def calls(self):
+        return self.server.commands.calls
+
+    @property
+    def url(self):
+        return f'redis://127.0.0.1:{self.port}/0'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=6390)
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args()
+    standin = RedisStandin(args.port, args.host)
+    print(f"🧪 Redis stand-in on redis://{args.host}:{args.port}/0")
+    standin.server.serve_forever()
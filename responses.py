@@ -0,0 +1,195 @@
+"""
+Response encoding for DataScrape Pro
+Bodies serialized once as JSON (orjson when installed) or MessagePack and compressed as the client accepts
+"""
+
+import functools
+import importlib
+import json
+import os
+import zlib
+from importlib.util import find_spec
+
+from flask import Response, request
+from flask.json.provider import DefaultJSONProvider
+
+# orjson, msgpack, brotli and zstandard are optional and imported on first
+# use, so importing the app does not load them
+HAS_MSGPACK = find_spec('msgpack') is not None
+
+# Smaller bodies go out uncompressed: the savings would not pay for the CPU
+COMPRESS_MIN_BYTES = int(os.environ.get('DATASCRAPE_COMPRESS_MIN_BYTES', 1024))
+# Levels that favor speed; large results are repetitive and compress well
+# anyway. gzip level 1 is about four times faster than 6 for a 20% larger body.
+GZIP_LEVEL = int(os.environ.get('DATASCRAPE_GZIP_LEVEL', 1))
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+JSON = 'application/json'
+NDJSON = 'application/x-ndjson'
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+
+# Codings this server can produce, best first on a tie in the client's q-values
+ENCODINGS = tuple(name for name, module in (('zstd', 'zstandard'), ('br', 'brotli'), ('gzip', 'zlib'))
+                  if find_spec(module) is not None)
+
+
+@functools.lru_cache(maxsize=None)
+def _orjson():
+    """(orjson.dumps, its options), or None without orjson"""
+    try:
+        import orjson
+    except ImportError:
+        return None
+    # Keep Flask's formats for dates and dataclasses; orjson handles the rest natively
+    return orjson.dumps, orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+
+def preload():
+    """Import the installed encoders now, e.g. in a master before it forks workers"""
+    _orjson()
+    for name in ('msgpack', 'zstandard', 'brotli'):
+        if find_spec(name) is not None:
+            importlib.import_module(name)
+
+
+def dumps(obj, default=None):
+    """Compact JSON bytes of obj, in insertion order"""
+    fast = _orjson()
+    if fast is not None:
+        encode, options = fast
+        try:
+            return encode(obj, default=default, option=options)
+        except TypeError:
+            # e.g. integers beyond 64 bits, which json handles
+            pass
+    return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider on top of dumps(): compact and unsorted, so jsonify() is one fast pass"""
+
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            kwargs.setdefault('sort_keys', self.sort_keys)
+            return super().dumps(obj, **kwargs)
+        return dumps(obj, self.default).decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj, self.default) + b'\n', mimetype=self.mimetype)
+
+
+def negotiate_type(default=JSON):
+    """The MessagePack type the client's Accept prefers, if msgpack is installed, else default"""
+    if not HAS_MSGPACK or not request.accept_mimetypes:
+        return default
+    return request.accept_mimetypes.best_match((default,) + MSGPACK_TYPES, default)
+
+
+def negotiate_encoding():
+    """The content coding to compress with for this request, or None"""
+    accepted = request.accept_encodings
+    best, best_quality = None, 0
+    for name in ENCODINGS:
+        quality = accepted.quality(name)
+        if quality > best_quality:
+            best, best_quality = name, quality
+    return best
+
+
+def serialize(obj, mimetype):
+    if mimetype in MSGPACK_TYPES:
+        import msgpack
+        return msgpack.packb(obj, use_bin_type=True)
+    return dumps(obj)
+
+
+def compress(body, encoding):
+    if encoding == 'zstd':
+        import zstandard
+        # Compressors are not thread-safe; creating one is cheap
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    if encoding == 'br':
+        import brotli
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def respond(obj, status=200):
+    """Response with obj serialized and compressed as negotiated
+
+    The body is encoded exactly once; its content_length is what goes on
+    the wire, for usage accounting.
+    """
+    mimetype = negotiate_type()
+    body = serialize(obj, mimetype)
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    encoding = negotiate_encoding() if len(body) >= COMPRESS_MIN_BYTES else None
+    if encoding is not None:
+        body = compress(body, encoding)
+        headers['Content-Encoding'] = encoding
+    return Response(body, status, headers, mimetype=mimetype)
+
+
+class StreamCompressor:
+    """Compresses a streamed body, flushing after every chunk so records are not held back"""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'zstd':
+            import zstandard
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        elif encoding == 'br':
+            import brotli
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, chunk):
+        if self.encoding == 'zstd':
+            return (self._compressor.compress(chunk) +
+                    self._compressor.flush(self._flush_mode))
+        if self.encoding == 'br':
+            return self._compressor.process(chunk) + self._compressor.flush()
+        return self._compressor.compress(chunk) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class RecordStream:
+    """Encoder for a streamed response of records: NDJSON, or MessagePack objects back to back
+
+    Construct it while the request is active; encode() and finish() may
+    then run in the response generator.
+    """
+
+    def __init__(self):
+        self.mimetype = negotiate_type(NDJSON)
+        encoding = negotiate_encoding()
+        self.compressor = StreamCompressor(encoding) if encoding is not None else None
+        self.headers = {'Vary': 'Accept, Accept-Encoding'}
+        if encoding is not None:
+            self.headers['Content-Encoding'] = encoding
+
+    def encode(self, record):
+        """Wire bytes of one record"""
+        if self.mimetype in MSGPACK_TYPES:
+            import msgpack
+            return self.chunk(msgpack.packb(record, use_bin_type=True))
+        return self.chunk(dumps(record) + b'\n')
+
+    def chunk(self, data):
+        """Wire bytes of already encoded data"""
+        return self.compressor.compress(data) if self.compressor is not None else data
+
+    def finish(self):
+        """Wire bytes that end the stream"""
+        return self.compressor.finish() if self.compressor is not None else b''
@@ -0,0 +1,59 @@
+"""
+Scrape result storage for DataScrape Pro
+Persists extraction results off the request path so they can be exported later
+"""
+
+import json
+import os
+
+import db
+from background import BufferedWriter
+from usage_log import utc_timestamp
+
+BUFFER_SIZE = int(os.environ.get('DATASCRAPE_RESULTS_BUFFER', 50_000))
+BATCH_SIZE = int(os.environ.get('DATASCRAPE_RESULTS_BATCH', 200))
+FLUSH_INTERVAL = float(os.environ.get('DATASCRAPE_RESULTS_FLUSH_INTERVAL', 1.0))
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS scrape_results (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        job_id TEXT,
+        url TEXT NOT NULL,
+        data TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )''',
+    # Entries are ordered by (user_id, rowid), which is exactly the export's keyset order
+    'CREATE INDEX IF NOT EXISTS idx_scrape_results_user ON scrape_results (user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_scrape_results_user_job ON scrape_results (user_id, job_id)',
+)
+
+INSERT_SQL = 'INSERT INTO scrape_results (user_id, job_id, url, data, created_at) VALUES (?, ?, ?, ?, ?)'
+
+
+def create_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+class ResultWriter(BufferedWriter):
+    """Buffers scrape results and inserts them in batches"""
+
+    def __init__(self, buffer_size=BUFFER_SIZE, batch_size=BATCH_SIZE, interval=FLUSH_INTERVAL):
+        super().__init__('results-flush', buffer_size, batch_size, interval)
+
+    def store(self, user_id, job_id, url, data):
+        self.store_many(user_id, job_id, [(url, data)])
+
+    def store_many(self, user_id, job_id, items):
+        """Queue (url, data) results of one user and job"""
+        timestamp = utc_timestamp()
+        self.append_many([(user_id, job_id, url, json.dumps(data), timestamp) for url, data in items])
+
+    def write_batch(self, batch):
+        with db.transaction() as conn:
+            conn.executemany(INSERT_SQL, batch)
+
+
+result_writer = ResultWriter()
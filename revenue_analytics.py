@@ -4,45 +4,19 @@ Revenue Analytics Script - Track and optimize DataScrape Pro profitability
 Run this script to analyze revenue trends and suggest optimizations
 """
 
-import sqlite3
 import json
 from datetime import datetime, timedelta
 import pandas as pd
 
+import analytics
+
 def analyze_revenue():
     """Analyze current revenue and provide optimization suggestions"""
-    conn = sqlite3.connect('datascrape.db')
-    
-    # Revenue analysis
-    revenue_query = """
-    SELECT 
-        r.tier,
-        COUNT(r.user_id) as subscribers,
-        SUM(r.amount) as total_revenue,
-        AVG(r.amount) as avg_revenue_per_user
-    FROM revenue r 
-    WHERE r.payment_date > date('now', '-30 days')
-    GROUP BY r.tier
-    """
-    
-    revenue_df = pd.read_sql_query(revenue_query, conn)
-    
-    # Usage analysis
-    usage_query = """
-    SELECT 
-        u.tier,
-        COUNT(au.id) as api_calls,
-        AVG(au.response_size) as avg_response_size,
-        u.requests_used
-    FROM users u
-    LEFT JOIN api_usage au ON u.id = au.user_id
-    WHERE au.timestamp > date('now', '-7 days') OR au.timestamp IS NULL
-    GROUP BY u.tier
-    """
-    
-    usage_df = pd.read_sql_query(usage_query, conn)
-    
-    conn.close()
+    # Metrics come from the incremental columnar snapshot; only rows added
+    # since the last run are read from SQLite
+    metrics = analytics.analyze()
+    revenue_df = pd.DataFrame(metrics['revenue_by_tier'])
+    usage_df = pd.DataFrame(metrics['usage_by_tier'])
     
     print("📊 DataScrape Pro Revenue Analysis")
     print("=" * 50)
@@ -63,6 +37,18 @@ def analyze_revenue():
     if not usage_df.empty:
         print(usage_df.to_string(index=False))
     
+    conversion = metrics['conversion']
+    print(f"\n🔁 Conversion: {conversion['converted']}/{conversion['signups']} users paid "
+          f"({conversion['rate'] * 100:.1f}%)")
+    
+    print("\n👥 Cohorts (by signup month):")
+    if metrics['cohorts']:
+        print(pd.DataFrame(metrics['cohorts']).tail(12).to_string(index=False))
+    
+    print("\n📉 Paid user churn (monthly, by API activity):")
+    if metrics['churn']:
+        print(pd.DataFrame(metrics['churn']).tail(6).to_string(index=False))
+    
     # Optimization suggestions
     print("\n🚀 Revenue Optimization Suggestions:")
     
@@ -92,7 +78,10 @@ def analyze_revenue():
     return {
         'current_mrr': total_mrr,
         'target_progress': total_mrr / 3000 * 100,
-        'revenue_by_tier': revenue_df.to_dict('records') if not revenue_df.empty else [],
+        'revenue_by_tier': metrics['revenue_by_tier'],
+        'cohorts': metrics['cohorts'],
+        'churn': metrics['churn'],
+        'conversion': conversion,
         'suggestions': 'Focus on user acquisition' if total_mrr < 100 else 'Optimize conversion' if total_mrr < 500 else 'Scale enterprise'
     }
 
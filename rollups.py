@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Usage rollups for DataScrape Pro
+Indexes, hourly/daily api_usage aggregates kept current on write, and raw-row retention
+"""
+
+import argparse
+from collections import defaultdict
+
+import db
+
+# Raw api_usage rows and hourly rollups older than this are compacted away;
+# daily rollups are kept forever.
+RAW_RETENTION_DAYS = 90
+HOURLY_RETENTION_DAYS = 35
+DELETE_CHUNK = 10_000
+
+SCHEMA = (
+    'CREATE INDEX IF NOT EXISTS idx_api_usage_timestamp ON api_usage (timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_api_usage_user_timestamp ON api_usage (user_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_revenue_payment_date ON revenue (payment_date)',
+    'CREATE INDEX IF NOT EXISTS idx_revenue_user ON revenue (user_id)',
+    'CREATE INDEX IF NOT EXISTS idx_users_tier ON users (tier)',
+    '''CREATE TABLE IF NOT EXISTS usage_hourly (
+        hour TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        endpoint TEXT NOT NULL,
+        tier TEXT NOT NULL,
+        calls INTEGER NOT NULL DEFAULT 0,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (hour, user_id, endpoint, tier)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS usage_daily (
+        day TEXT NOT NULL,
+        user_id INTEGER NOT NULL,
+        endpoint TEXT NOT NULL,
+        tier TEXT NOT NULL,
+        calls INTEGER NOT NULL DEFAULT 0,
+        bytes INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, user_id, endpoint, tier)
+    ) WITHOUT ROWID''',
+    'CREATE INDEX IF NOT EXISTS idx_usage_daily_tier_day ON usage_daily (tier, day)',
+)
+
+UPSERT_HOURLY = '''INSERT INTO usage_hourly (hour, user_id, endpoint, tier, calls, bytes)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (hour, user_id, endpoint, tier)
+    DO UPDATE SET calls = calls + excluded.calls, bytes = bytes + excluded.bytes'''
+
+UPSERT_DAILY = '''INSERT INTO usage_daily (day, user_id, endpoint, tier, calls, bytes)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (day, user_id, endpoint, tier)
+    DO UPDATE SET calls = calls + excluded.calls, bytes = bytes + excluded.bytes'''
+
+
+def create_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+
+
+def apply_rollups(conn, events):
+    """Fold (user_id, endpoint, timestamp, response_size, tier) events into the rollups"""
+    missing = {event[0] for event in events if event[4] is None}
+    tiers = {}
+    if missing:
+        ids = list(missing)
+        tiers = dict(conn.execute(f'SELECT id, tier FROM users WHERE id IN ({",".join("?" * len(ids))})',
+                                  ids).fetchall())
+
+    hourly = defaultdict(lambda: [0, 0])
+    daily = defaultdict(lambda: [0, 0])
+    for user_id, endpoint, timestamp, response_size, tier in events:
+        size = response_size or 0
+        tier = tier or tiers.get(user_id) or 'unknown'
+        # timestamp is 'YYYY-MM-DD HH:MM:SS' UTC, as CURRENT_TIMESTAMP writes it
+        h = hourly[(timestamp[:13] + ':00:00', user_id, endpoint, tier)]
+        h[0] += 1
+        h[1] += size
+        d = daily[(timestamp[:10], user_id, endpoint, tier)]
+        d[0] += 1
+        d[1] += size
+    conn.executemany(UPSERT_HOURLY, [key + tuple(v) for key, v in hourly.items()])
+    conn.executemany(UPSERT_DAILY, [key + tuple(v) for key, v in daily.items()])
+
+
+def backfill_rollups(conn):
+    """Rebuild both rollups from raw api_usage, attributing rows to the user's current tier
+
+    Only days the raw rows still cover in full are rebuilt. Once compact_usage
+    has run, the daily rollups before them are the only record left, and the
+    oldest remaining day may have lost its first hours.
+    """
+    first = conn.execute('SELECT substr(MIN(timestamp), 1, 10) FROM api_usage').fetchone()[0]
+    if first is None:
+        return
+    if conn.execute('SELECT 1 FROM usage_daily WHERE day <= ? LIMIT 1', (first,)).fetchone():
+        # History reaches back to or past the oldest raw row: keep that day as recorded
+        first = conn.execute("SELECT date(?, '+1 day')", (first,)).fetchone()[0]
+    start = first + ' 00:00:00'
+    conn.execute('DELETE FROM usage_hourly WHERE hour >= ?', (start,))
+    conn.execute('DELETE FROM usage_daily WHERE day >= ?', (first,))
+    conn.execute('''INSERT INTO usage_hourly (hour, user_id, endpoint, tier, calls, bytes)
+        SELECT strftime('%Y-%m-%d %H:00:00', au.timestamp), au.user_id, COALESCE(au.endpoint, ''),
+               COALESCE(u.tier, 'unknown'), COUNT(*), COALESCE(SUM(au.response_size), 0)
+        FROM api_usage au LEFT JOIN users u ON u.id = au.user_id
+        WHERE au.user_id IS NOT NULL AND au.timestamp >= ?
+        GROUP BY 1, 2, 3, 4''', (start,))
+    conn.execute('''INSERT INTO usage_daily (day, user_id, endpoint, tier, calls, bytes)
+        SELECT substr(hour, 1, 10), user_id, endpoint, tier, SUM(calls), SUM(bytes)
+        FROM usage_hourly WHERE hour >= ? GROUP BY 1, 2, 3, 4''', (start,))
+
+
+def compact_usage(raw_days=RAW_RETENTION_DAYS, hourly_days=HOURLY_RETENTION_DAYS):
+    """Delete raw rows and hourly rollups past retention, in short transactions"""
+    deleted = 0
+    while True:
+        with db.transaction() as conn:
+            count = conn.execute('''DELETE FROM api_usage WHERE id IN (
+                SELECT id FROM api_usage WHERE timestamp < datetime('now', ?) LIMIT ?)''',
+                                 (f'-{raw_days} days', DELETE_CHUNK)).rowcount
+        deleted += count
+        if count < DELETE_CHUNK:
+            break
+    with db.transaction() as conn:
+        conn.execute("DELETE FROM usage_hourly WHERE hour < strftime('%Y-%m-%d %H:00:00', 'now', ?)",
+                     (f'-{hourly_days} days',))
+    return deleted
+
+
+if __name__ == '__main__':
+    # Only the retention job prunes fingerprints; importing it at the top would load the fetch stack
+    import fingerprints
+
+    parser = argparse.ArgumentParser(description='Compact raw api_usage rows and stale fingerprints past retention')
+    parser.add_argument('--raw-days', type=int, default=RAW_RETENTION_DAYS)
+    parser.add_argument('--hourly-days', type=int, default=HOURLY_RETENTION_DAYS)
+    parser.add_argument('--fingerprint-days', type=int, default=fingerprints.RETENTION_DAYS)
+    parser.add_argument('--backfill', action='store_true', help='rebuild rollups from the raw rows still kept first')
+    args = parser.parse_args()
+    if args.backfill:
+        with db.transaction() as conn:
+            backfill_rollups(conn)
+    removed = compact_usage(args.raw_days, args.hourly_days)
+    print(f"🧹 Removed {removed} raw api_usage rows older than {args.raw_days} days")
+    pruned = fingerprints.prune(args.fingerprint_days)
+    print(f"🧹 Removed {pruned} fingerprints not updated for {args.fingerprint_days} days")
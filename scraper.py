@@ -0,0 +1,158 @@
+"""
+Scrape pipeline for DataScrape Pro
+Fetches pages through the response cache and extracts data with CSS selectors
+"""
+
+import codecs
+import hashlib
+from concurrent.futures import as_completed
+
+import cache
+import fetcher
+import instrumentation
+from extraction import apply_limits, extract, streaming_extractor
+from fingerprints import Fingerprint, result_hash
+
+
+def extract_page(page, selectors):
+    """Extract from a cached page, reusing results for identical content"""
+    page_cache, extraction_cache = cache.get_caches()
+    results = extraction_cache.get(page.content_hash, selectors)
+    if results is not None:
+        return results, True
+    results = extract(page.text, selectors)
+    extraction_cache.put(page.content_hash, selectors, results)
+    return results, False
+
+
+def is_cached(url, ttl=None):
+    """True if url can be served from the page cache without fetching"""
+    return cache.get_caches()[0].peek_fresh(url, ttl)
+
+
+def scrape(url, selectors, timeout=fetcher.DEFAULT_TIMEOUT, ttl=None, max_bytes=None, max_seconds=None):
+    """Fetch url and extract selectors from it, returning (results, cache_info)"""
+    with instrumentation.span('fetch'):
+        page, status = cache.get_caches()[0].fetch(url, ttl, timeout, None, max_bytes, max_seconds)
+    results, extraction_hit = extract_page(page, selectors)
+    return results, {'page': status, 'extraction': extraction_hit}
+
+
+def extract_incremental(page, status, selectors, previous=None):
+    """Like extract_page, but reuse previous results when the body is unchanged
+
+    page is None when the target answered 304 to previous's validators.
+    Returns (results, cache_info, Fingerprint).
+    """
+    if page is None:
+        return previous.results, {'page': status, 'extraction': True}, previous
+    if previous is not None and page.content_hash == previous.body_hash:
+        fingerprint = Fingerprint(page.content_hash, previous.result_hash, previous.results,
+                                  page.etag, page.last_modified)
+        return previous.results, {'page': status, 'extraction': True}, fingerprint
+    results, extraction_hit = extract_page(page, selectors)
+    return results, {'page': status, 'extraction': extraction_hit}, Fingerprint.of(page, results)
+
+
+def scrape_incremental(url, selectors, previous=None, timeout=fetcher.DEFAULT_TIMEOUT, ttl=None,
+                       max_bytes=None, max_seconds=None):
+    """scrape() against the caller's last Fingerprint for (url, selectors)
+
+    The fingerprint's validators make the fetch conditional even when the
+    page is not cached in this process, and an unchanged body skips parsing.
+    """
+    validators = previous.validators() if previous is not None else None
+    with instrumentation.span('fetch'):
+        page, status = cache.get_caches()[0].fetch(url, ttl, timeout, validators, max_bytes, max_seconds)
+    return extract_incremental(page, status, selectors, previous)
+
+
+class StreamConsumer:
+    """Decodes a body chunk by chunk into a streaming extractor, hashing what it reads"""
+
+    def __init__(self, selectors, limits=None):
+        self.selectors = selectors
+        self.limits = limits
+        self.extractor = None
+        self.digest = hashlib.blake2b(digest_size=16)
+        self.decoder = None
+        self.results = None
+
+    def start(self, response):
+        # Built here so the parser lives on the fetch thread that feeds it
+        self.extractor = streaming_extractor(self.selectors, self.limits)
+        try:
+            factory = codecs.getincrementaldecoder(response.encoding or 'utf-8')
+        except LookupError:
+            factory = codecs.getincrementaldecoder('utf-8')
+        self.decoder = factory(errors='replace')
+
+    def feed(self, chunk):
+        self.digest.update(chunk)
+        return self.extractor.feed(self.decoder.decode(chunk))
+
+    def close(self):
+        tail = self.decoder.decode(b'', final=True)
+        if tail:
+            self.extractor.feed(tail)
+        self.results = self.extractor.close()
+
+
+def scrape_streaming(url, selectors, limits=None, previous=None, timeout=fetcher.DEFAULT_TIMEOUT,
+                     max_bytes=None, max_seconds=None):
+    """Extract selectors while the page downloads, without caching or keeping the body
+
+    Reading stops once every selector has limits[key] matches, and a body
+    past max_bytes or max_seconds is cut off rather than failing. Returns
+    (results, cache_info, Fingerprint) like scrape_incremental; validators
+    and the body hash are only kept when the whole body was read, so a later
+    full scrape never gets a 304 or an extraction reuse for a partial result.
+    """
+    validators = previous.validators() if previous is not None else None
+    headers = cache.conditional_headers(*validators) if validators else None
+    consumer = StreamConsumer(selectors, limits)
+    with instrumentation.span('fetch'):
+        response, size, truncated = fetcher.get_engine().stream(
+            url, consumer, headers or None, timeout, max_bytes, max_seconds).result()
+    if response.status_code == 304 and headers:
+        return (apply_limits(previous.results, limits),
+                {'page': 'not_modified', 'extraction': True, 'streamed': True}, previous)
+
+    results = consumer.results
+    stopped = consumer.extractor.done
+    complete = not truncated and not stopped
+    # Results cut short by a limit or the cap do not describe the body, even
+    # when all of it arrived: without a body hash a later full scrape of the
+    # same page extracts again instead of reusing them
+    fingerprint = Fingerprint(consumer.digest.hexdigest() if complete else '', result_hash(results), results,
+                              response.headers.get('ETag') if complete else None,
+                              response.headers.get('Last-Modified') if complete else None)
+    cache_info = {'page': 'streamed', 'extraction': False, 'streamed': True,
+                  'bytes': size, 'stopped_early': stopped, 'truncated': truncated}
+    return results, cache_info, fingerprint
+
+
+def scrape_many(jobs, timeout=fetcher.DEFAULT_TIMEOUT, max_bytes=None, max_seconds=None):
+    """Scrape (url, selectors, ttl) jobs concurrently
+
+    Yields (index, results, cache_info, error) as each job finishes.
+    """
+    page_cache = cache.get_caches()[0]
+    futures = {}
+    for index, (url, selectors, ttl) in enumerate(jobs):
+        futures[page_cache.submit(url, ttl, timeout, None, max_bytes, max_seconds)] = (index, selectors)
+
+    try:
+        for future in as_completed(futures):
+            index, selectors = futures[future]
+            try:
+                page, status = future.result()
+                results, extraction_hit = extract_page(page, selectors)
+            except Exception as e:
+                yield index, None, None, e
+            else:
+                yield index, results, {'page': status, 'extraction': extraction_hit}, None
+    finally:
+        # The client may disconnect mid-stream; drop fetches still queued
+        for future in futures:
+            future.cancel()
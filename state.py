@@ -0,0 +1,432 @@
+"""
+Shared state backends for DataScrape Pro
+Users, quota counters, usage events and dashboard totals in local SQLite or a Redis shared by every node
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import db
+import rollups
+
+# 'sqlite' keeps everything in DATASCRAPE_DB (one node); a redis:// URL moves
+# users, quota, usage counters and the page cache to a server all nodes share
+STATE_URL = os.environ.get('DATASCRAPE_STATE', 'sqlite')
+# Key prefix, so several deployments can share one Redis
+KEY_PREFIX = os.environ.get('DATASCRAPE_STATE_PREFIX', 'ds:')
+# Length of a monthly quota window, matching users.monthly_reset in SQLite
+QUOTA_PERIOD = 30 * 24 * 3600
+# Journal entries copied into SQLite per drain transaction
+DRAIN_BATCH = 500
+
+USAGE_INSERT_SQL = 'INSERT INTO api_usage (user_id, endpoint, timestamp, response_size) VALUES (?, ?, ?, ?)'
+
+
+def _parse_reset(value):
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _utc_now():
+    """Same format as SQLite's CURRENT_TIMESTAMP"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+
+class SQLiteState:
+    """State in the service's own SQLite file, for a single node (the default)"""
+
+    shared = False
+
+    def get_user(self, api_key, conn=None):
+        if conn is None:
+            with db.connection() as conn:
+                return self.get_user(api_key, conn)
+        return conn.execute('SELECT * FROM users WHERE api_key = ?', (api_key,)).fetchone()
+
+    def create_user(self, api_key, tier, price, requests_used=0):
+        with db.transaction() as conn:
+            user_id = conn.execute('INSERT INTO users (api_key, tier, requests_used) VALUES (?, ?, ?)',
+                                   (api_key, tier, requests_used)).lastrowid
+            # Record revenue if paid tier
+            if price > 0:
+                conn.execute('INSERT INTO revenue (user_id, amount, tier) VALUES (?, ?, ?)',
+                             (user_id, price, tier))
+        return user_id
+
+    def change_tier(self, user_id, tier, price):
+        with db.transaction() as conn:
+            conn.execute('UPDATE users SET tier = ? WHERE id = ?', (tier, user_id))
+            if price > 0:
+                conn.execute('INSERT INTO revenue (user_id, amount, tier) VALUES (?, ?, ?)',
+                             (user_id, price, tier))
+
+    def count_users(self):
+        with db.connection() as conn:
+            return conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def load_quota(self, user_id):
+        """(requests_used, monthly_reset), applying the monthly reset, or None"""
+        with db.transaction() as conn:
+            row = conn.execute('SELECT monthly_reset, requests_used FROM users WHERE id = ?',
+                               (user_id,)).fetchone()
+            if row is None:
+                return None
+            monthly_reset, requests_used = _parse_reset(row[0]), row[1] or 0
+            if monthly_reset is None or datetime.now() > monthly_reset:
+                new_reset = datetime.now() + timedelta(days=30)
+                if monthly_reset is None:
+                    # Set initial reset date
+                    conn.execute('UPDATE users SET monthly_reset = ? WHERE id = ?', (new_reset, user_id))
+                else:
+                    # Reset usage
+                    conn.execute('UPDATE users SET requests_used = 0, monthly_reset = ? WHERE id = ?',
+                                 (new_reset, user_id))
+                    requests_used = 0
+                monthly_reset = new_reset
+        return requests_used, monthly_reset
+
+    def reserve(self, user_id, pending, count, limit):
+        """Add pending usage, then count more only if that stays within limit
+
+        Returns (admitted, requests_used).
+        """
+        with db.transaction() as conn:
+            if pending:
+                conn.execute('UPDATE users SET requests_used = requests_used + ? WHERE id = ?',
+                             (pending, user_id))
+            used = conn.execute('SELECT requests_used FROM users WHERE id = ?', (user_id,)).fetchone()[0]
+            admitted = used + count <= limit
+            if admitted and count:
+                conn.execute('UPDATE users SET requests_used = requests_used + ? WHERE id = ?',
+                             (count, user_id))
+                used += count
+        return admitted, used
+
+    def add_usage(self, updates, user_ids):
+        """Apply {user_id: count} increments and return {user_id: requests_used} for user_ids"""
+        with db.transaction() as conn:
+            if updates:
+                # Refunds flush as negative counts; a month's total never drops below zero
+                conn.executemany('UPDATE users SET requests_used = MAX(requests_used + ?, 0) WHERE id = ?',
+                                 [(count, user_id) for user_id, count in updates.items()])
+            # Pick up usage other workers have flushed since our last read
+            used = {}
+            for i in range(0, len(user_ids), 500):
+                chunk = user_ids[i:i + 500]
+                used.update(conn.execute(
+                    f'SELECT id, requests_used FROM users WHERE id IN ({",".join("?" * len(chunk))})',
+                    chunk).fetchall())
+        return {user_id: value or 0 for user_id, value in used.items()}
+
+    def write_usage(self, batch):
+        """Persist (user_id, endpoint, timestamp, response_size, tier) events"""
+        with db.transaction() as conn:
+            conn.executemany(USAGE_INSERT_SQL, [event[:4] for event in batch])
+            # Keep the hourly/daily rollups current in the same transaction
+            rollups.apply_rollups(conn, batch)
+
+    def dashboard_totals(self):
+        """Users per tier, 30-day revenue and API calls in the last 24 hours"""
+        with db.connection() as conn:
+            user_tiers = dict(conn.execute('SELECT tier, COUNT(*) FROM users GROUP BY tier').fetchall())
+            monthly_revenue = conn.execute(
+                'SELECT SUM(amount) FROM revenue WHERE payment_date > date("now", "-30 days")').fetchone()[0] or 0
+            # Last 24 hourly buckets, independent of how large api_usage grows
+            daily_api_calls = conn.execute(
+                'SELECT COALESCE(SUM(calls), 0) FROM usage_hourly '
+                'WHERE hour >= strftime("%Y-%m-%d %H:00:00", "now", "-23 hours")').fetchone()[0]
+        return user_tiers, monthly_revenue, daily_api_calls
+
+    def page_store(self):
+        """Shared page-cache tier, or None to use DATASCRAPE_CACHE_DB only"""
+        return None
+
+
+class RedisState:
+    """State shared by every node through one Redis (or Redis-compatible) server
+
+    Each monthly quota window is its own counter key, so a reset needs no
+    read-modify-write and every admission is a single atomic INCRBY. Users,
+    tier changes, revenue and usage events are also appended to a journal
+    that `python state.py drain` copies into the local SQLite for analytics,
+    exports and scheduled jobs.
+    """
+
+    shared = True
+
+    def __init__(self, url=STATE_URL, prefix=KEY_PREFIX):
+        # Imported here so single-node deployments never load it
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('DATASCRAPE_STATE=redis://... needs the redis package (pip install redis)')
+        # redis-py's connection pool reconnects by itself after fork()
+        self.client = redis.Redis.from_url(url, health_check_interval=30)
+        self.prefix = prefix
+        # Quota window anchors never change once set, so every process caches them
+        self._anchors = {}
+
+    def key(self, *parts):
+        return self.prefix + ':'.join(str(part) for part in parts)
+
+    def _journal(self, pipe, *entries):
+        pipe.rpush(self.key('journal'), *[json.dumps(entry) for entry in entries])
+
+    def _add_revenue(self, pipe, user_id, price, tier, timestamp):
+        day_key = self.key('revenue', timestamp[:10])
+        pipe.incrbyfloat(day_key, price)
+        pipe.expire(day_key, 32 * 24 * 3600)
+        self._journal(pipe, ['revenue', user_id, price, tier, timestamp])
+
+    def get_user(self, api_key, conn=None):
+        fields = self.client.hmget(self.key('user', api_key), 'id', 'tier', 'created_at')
+        if fields[0] is None:
+            return None
+        # Same column order as the SQLite users row
+        return (int(fields[0]), api_key, fields[1].decode(), fields[2].decode(), None, None, None)
+
+    def create_user(self, api_key, tier, price, requests_used=0):
+        user_id = self.client.incr(self.key('next-user-id'))
+        timestamp = _utc_now()
+        pipe = self.client.pipeline()
+        pipe.hset(self.key('user', api_key), mapping={'id': user_id, 'tier': tier, 'created_at': timestamp})
+        pipe.set(self.key('user-key', user_id), api_key)
+        pipe.hincrby(self.key('tiers'), tier, 1)
+        self._journal(pipe, ['user', user_id, api_key, tier, timestamp, requests_used])
+        if price > 0:
+            self._add_revenue(pipe, user_id, price, tier, timestamp)
+        if requests_used:
+            anchor = time.time()
+            pipe.hset(self.key('user', api_key), 'anchor', anchor)
+            pipe.set(self.key('used', user_id, 0), requests_used, ex=2 * QUOTA_PERIOD)
+        pipe.execute()
+        return user_id
+
+    def change_tier(self, user_id, tier, price):
+        api_key = self.client.get(self.key('user-key', user_id))
+        if api_key is None:
+            return
+        user_key = self.key('user', api_key.decode())
+
+        def update(pipe):
+            # WATCH keeps the per-tier totals exact under concurrent changes
+            old = pipe.hget(user_key, 'tier')
+            pipe.multi()
+            pipe.hset(user_key, 'tier', tier)
+            if old is not None:
+                pipe.hincrby(self.key('tiers'), old.decode(), -1)
+            pipe.hincrby(self.key('tiers'), tier, 1)
+            timestamp = _utc_now()
+            self._journal(pipe, ['tier', user_id, tier])
+            if price > 0:
+                self._add_revenue(pipe, user_id, price, tier, timestamp)
+
+        self.client.transaction(update, user_key)
+
+    def count_users(self):
+        return sum(int(count) for count in self.client.hvals(self.key('tiers')))
+
+    def _anchor(self, user_id):
+        anchor = self._anchors.get(user_id)
+        if anchor is None:
+            api_key = self.client.get(self.key('user-key', user_id))
+            if api_key is None:
+                return None
+            user_key = self.key('user', api_key.decode())
+            # The window starts at first use, like the initial monthly_reset
+            pipe = self.client.pipeline()
+            pipe.hsetnx(user_key, 'anchor', time.time())
+            pipe.hget(user_key, 'anchor')
+            anchor = self._anchors[user_id] = float(pipe.execute()[1])
+        return anchor
+
+    def _window(self, user_id):
+        anchor = self._anchor(user_id)
+        return anchor, int((time.time() - anchor) // QUOTA_PERIOD)
+
+    def _used_key(self, user_id):
+        return self.key('used', user_id, self._window(user_id)[1])
+
+    def _incr(self, pipe, key, count):
+        pipe.incrby(key, count)
+        pipe.expire(key, 2 * QUOTA_PERIOD)
+
+    def load_quota(self, user_id):
+        if self._anchor(user_id) is None:
+            return None
+        anchor, window = self._window(user_id)
+        used = int(self.client.get(self.key('used', user_id, window)) or 0)
+        return used, datetime.fromtimestamp(anchor + (window + 1) * QUOTA_PERIOD)
+
+    def reserve(self, user_id, pending, count, limit):
+        key = self._used_key(user_id)
+        if not pending and not count:
+            used = int(self.client.get(key) or 0)
+            return used <= limit, used
+        pipe = self.client.pipeline()
+        self._incr(pipe, key, pending + count)
+        used = pipe.execute()[0]
+        if used > limit:
+            if count:
+                # Give the slot back; nodes racing here may briefly under-admit,
+                # but the window never goes past its limit
+                used = self.client.decrby(key, count)
+            return False, used
+        return True, used
+
+    def add_usage(self, updates, user_ids):
+        pipe = self.client.pipeline(transaction=False)
+        for user_id, count in updates.items():
+            self._incr(pipe, self._used_key(user_id), count)
+        keys = [self._used_key(user_id) for user_id in user_ids]
+        for i in range(0, len(keys), 500):
+            pipe.mget(keys[i:i + 500])
+        replies = pipe.execute()[2 * len(updates):]
+        values = [value for reply in replies for value in reply]
+        return {user_id: int(value or 0) for user_id, value in zip(user_ids, values)}
+
+    def write_usage(self, batch):
+        calls = {}
+        for event in batch:
+            hour = event[2][:13]
+            calls[hour] = calls.get(hour, 0) + 1
+        pipe = self.client.pipeline(transaction=False)
+        for hour, count in calls.items():
+            hour_key = self.key('calls', hour)
+            pipe.incrby(hour_key, count)
+            pipe.expire(hour_key, 2 * 24 * 3600)
+        self._journal(pipe, ['usage', batch])
+        pipe.execute()
+
+    def dashboard_totals(self):
+        now = datetime.now(timezone.utc)
+        days = [(now - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(31)]
+        hours = [(now - timedelta(hours=i)).strftime('%Y-%m-%d %H') for i in range(24)]
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hgetall(self.key('tiers'))
+        pipe.mget([self.key('revenue', day) for day in days])
+        pipe.mget([self.key('calls', hour) for hour in hours])
+        tiers, revenue, calls = pipe.execute()
+        user_tiers = {tier.decode(): int(count) for tier, count in tiers.items() if int(count)}
+        return (user_tiers, sum(float(value) for value in revenue if value),
+                sum(int(value) for value in calls if value))
+
+    def page_store(self):
+        import cache
+        return cache.RedisCache(self.client, self.key('page', ''))
+
+    def drain(self, batch=DRAIN_BATCH):
+        """Copy journal entries into the local SQLite; returns how many were applied
+
+        Run from a single process: entries are trimmed only after they commit.
+        """
+        journal = self.key('journal')
+        applied = 0
+        while True:
+            entries = self.client.lrange(journal, 0, batch - 1)
+            if not entries:
+                return applied
+            with db.transaction() as conn:
+                for entry in entries:
+                    kind, *args = json.loads(entry)
+                    if kind == 'user':
+                        user_id, api_key, tier, created_at, requests_used = args
+                        conn.execute('''INSERT OR IGNORE INTO users (id, api_key, tier, created_at, requests_used)
+                                        VALUES (?, ?, ?, ?, ?)''', (user_id, api_key, tier, created_at, requests_used))
+                    elif kind == 'tier':
+                        conn.execute('UPDATE users SET tier = ? WHERE id = ?', (args[1], args[0]))
+                    elif kind == 'revenue':
+                        conn.execute('INSERT INTO revenue (user_id, amount, tier, payment_date) VALUES (?, ?, ?, ?)',
+                                     args)
+                    elif kind == 'usage':
+                        events = [tuple(event) for event in args[0]]
+                        conn.executemany(USAGE_INSERT_SQL, [event[:4] for event in events])
+                        rollups.apply_rollups(conn, events)
+            self.client.ltrim(journal, len(entries), -1)
+            applied += len(entries)
+
+    def migrate(self):
+        """Load the local SQLite users, quota counters and recent totals into Redis"""
+        with db.connection() as conn:
+            users = conn.execute('SELECT id, api_key, tier, created_at, requests_used, monthly_reset '
+                                 'FROM users').fetchall()
+            revenue = conn.execute('''SELECT date(payment_date), SUM(amount) FROM revenue
+                                      WHERE payment_date > date("now", "-31 days") GROUP BY 1''').fetchall()
+            calls = conn.execute('''SELECT substr(hour, 1, 13), SUM(calls) FROM usage_hourly
+                                    WHERE hour >= strftime("%Y-%m-%d %H:00:00", "now", "-23 hours")
+                                    GROUP BY 1''').fetchall()
+        pipe = self.client.pipeline()
+        tiers = {}
+        for user_id, api_key, tier, created_at, requests_used, monthly_reset in users:
+            user = {'id': user_id, 'tier': tier, 'created_at': str(created_at)}
+            monthly_reset = _parse_reset(monthly_reset)
+            if monthly_reset is not None and monthly_reset > datetime.now():
+                # Keep the current window and what was used in it
+                user['anchor'] = monthly_reset.timestamp() - QUOTA_PERIOD
+                pipe.set(self.key('used', user_id, 0), requests_used or 0, ex=2 * QUOTA_PERIOD)
+            pipe.hset(self.key('user', api_key), mapping=user)
+            pipe.set(self.key('user-key', user_id), api_key)
+            tiers[tier] = tiers.get(tier, 0) + 1
+        pipe.delete(self.key('tiers'))
+        if tiers:
+            pipe.hset(self.key('tiers'), mapping=tiers)
+        if users:
+            pipe.set(self.key('next-user-id'), max(user[0] for user in users))
+        for day, amount in revenue:
+            pipe.set(self.key('revenue', day), amount, ex=32 * 24 * 3600)
+        for hour, count in calls:
+            pipe.set(self.key('calls', hour), count, ex=2 * 24 * 3600)
+        pipe.execute()
+        return len(users)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(url=STATE_URL):
+    if url == 'sqlite':
+        return SQLiteState()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisState(url)
+    raise ValueError(f'Unsupported DATASCRAPE_STATE {url!r}; use sqlite or a redis:// URL')
+
+
+def get_backend():
+    """Return the process-wide backend selected by DATASCRAPE_STATE"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = create_backend()
+    return _backend
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the shared state of a multi-node deployment')
+    sub = parser.add_subparsers(dest='command', required=True)
+    drain = sub.add_parser('drain', help='copy users, revenue and usage from Redis into the local SQLite')
+    drain.add_argument('--follow', action='store_true', help='keep draining every --interval seconds')
+    drain.add_argument('--interval', type=float, default=5.0)
+    sub.add_parser('migrate', help='load the local SQLite users and quota into Redis')
+    args = parser.parse_args()
+
+    backend = get_backend()
+    if not backend.shared:
+        parser.error('DATASCRAPE_STATE is sqlite; set it to the shared redis:// URL')
+    # The local schema may be newer than this SQLite file, e.g. on a fresh node
+    from app import init_db
+    init_db()
+    if args.command == 'migrate':
+        print(f'Migrated {backend.migrate()} users to {STATE_URL}')
+    else:
+        while True:
+            applied = backend.drain()
+            if applied:
+                print(f'Drained {applied} journal entries into {db.DATABASE_PATH}')
+            if not args.follow:
+                break
+            time.sleep(args.interval)
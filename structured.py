@@ -0,0 +1,348 @@
+"""
+Structured data extraction for DataScrape Pro
+JSON-LD, microdata, OpenGraph and embedded JSON state read in one pass over the page, queried with JSONPath
+"""
+
+import functools
+import html
+import json
+import re
+
+import instrumentation
+
+SOURCES = ('jsonld', 'microdata', 'opengraph', 'embedded')
+
+# Each source is found by scanning for its own tags; nothing else in the page is parsed
+SCRIPT_RE = re.compile(r'<script\b([^>]*)>(.*?)</script\s*>', re.I | re.S)
+META_RE = re.compile(r'<meta\b([^>]*)>', re.I)
+ATTR_RE = re.compile(r'''([^\s=/>"']+)(?:\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+)))?''')
+ITEM_TAG_RE = re.compile(r'<([a-zA-Z][^\s/>]*)(\s[^>]*?\bitem(?:scope|prop)\b[^>]*)>')
+STRIP_TAGS_RE = re.compile(r'<[^>]*>')
+
+# Inline state assignments such as window.__INITIAL_STATE__ = {...}
+ASSIGNMENT_RE = re.compile(
+    r'(?:\b(?:window|self|globalThis)\s*\.\s*|\b(?:var|let|const)\s+)([A-Za-z_$][\w$]*)\s*=\s*'
+    r'(JSON\.parse\(\s*)?')
+JS_STRING_RE = re.compile(r'''"((?:[^"\\]|\\.)*)"|'((?:[^'\\]|\\.)*)\'''', re.S)
+
+VOID_TAGS = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+                       'param', 'source', 'track', 'wbr'))
+# Where a microdata property takes its value from instead of the element's text
+PROPERTY_ATTRIBUTES = {
+    'meta': 'content', 'a': 'href', 'area': 'href', 'link': 'href', 'audio': 'src', 'embed': 'src',
+    'iframe': 'src', 'img': 'src', 'source': 'src', 'track': 'src', 'video': 'src', 'object': 'data',
+    'data': 'value', 'meter': 'value', 'time': 'datetime',
+}
+
+_decoder = json.JSONDecoder()
+
+
+def parse_attributes(text):
+    attributes = {name.lower(): value or single or bare for name, value, single, bare in ATTR_RE.findall(text)}
+    if '&' in text:
+        attributes = {name: html.unescape(value) for name, value in attributes.items()}
+    return attributes
+
+
+def _loads(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+def _js_string(match):
+    """Value of a JavaScript string literal that is also valid JSON once requoted"""
+    double, single = match.groups()
+    if double is not None:
+        return _loads('"' + double + '"')
+    requoted = re.sub(r'\\(.)|"', lambda m: '\\"' if m.group(0) == '"' else
+                      (m.group(1) if m.group(1) == "'" else m.group(0)), single)
+    return _loads('"' + requoted + '"')
+
+
+def _embedded_state(script, found):
+    for match in ASSIGNMENT_RE.finditer(script):
+        name, parse_call = match.groups()
+        start = match.end()
+        if parse_call:
+            # window.__STATE__ = JSON.parse("...")
+            literal = JS_STRING_RE.match(script, start)
+            encoded = _js_string(literal) if literal else None
+            value = _loads(encoded) if isinstance(encoded, str) else None
+        elif start < len(script) and script[start] in '{[':
+            try:
+                value = _decoder.raw_decode(script, start)[0]
+            except ValueError:
+                # JavaScript object literals (unquoted keys, undefined, ...) are not data
+                value = None
+        else:
+            value = None
+        if value is not None:
+            found.setdefault(name, value)
+
+
+def _element_end(text, tag, start, limit):
+    """Where the element whose start tag ends at start closes, counting nested same-name tags"""
+    pattern = _tag_pattern(tag)
+    depth = 1
+    for match in pattern.finditer(text, start, limit):
+        depth += -1 if match.group(1) else 1
+        if depth == 0:
+            return match.start(), match.end()
+    # Unclosed, e.g. a <p> ended by its parent
+    return limit, limit
+
+
+@functools.lru_cache(maxsize=64)
+def _tag_pattern(tag):
+    return re.compile(r'<(/?)' + re.escape(tag) + r'(?=[\s/>])[^>]*>', re.I)
+
+
+def _microdata(text, start):
+    """Top-level microdata items
+
+    Only the tags carrying itemscope or itemprop are visited; an element's
+    extent is found by matching its own tag name, so no tree is built.
+    """
+    items = []
+    # Enclosing items as (end offset, item), innermost last
+    scopes = []
+    for match in ITEM_TAG_RE.finditer(text, start):
+        tag, attrs = match.group(1).lower(), match.group(2)
+        while scopes and scopes[-1][0] <= match.start():
+            scopes.pop()
+        attributes = parse_attributes(attrs)
+        names = attributes.get('itemprop', '').split()
+        owner = scopes[-1][1] if scopes else None
+        void = tag in VOID_TAGS or attrs.endswith('/')
+        limit = scopes[-1][0] if scopes else len(text)
+        if 'itemscope' in attributes:
+            item = {'type': attributes.get('itemtype', '').split(), 'properties': {}}
+            if attributes.get('itemid'):
+                item['id'] = attributes['itemid']
+            if names and owner is not None:
+                _add_property(owner, names, item)
+            elif not names:
+                items.append(item)
+            if not void:
+                scopes.append((_element_end(text, tag, match.end(), limit)[1], item))
+        elif names and owner is not None:
+            if tag in PROPERTY_ATTRIBUTES:
+                value = attributes.get(PROPERTY_ATTRIBUTES[tag], '')
+            elif void:
+                value = ''
+            else:
+                content = text[match.end():_element_end(text, tag, match.end(), limit)[0]]
+                value = ' '.join(html.unescape(STRIP_TAGS_RE.sub(' ', content)).split())
+            _add_property(owner, names, value)
+    return items
+
+
+def _add_property(owner, names, value):
+    for name in names:
+        owner['properties'].setdefault(name, []).append(value)
+
+
+def extract_structured(text, sources=SOURCES):
+    """{'jsonld': [...], 'microdata': [...], 'opengraph': {...}, 'embedded': {...}} for sources"""
+    data = {source: [] if source in ('jsonld', 'microdata') else {} for source in sources}
+    if 'jsonld' in data or 'embedded' in data:
+        for match in SCRIPT_RE.finditer(text):
+            attributes = parse_attributes(match.group(1))
+            kind = attributes.get('type', '').lower().split(';')[0].strip()
+            body = match.group(2).strip()
+            if kind == 'application/ld+json':
+                if 'jsonld' in data:
+                    # Some sites wrap the block in an HTML comment or CDATA section
+                    value = _loads(re.sub(r'^\s*(?:<!--|<!\[CDATA\[)|(?:-->|\]\]>)\s*$', '', body))
+                    if isinstance(value, list):
+                        data['jsonld'].extend(value)
+                    elif value is not None:
+                        data['jsonld'].append(value)
+            elif 'embedded' in data:
+                if kind == 'application/json':
+                    value = _loads(body)
+                    if value is not None:
+                        data['embedded'].setdefault(attributes.get('id') or f'json-{len(data["embedded"])}', value)
+                elif kind in ('', 'text/javascript', 'application/javascript', 'module') and '=' in body:
+                    _embedded_state(body, data['embedded'])
+    if 'opengraph' in data:
+        for match in META_RE.finditer(text):
+            attrs = match.group(1)
+            if 'og:' not in attrs:
+                continue
+            attributes = parse_attributes(attrs)
+            prop = attributes.get('property') or attributes.get('name') or ''
+            if prop.startswith('og:') and 'content' in attributes:
+                key = prop[3:]
+                previous = data['opengraph'].get(key)
+                if previous is None:
+                    data['opengraph'][key] = attributes['content']
+                elif isinstance(previous, list):
+                    previous.append(attributes['content'])
+                else:
+                    data['opengraph'][key] = [previous, attributes['content']]
+    if 'microdata' in data:
+        start = text.find('itemscope')
+        if start != -1:
+            data['microdata'] = _microdata(text, text.rfind('<', 0, start))
+    return data
+
+
+class JSONPath:
+    """A compiled JSONPath: $, .key, ['key'], [n], [*], .., and [?(@.key op value)] filters"""
+
+    TOKEN_RE = re.compile(r'''
+        (?P<descend>\.\.)
+      | \.(?P<name>[^.\[\]\s]+)
+      | \[\s*(?P<quoted>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")\s*\]
+      | \[\s*(?P<index>-?\d+)\s*\]
+      | \[\s*(?P<wildcard>\*)\s*\]
+      | \[\s*\?\(\s*(?P<filter>.+?)\s*\)\s*\]
+    ''', re.X)
+    NAME_RE = re.compile(r'(?P<name>[^.\[\]\s]+)')
+    FILTER_RE = re.compile(r'''@(?P<path>(?:\.[^.\[\]\s=!<>]+|\[\s*(?:'[^']*'|"[^"]*"|-?\d+)\s*\])*)
+                               \s*(?:(?P<op>==|!=|<=|>=|<|>)\s*(?P<value>'[^']*'|"[^"]*"|[^\s)]+))?$''', re.X)
+
+    def __init__(self, expression):
+        self.expression = expression
+        if not expression.startswith('$'):
+            raise ValueError(f'JSONPath {expression!r} must start with $')
+        self.steps = self._parse(expression[1:])
+        self.root = self.steps[0][1] if self.steps and self.steps[0][0] == 'key' else None
+
+    def _parse(self, text):
+        steps = []
+        pos = 0
+        descend = False
+        while pos < len(text):
+            match = self.TOKEN_RE.match(text, pos)
+            if match is None:
+                # $..name has no dot of its own before the name
+                match = self.NAME_RE.match(text, pos) if descend else None
+                if match is None:
+                    raise ValueError(f'Invalid JSONPath {self.expression!r} at {text[pos:]!r}')
+            pos = match.end()
+            groups = match.groupdict()
+            if groups.get('descend'):
+                descend = True
+                continue
+            if groups.get('name') is not None:
+                step = ('all', None) if groups['name'] == '*' else ('key', groups['name'])
+            elif groups.get('quoted') is not None:
+                step = ('key', json.loads('"' + groups['quoted'][1:-1].replace('"', '\\"') + '"')
+                        if groups['quoted'][0] == "'" else json.loads(groups['quoted']))
+            elif groups.get('index') is not None:
+                step = ('index', int(groups['index']))
+            elif groups.get('wildcard') is not None:
+                step = ('all', None)
+            else:
+                step = ('filter', self._parse_filter(groups['filter']))
+            steps.append(('descend', step) if descend else step)
+            descend = False
+        if descend:
+            raise ValueError(f'Invalid JSONPath {self.expression!r}: trailing ..')
+        return steps
+
+    def _parse_filter(self, text):
+        match = self.FILTER_RE.match(text)
+        if match is None:
+            raise ValueError(f'Unsupported JSONPath filter {text!r}')
+        path = JSONPath('$' + match.group('path'))
+        value = match.group('value')
+        if value is not None:
+            try:
+                value = json.loads(value if value[0] != "'" else '"' + value[1:-1] + '"')
+            except ValueError:
+                raise ValueError(f'Invalid JSONPath filter value {value!r}')
+        return path, match.group('op'), value
+
+    def find(self, data):
+        """Every value the path matches, in document order"""
+        nodes = [data]
+        for step in self.steps:
+            if step[0] == 'descend':
+                nodes = [node for root in nodes for node in _descendants(root)]
+                step = step[1]
+            nodes = [value for node in nodes for value in _apply(step, node)]
+        return nodes
+
+
+def _descendants(node):
+    yield node
+    children = node.values() if isinstance(node, dict) else node if isinstance(node, list) else ()
+    for child in children:
+        yield from _descendants(child)
+
+
+def _apply(step, node):
+    kind, arg = step
+    if kind == 'key':
+        if isinstance(node, dict) and arg in node:
+            yield node[arg]
+    elif kind == 'index':
+        if isinstance(node, list) and -len(node) <= arg < len(node):
+            yield node[arg]
+    elif kind == 'all':
+        yield from node.values() if isinstance(node, dict) else node if isinstance(node, list) else ()
+    else:
+        children = node.values() if isinstance(node, dict) else node if isinstance(node, list) else ()
+        for child in children:
+            if _matches(arg, child):
+                yield child
+
+
+def _matches(condition, node):
+    path, op, expected = condition
+    for value in path.find(node):
+        if op is None:
+            return True
+        # '@type' and friends are often lists; match any member
+        for candidate in value if isinstance(value, list) else (value,):
+            try:
+                if ((op == '==' and candidate == expected) or (op == '!=' and candidate != expected)
+                        or (op == '<' and candidate < expected) or (op == '<=' and candidate <= expected)
+                        or (op == '>' and candidate > expected) or (op == '>=' and candidate >= expected)):
+                    return True
+            except TypeError:
+                continue
+    return False
+
+
+def is_path(selector):
+    """True for JSONPath selectors; CSS selectors never start with $"""
+    return isinstance(selector, str) and selector.startswith('$')
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_path(expression):
+    return JSONPath(expression)
+
+
+def needed_sources(paths):
+    """The sources the paths can reach; the microdata walk is skipped unless asked for"""
+    sources = set()
+    for path in paths:
+        root = compile_path(path).root
+        if root not in SOURCES:
+            return SOURCES
+        sources.add(root)
+    return tuple(source for source in SOURCES if source in sources)
+
+
+def query(text, paths):
+    """{key: [matches]} for {key: JSONPath} over the page's structured data"""
+    with instrumentation.span('structured'):
+        data = extract_structured(text, needed_sources(paths.values()))
+        return {key: compile_path(path).find(data) for key, path in paths.items()}
+
+
+def validate(selectors):
+    """Compile every JSONPath selector, raising ValueError for a malformed one"""
+    for key, selector in (selectors or {}).items():
+        if is_path(selector):
+            try:
+                compile_path(selector)
+            except ValueError as e:
+                raise ValueError(f'selector {key!r}: {e}')
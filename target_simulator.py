@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Target Site Simulator - local stand-in for the websites DataScrape Pro scrapes
+Serves synthetic HTML pages with configurable size, latency and error rate, optionally streamed without end
+"""
+
+import argparse
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+def iter_page(size, seed=0):
+    """Parts of a synthetic HTML page of roughly size bytes, endless if size is 0"""
+    rng = random.Random(seed)
+    head = (f'<html><head><title>Synthetic page {seed}</title>'
+            f'<meta name="description" content="Simulated target page {seed}"></head><body>'
+            f'<h1>Products {seed}</h1>')
+    yield head
+    total = len(head)
+    i = 0
+    while not size or total < size:
+        item = (f'<div class="item" id="item-{i}"><h2>Item {i}</h2>'
+                f'<span class="price">${rng.randint(1, 999)}.{rng.randint(0, 99):02d}</span>'
+                f'<a href="/item/{i}">details</a><p>{"lorem ipsum " * rng.randint(1, 8)}</p></div>')
+        yield item
+        total += len(item)
+        i += 1
+    yield '</body></html>'
+
+
+def build_page(size, seed=0):
+    """Build a synthetic HTML page of roughly size bytes"""
+    return ''.join(iter_page(size, seed)).encode()
+
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        sim = self.server.simulator
+        params = parse_qs(urlsplit(self.path).query, keep_blank_values=True)
+        latency = float(params.get('latency', [sim.latency])[0])
+        size = int(params.get('size', [sim.page_size])[0])
+        error_rate = float(params.get('error_rate', [sim.error_rate])[0])
+        retry_after = params.get('retry_after', [None])[0]
+
+        if latency > 0:
+            time.sleep(latency)
+        with sim.lock:
+            sim.requests += 1
+        if error_rate and random.random() < error_rate:
+            self.send_response(503)
+            if retry_after is not None:
+                self.send_header('Retry-After', retry_after)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if 'stream' in params:
+            self._stream(size)
+            return
+
+        body = sim.page(size)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up waiting
+            self.close_connection = True
+
+    def _stream(self, size):
+        """Generate the page while sending it, chunked; size=0 never ends"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        buffered, pending = 0, []
+        try:
+            for part in iter_page(size):
+                pending.append(part.encode())
+                buffered += len(pending[-1])
+                if buffered >= 64 * 1024:
+                    chunk = b''.join(pending)
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                    buffered, pending = 0, []
+            chunk = b''.join(pending)
+            if chunk:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            # The client stopped reading
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TargetSimulator:
+    """Threaded HTTP server serving synthetic pages on all loopback addresses
+
+    Every 127.0.0.x address reaches the same server, so benchmarks can spread
+    load across many distinct "hosts" with host_url(n).
+    """
+
+    def __init__(self, port=0, latency=0.0, page_size=20_000, error_rate=0.0):
+        self.latency = latency
+        self.page_size = page_size
+        self.error_rate = error_rate
+        self.requests = 0
+        self.lock = threading.Lock()
+        self._pages = {}
+        self.server = ThreadingHTTPServer(('0.0.0.0', port), SimulatorHandler)
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 1024
+        self.server.simulator = self
+        self.port = self.server.server_address[1]
+
+    def page(self, size):
+        body = self._pages.get(size)
+        if body is None:
+            body = self._pages[size] = build_page(size)
+        return body
+
+    def host_url(self, n=1, path='/'):
+        return f'http://127.0.0.{n % 254 + 1}:{self.port}{path}'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before responding')
+    parser.add_argument('--size', type=int, default=20_000, help='page size in bytes')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503 responses')
+    args = parser.parse_args()
+    sim = TargetSimulator(args.port, args.latency, args.size, args.error_rate)
+    print(f"🎯 Target simulator on {sim.host_url(0)} (latency={args.latency}s, size={args.size}B)")
+    sim.server.serve_forever()
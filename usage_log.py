@@ -0,0 +1,45 @@
+"""
+Usage event pipeline for DataScrape Pro
+Ring-buffered api_usage events written off the request path in batches
+"""
+
+import os
+import time
+
+import instrumentation
+import state
+from background import BufferedWriter
+
+# Events held in memory before the oldest are dropped
+BUFFER_SIZE = int(os.environ.get('DATASCRAPE_USAGE_BUFFER', 100_000))
+# Flush as soon as this many events are waiting...
+BATCH_SIZE = int(os.environ.get('DATASCRAPE_USAGE_BATCH', 500))
+# ...or at least this often
+FLUSH_INTERVAL = float(os.environ.get('DATASCRAPE_USAGE_FLUSH_INTERVAL', 1.0))
+
+def utc_timestamp():
+    """Same format as SQLite's CURRENT_TIMESTAMP"""
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+
+
+class UsageLogger(BufferedWriter):
+    """Buffers api_usage events and hands them to the state backend in batches"""
+
+    def __init__(self, buffer_size=BUFFER_SIZE, batch_size=BATCH_SIZE, interval=FLUSH_INTERVAL):
+        super().__init__('usage-flush', buffer_size, batch_size, interval)
+
+    def log(self, user_id, endpoint, response_size, tier=None):
+        self.log_many([(user_id, endpoint, response_size)], tier)
+
+    def log_many(self, events, tier=None):
+        """Queue (user_id, endpoint, response_size) events; never touches SQLite"""
+        timestamp = utc_timestamp()
+        self.append_many([(user_id, endpoint, timestamp, response_size, tier)
+                          for user_id, endpoint, response_size in events])
+
+    def write_batch(self, batch):
+        with instrumentation.span('usage-flush'):
+            state.get_backend().write_usage(batch)
+
+
+usage_logger = UsageLogger()